@@ -7,9 +7,19 @@
 #include <structmember.h>
 #include <float.h>
 #include <stdbool.h>
+#include <pythread.h>
 
 #include "lib/tsinfer.h"
 
+/* Snapshots are memory mapped where possible, and otherwise read into memory. */
+#if !defined(_WIN32)
+#define MMAP_SNAPSHOTS 1
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+#endif
+
 #if PY_MAJOR_VERSION >= 3
 #define IS_PY3K
 #endif
@@ -25,6 +35,12 @@ typedef struct {
     ancestor_builder_t *builder;
 } AncestorBuilder;
 
+typedef struct {
+    PyObject_HEAD
+    ancestor_builder_workspace_t *workspace;
+    AncestorBuilder *ancestor_builder;
+} AncestorBuilderWorkspace;
+
 typedef struct {
     PyObject_HEAD
     tree_sequence_builder_t *tree_sequence_builder;
@@ -34,8 +50,14 @@ typedef struct {
     PyObject_HEAD
     ancestor_matcher_t *ancestor_matcher;
     TreeSequenceBuilder *tree_sequence_builder;
+    /* Additional low-level matchers used by the worker threads in find_paths.
+     * These are allocated on demand and kept for subsequent calls. */
+    ancestor_matcher_t **workers;
+    size_t num_workers;
 } AncestorMatcher;
 
+static PyTypeObject AncestorBuilderWorkspaceType;
+
 static void
 handle_library_error(int err)
 {
@@ -166,16 +188,83 @@ out:
     return ret;
 }
 
+static PyObject *
+AncestorBuilder_add_sites(AncestorBuilder *self, PyObject *args, PyObject *kwds)
+{
+    int err;
+    static char *kwlist[] = {"time", "genotypes", NULL};
+    PyObject *ret = NULL;
+    PyObject *time = NULL;
+    PyArrayObject *time_array = NULL;
+    PyObject *genotypes = NULL;
+    PyArrayObject *genotypes_array = NULL;
+    npy_intp *shape;
+    size_t num_sites;
+
+    if (AncestorBuilder_check_state(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO", kwlist,
+            &time, &genotypes)) {
+        goto out;
+    }
+    time_array = (PyArrayObject *) PyArray_FROM_OTF(time, NPY_FLOAT64,
+            NPY_ARRAY_IN_ARRAY);
+    if (time_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(time_array) != 1) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 1");
+        goto out;
+    }
+    num_sites = (size_t) PyArray_DIMS(time_array)[0];
+    genotypes_array = (PyArrayObject *) PyArray_FROM_OTF(genotypes, NPY_INT8,
+            NPY_ARRAY_IN_ARRAY);
+    if (genotypes_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(genotypes_array) != 2) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 2");
+        goto out;
+    }
+    shape = PyArray_DIMS(genotypes_array);
+    if (shape[0] != (npy_intp) num_sites) {
+        PyErr_SetString(PyExc_ValueError, "time and genotypes must have the same "
+                "number of sites.");
+        goto out;
+    }
+    if (shape[1] != (npy_intp) self->builder->num_samples) {
+        PyErr_SetString(PyExc_ValueError, "genotypes array wrong size.");
+        goto out;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    err = ancestor_builder_add_sites(self->builder, num_sites,
+            (double *) PyArray_DATA(time_array),
+            (allele_t *) PyArray_DATA(genotypes_array));
+    Py_END_ALLOW_THREADS
+    if (err != 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    ret = Py_BuildValue("");
+out:
+    Py_XDECREF(time_array);
+    Py_XDECREF(genotypes_array);
+    return ret;
+}
+
 static PyObject *
 AncestorBuilder_make_ancestor(AncestorBuilder *self, PyObject *args, PyObject *kwds)
 {
     int err;
     PyObject *ret = NULL;
-    static char *kwlist[] = {"focal_sites", "ancestor", NULL};
+    static char *kwlist[] = {"focal_sites", "ancestor", "workspace", NULL};
     PyObject *ancestor = NULL;
     PyArrayObject *ancestor_array = NULL;
     PyObject *focal_sites = NULL;
     PyArrayObject *focal_sites_array = NULL;
+    AncestorBuilderWorkspace *workspace = NULL;
+    ancestor_builder_workspace_t *ws = NULL;
     size_t num_focal_sites;
     size_t num_sites;
     tsk_id_t start, end;
@@ -184,10 +273,24 @@ AncestorBuilder_make_ancestor(AncestorBuilder *self, PyObject *args, PyObject *k
     if (AncestorBuilder_check_state(self) != 0) {
         goto out;
     }
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO!", kwlist,
-            &focal_sites, &PyArray_Type, &ancestor)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO!|O!", kwlist,
+            &focal_sites, &PyArray_Type, &ancestor,
+            &AncestorBuilderWorkspaceType, &workspace)) {
         goto out;
     }
+    if (workspace != NULL) {
+        if (workspace->workspace == NULL) {
+            PyErr_SetString(PyExc_SystemError,
+                    "AncestorBuilderWorkspace not initialised");
+            goto out;
+        }
+        if (workspace->ancestor_builder != self) {
+            PyErr_SetString(PyExc_ValueError,
+                    "workspace was allocated for a different AncestorBuilder");
+            goto out;
+        }
+        ws = workspace->workspace;
+    }
     num_sites = self->builder->num_sites;
     focal_sites_array = (PyArrayObject *) PyArray_FROM_OTF(focal_sites, NPY_INT32,
             NPY_ARRAY_IN_ARRAY);
@@ -221,7 +324,7 @@ AncestorBuilder_make_ancestor(AncestorBuilder *self, PyObject *args, PyObject *k
     Py_BEGIN_ALLOW_THREADS
     err = ancestor_builder_make_ancestor(self->builder, num_focal_sites,
         (int32_t *) PyArray_DATA(focal_sites_array),
-        &start, &end, (int8_t *) PyArray_DATA(ancestor_array));
+        &start, &end, (int8_t *) PyArray_DATA(ancestor_array), ws);
     Py_END_ALLOW_THREADS
     if (err != 0) {
         handle_library_error(err);
@@ -341,9 +444,14 @@ static PyMethodDef AncestorBuilder_methods[] = {
     {"add_site", (PyCFunction) AncestorBuilder_add_site,
         METH_VARARGS|METH_KEYWORDS,
         "Adds the specified site to this ancestor builder."},
+    {"add_sites", (PyCFunction) AncestorBuilder_add_sites,
+        METH_VARARGS|METH_KEYWORDS,
+        "Adds the sites in the rows of the specified genotype matrix to this "
+        "ancestor builder."},
     {"make_ancestor", (PyCFunction) AncestorBuilder_make_ancestor,
         METH_VARARGS|METH_KEYWORDS,
-        "Makes the specified ancestor."},
+        "Makes the specified ancestor, optionally using the specified "
+        "workspace for scratch memory."},
     {"ancestor_descriptors", (PyCFunction) AncestorBuilder_ancestor_descriptors,
         METH_NOARGS,
         "Returns a list of ancestor (frequency, focal_sites) tuples."},
@@ -389,6 +497,98 @@ static PyTypeObject AncestorBuilderType = {
     (initproc)AncestorBuilder_init,      /* tp_init */
 };
 
+/*===================================================================
+ * AncestorBuilderWorkspace
+ *===================================================================
+ */
+
+static void
+AncestorBuilderWorkspace_dealloc(AncestorBuilderWorkspace* self)
+{
+    if (self->workspace != NULL) {
+        ancestor_builder_workspace_free(self->workspace);
+        PyMem_Free(self->workspace);
+        self->workspace = NULL;
+    }
+    Py_XDECREF(self->ancestor_builder);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int
+AncestorBuilderWorkspace_init(AncestorBuilderWorkspace *self, PyObject *args,
+        PyObject *kwds)
+{
+    int ret = -1;
+    int err;
+    static char *kwlist[] = {"ancestor_builder", NULL};
+    AncestorBuilder *ancestor_builder = NULL;
+
+    self->workspace = NULL;
+    self->ancestor_builder = NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!", kwlist,
+                &AncestorBuilderType, &ancestor_builder)) {
+        goto out;
+    }
+    self->ancestor_builder = ancestor_builder;
+    Py_INCREF(self->ancestor_builder);
+    if (AncestorBuilder_check_state(self->ancestor_builder) != 0) {
+        goto out;
+    }
+    self->workspace = PyMem_Malloc(sizeof(ancestor_builder_workspace_t));
+    if (self->workspace == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    err = ancestor_builder_workspace_alloc(self->workspace,
+            self->ancestor_builder->builder);
+    if (err != 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+static PyTypeObject AncestorBuilderWorkspaceType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_tsinfer.AncestorBuilderWorkspace",             /* tp_name */
+    sizeof(AncestorBuilderWorkspace),             /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)AncestorBuilderWorkspace_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "AncestorBuilderWorkspace objects",           /* tp_doc */
+    0,                     /* tp_traverse */
+    0,                     /* tp_clear */
+    0,                     /* tp_richcompare */
+    0,                     /* tp_weaklistoffset */
+    0,                     /* tp_iter */
+    0,                     /* tp_iternext */
+    0,                         /* tp_methods */
+    0,                         /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)AncestorBuilderWorkspace_init,      /* tp_init */
+};
+
 /*===================================================================
  * TreeSequenceBuilder
  *===================================================================
@@ -970,10 +1170,12 @@ out:
 }
 
 static PyObject *
-TreeSequenceBuilder_dump_edges(TreeSequenceBuilder *self)
+TreeSequenceBuilder_dump_edges(TreeSequenceBuilder *self, PyObject *args, PyObject *kwds)
 {
     int err;
     PyObject *ret = NULL;
+    static char *kwlist[] = {"sort", NULL};
+    int sort = 0;
     PyArrayObject *left = NULL;
     PyArrayObject *right = NULL;
     PyArrayObject *parent = NULL;
@@ -983,6 +1185,9 @@ TreeSequenceBuilder_dump_edges(TreeSequenceBuilder *self)
     if (TreeSequenceBuilder_check_state(self) != 0) {
         goto out;
     }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|i", kwlist, &sort)) {
+        goto out;
+    }
     shape = tree_sequence_builder_get_num_edges(self->tree_sequence_builder);
     left = (PyArrayObject *) PyArray_SimpleNew(1, &shape, NPY_INT32);
     right = (PyArrayObject *) PyArray_SimpleNew(1, &shape, NPY_INT32);
@@ -992,11 +1197,19 @@ TreeSequenceBuilder_dump_edges(TreeSequenceBuilder *self)
         goto out;
     }
     Py_BEGIN_ALLOW_THREADS
-    err = tree_sequence_builder_dump_edges(self->tree_sequence_builder,
-        (tsk_id_t *) PyArray_DATA(left),
-        (tsk_id_t *) PyArray_DATA(right),
-        (tsk_id_t *) PyArray_DATA(parent),
-        (tsk_id_t *) PyArray_DATA(child));
+    if (sort) {
+        err = tree_sequence_builder_dump_sorted_edges(self->tree_sequence_builder,
+            (tsk_id_t *) PyArray_DATA(left),
+            (tsk_id_t *) PyArray_DATA(right),
+            (tsk_id_t *) PyArray_DATA(parent),
+            (tsk_id_t *) PyArray_DATA(child));
+    } else {
+        err = tree_sequence_builder_dump_edges(self->tree_sequence_builder,
+            (tsk_id_t *) PyArray_DATA(left),
+            (tsk_id_t *) PyArray_DATA(right),
+            (tsk_id_t *) PyArray_DATA(parent),
+            (tsk_id_t *) PyArray_DATA(child));
+    }
     Py_END_ALLOW_THREADS
     if (err != 0) {
         handle_library_error(err);
@@ -1067,6 +1280,137 @@ out:
     return ret;
 }
 
+static PyObject *
+TreeSequenceBuilder_dump_snapshot(TreeSequenceBuilder *self, PyObject *args, PyObject *kwds)
+{
+    int err;
+    PyObject *ret = NULL;
+    static char *kwlist[] = {"path", NULL};
+    PyObject *path = NULL;
+    FILE *file = NULL;
+
+    if (TreeSequenceBuilder_check_state(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&", kwlist,
+                PyUnicode_FSConverter, &path)) {
+        goto out;
+    }
+    file = fopen(PyBytes_AS_STRING(path), "wb");
+    if (file == NULL) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        goto out;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    err = tree_sequence_builder_dump_snapshot(self->tree_sequence_builder, file);
+    Py_END_ALLOW_THREADS
+    if (err == TSI_ERR_IO) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        goto out;
+    }
+    if (err != 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    err = fclose(file);
+    file = NULL;
+    if (err != 0) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        goto out;
+    }
+    ret = Py_BuildValue("");
+out:
+    if (file != NULL) {
+        fclose(file);
+    }
+    Py_XDECREF(path);
+    return ret;
+}
+
+static PyObject *
+TreeSequenceBuilder_restore_snapshot(TreeSequenceBuilder *self, PyObject *args, PyObject *kwds)
+{
+    int err;
+    PyObject *ret = NULL;
+    static char *kwlist[] = {"path", NULL};
+    PyObject *path = NULL;
+    void *snapshot = NULL;
+    size_t size = 0;
+#ifdef MMAP_SNAPSHOTS
+    int fd = -1;
+    struct stat st;
+#else
+    FILE *file = NULL;
+    long file_size;
+#endif
+
+    if (TreeSequenceBuilder_check_state(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O&", kwlist,
+                PyUnicode_FSConverter, &path)) {
+        goto out;
+    }
+#ifdef MMAP_SNAPSHOTS
+    fd = open(PyBytes_AS_STRING(path), O_RDONLY);
+    if (fd == -1 || fstat(fd, &st) != 0) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        goto out;
+    }
+    size = (size_t) st.st_size;
+    if (size > 0) {
+        snapshot = mmap(NULL, size, PROT_READ, MAP_PRIVATE, fd, 0);
+        if (snapshot == MAP_FAILED) {
+            snapshot = NULL;
+            PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+            goto out;
+        }
+    }
+#else
+    file = fopen(PyBytes_AS_STRING(path), "rb");
+    if (file == NULL || fseek(file, 0, SEEK_END) != 0
+            || (file_size = ftell(file)) < 0 || fseek(file, 0, SEEK_SET) != 0) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        goto out;
+    }
+    size = (size_t) file_size;
+    snapshot = PyMem_Malloc(size > 0 ? size : 1);
+    if (snapshot == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    if (fread(snapshot, 1, size, file) != size) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+        goto out;
+    }
+#endif
+    Py_BEGIN_ALLOW_THREADS
+    err = tree_sequence_builder_restore_snapshot(
+        self->tree_sequence_builder, snapshot, size);
+    Py_END_ALLOW_THREADS
+    if (err != 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    ret = Py_BuildValue("");
+out:
+#ifdef MMAP_SNAPSHOTS
+    if (snapshot != NULL) {
+        munmap(snapshot, size);
+    }
+    if (fd != -1) {
+        close(fd);
+    }
+#else
+    PyMem_Free(snapshot);
+    if (file != NULL) {
+        fclose(file);
+    }
+#endif
+    Py_XDECREF(path);
+    return ret;
+}
+
 static PyObject *
 TreeSequenceBuilder_freeze_indexes(TreeSequenceBuilder *self)
 {
@@ -1191,10 +1535,17 @@ static PyMethodDef TreeSequenceBuilder_methods[] = {
         "Restores the mutations in this tree sequence builder."},
     {"dump_nodes", (PyCFunction) TreeSequenceBuilder_dump_nodes, METH_NOARGS,
         "Dumps node data into numpy arrays."},
-    {"dump_edges", (PyCFunction) TreeSequenceBuilder_dump_edges, METH_NOARGS,
-        "Dumps edgeset data into numpy arrays."},
+    {"dump_edges", (PyCFunction) TreeSequenceBuilder_dump_edges,
+        METH_VARARGS|METH_KEYWORDS,
+        "Dumps edgeset data into numpy arrays, optionally in tskit sorted order."},
     {"dump_mutations", (PyCFunction) TreeSequenceBuilder_dump_mutations, METH_NOARGS,
-        "Dumps mutation data into numpy arrays."},
+        "Dumps mutation data, including the mutation parents, into numpy arrays."},
+    {"dump_snapshot", (PyCFunction) TreeSequenceBuilder_dump_snapshot,
+        METH_VARARGS|METH_KEYWORDS,
+        "Writes a snapshot of the builder's state to the specified file."},
+    {"restore_snapshot", (PyCFunction) TreeSequenceBuilder_restore_snapshot,
+        METH_VARARGS|METH_KEYWORDS,
+        "Restores the state of this empty builder from the specified snapshot file."},
     {"freeze_indexes", (PyCFunction) TreeSequenceBuilder_freeze_indexes, METH_NOARGS,
         "Freezes the indexes used for ancestor matching."},
     {NULL}  /* Sentinel */
@@ -1259,11 +1610,21 @@ AncestorMatcher_check_state(AncestorMatcher *self)
 static void
 AncestorMatcher_dealloc(AncestorMatcher* self)
 {
+    size_t j;
+
     if (self->ancestor_matcher != NULL) {
         ancestor_matcher_free(self->ancestor_matcher);
         PyMem_Free(self->ancestor_matcher);
         self->ancestor_matcher = NULL;
     }
+    if (self->workers != NULL) {
+        for (j = 0; j < self->num_workers; j++) {
+            ancestor_matcher_free(self->workers[j]);
+            PyMem_Free(self->workers[j]);
+        }
+        PyMem_Free(self->workers);
+        self->workers = NULL;
+    }
     Py_XDECREF(self->tree_sequence_builder);
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
@@ -1275,7 +1636,7 @@ AncestorMatcher_init(AncestorMatcher *self, PyObject *args, PyObject *kwds)
     int err;
     int extended_checks = 0;
     static char *kwlist[] = {"tree_sequence_builder", "recombination",
-        "mismatch", "precision", "extended_checks", NULL};
+        "mismatch", "precision", "extended_checks", "traceback_memory_limit", NULL};
     TreeSequenceBuilder *tree_sequence_builder = NULL;
     PyObject *recombination = NULL;
     PyObject *mismatch = NULL;
@@ -1283,14 +1644,21 @@ AncestorMatcher_init(AncestorMatcher *self, PyObject *args, PyObject *kwds)
     PyArrayObject *mismatch_array = NULL;
     npy_intp *shape;
     unsigned int precision = 22;
+    Py_ssize_t traceback_memory_limit = 0;
     int flags = 0;
 
     self->ancestor_matcher = NULL;
     self->tree_sequence_builder = NULL;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!OO|Ii", kwlist,
+    self->workers = NULL;
+    self->num_workers = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!OO|Iin", kwlist,
                 &TreeSequenceBuilderType, &tree_sequence_builder,
                 &recombination, &mismatch, &precision,
-                &extended_checks)) {
+                &extended_checks, &traceback_memory_limit)) {
+        goto out;
+    }
+    if (traceback_memory_limit < 0) {
+        PyErr_SetString(PyExc_ValueError, "traceback_memory_limit must be >= 0");
         goto out;
     }
     self->tree_sequence_builder = tree_sequence_builder;
@@ -1340,6 +1708,8 @@ AncestorMatcher_init(AncestorMatcher *self, PyObject *args, PyObject *kwds)
         handle_library_error(err);
         goto out;
     }
+    ancestor_matcher_set_traceback_memory_limit(self->ancestor_matcher,
+            (size_t) traceback_memory_limit);
     ret = 0;
 out:
     Py_XDECREF(recombination_array);
@@ -1352,14 +1722,17 @@ AncestorMatcher_find_path(AncestorMatcher *self, PyObject *args, PyObject *kwds)
 {
     int err;
     PyObject *ret = NULL;
-    static char *kwlist[] = {"haplotype", "start", "end", "match", NULL};
+    static char *kwlist[] = {"haplotype", "start", "end", "match",
+        "num_match_nodes", NULL};
     PyObject *haplotype = NULL;
     PyArrayObject *haplotype_array = NULL;
     PyObject *match = NULL;
     PyArrayObject *match_array = NULL;
+    ancestor_matcher_t *matcher = self->ancestor_matcher;
     npy_intp *shape;
     size_t num_edges;
     int start, end;
+    Py_ssize_t num_match_nodes = 0;
     tsk_id_t *ret_left, *ret_right;
     tsk_id_t *ret_parent;
     PyArrayObject *left = NULL;
@@ -1370,8 +1743,12 @@ AncestorMatcher_find_path(AncestorMatcher *self, PyObject *args, PyObject *kwds)
     if (AncestorMatcher_check_state(self) != 0) {
         goto out;
     }
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OiiO!", kwlist,
-                &haplotype, &start, &end, &PyArray_Type, &match)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OiiO!|n", kwlist,
+                &haplotype, &start, &end, &PyArray_Type, &match, &num_match_nodes)) {
+        goto out;
+    }
+    if (num_match_nodes < 0) {
+        PyErr_SetString(PyExc_ValueError, "num_match_nodes must be >= 0");
         goto out;
     }
     haplotype_array = (PyArrayObject *) PyArray_FROM_OTF(haplotype, NPY_INT8,
@@ -1404,12 +1781,20 @@ AncestorMatcher_find_path(AncestorMatcher *self, PyObject *args, PyObject *kwds)
         goto out;
     }
 
+    /* Hold a reference to the current frozen indexes so that the builder can
+     * be modified and refrozen by other threads while we are matching. */
+    matcher->indexes = tree_sequence_builder_acquire_indexes(
+            matcher->tree_sequence_builder);
+    matcher->num_match_nodes = (size_t) num_match_nodes;
     Py_BEGIN_ALLOW_THREADS
-    err = ancestor_matcher_find_path(self->ancestor_matcher,
+    err = ancestor_matcher_find_path(matcher,
             (tsk_id_t) start, (tsk_id_t) end, (allele_t *) PyArray_DATA(haplotype_array),
             (allele_t *) PyArray_DATA(match_array),
             &num_edges, &ret_left, &ret_right, &ret_parent);
     Py_END_ALLOW_THREADS
+    frozen_indexes_release(matcher->indexes);
+    matcher->indexes = NULL;
+    matcher->num_match_nodes = 0;
     if (err != 0) {
         handle_library_error(err);
         goto out;
@@ -1440,16 +1825,434 @@ out:
     return ret;
 }
 
+/* State shared between the threads matching a block of haplotypes in
+ * AncestorMatcher.find_paths. Haplotypes are handed out to the workers one at
+ * a time under the lock, and each worker stores its outputs in the per
+ * haplotype result slot, so that no Python objects are touched until all
+ * threads have finished. */
+typedef struct {
+    size_t num_edges;
+    tsk_id_t *left;
+    tsk_id_t *right;
+    tsk_id_t *parent;
+    size_t num_mutations;
+    tsk_id_t *mutation_site;
+    allele_t *mutation_derived_state;
+    double mean_traceback_size;
+} find_paths_result_t;
+
+typedef struct {
+    size_t num_haplotypes;
+    size_t num_sites;
+    const allele_t *haplotypes;
+    const int32_t *start;
+    const int32_t *end;
+    find_paths_result_t *results;
+    PyThread_type_lock lock;
+    size_t next_haplotype;
+    int error;
+} find_paths_work_t;
+
+typedef struct {
+    find_paths_work_t *work;
+    ancestor_matcher_t *matcher;
+    allele_t *match;
+    PyThread_type_lock done;
+} find_paths_worker_t;
+
+static int
+find_paths_match_haplotype(find_paths_worker_t *worker, size_t index)
+{
+    int ret = 0;
+    find_paths_work_t *work = worker->work;
+    find_paths_result_t *result = &work->results[index];
+    const allele_t *haplotype = work->haplotypes + index * work->num_sites;
+    tsk_id_t start = (tsk_id_t) work->start[index];
+    tsk_id_t end = (tsk_id_t) work->end[index];
+    allele_t *match = worker->match;
+    size_t num_edges, num_mutations, j;
+    tsk_id_t *left, *right, *parent;
+    tsk_id_t l;
+
+    ret = ancestor_matcher_find_path(worker->matcher, start, end,
+            (allele_t *) haplotype, match, &num_edges, &left, &right, &parent);
+    if (ret != 0) {
+        goto out;
+    }
+    /* Copy the outputs, as they are overwritten by the next find_path */
+    result->num_edges = num_edges;
+    result->left = malloc(num_edges * sizeof(*result->left));
+    result->right = malloc(num_edges * sizeof(*result->right));
+    result->parent = malloc(num_edges * sizeof(*result->parent));
+    if (result->left == NULL || result->right == NULL || result->parent == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    memcpy(result->left, left, num_edges * sizeof(*left));
+    memcpy(result->right, right, num_edges * sizeof(*right));
+    memcpy(result->parent, parent, num_edges * sizeof(*parent));
+    result->mean_traceback_size
+        = ancestor_matcher_get_mean_traceback_size(worker->matcher);
+
+    /* Mutations are needed wherever the haplotype differs from the
+     * match, ignoring sites with missing data. */
+    num_mutations = 0;
+    for (l = start; l < end; l++) {
+        if (haplotype[l] != TSK_MISSING_DATA && haplotype[l] != match[l]) {
+            num_mutations++;
+        }
+    }
+    result->num_mutations = num_mutations;
+    result->mutation_site = malloc(
+            TSK_MAX(1, num_mutations) * sizeof(*result->mutation_site));
+    result->mutation_derived_state = malloc(
+            TSK_MAX(1, num_mutations) * sizeof(*result->mutation_derived_state));
+    if (result->mutation_site == NULL || result->mutation_derived_state == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    j = 0;
+    for (l = start; l < end; l++) {
+        if (haplotype[l] != TSK_MISSING_DATA && haplotype[l] != match[l]) {
+            result->mutation_site[j] = l;
+            result->mutation_derived_state[j] = haplotype[l];
+            j++;
+        }
+    }
+out:
+    return ret;
+}
+
+static void
+find_paths_worker_run(void *arg)
+{
+    find_paths_worker_t *worker = (find_paths_worker_t *) arg;
+    find_paths_work_t *work = worker->work;
+    size_t index;
+    int err;
+
+    while (true) {
+        PyThread_acquire_lock(work->lock, WAIT_LOCK);
+        index = work->num_haplotypes;
+        if (work->error == 0 && work->next_haplotype < work->num_haplotypes) {
+            index = work->next_haplotype;
+            work->next_haplotype++;
+        }
+        PyThread_release_lock(work->lock);
+        if (index == work->num_haplotypes) {
+            break;
+        }
+        err = find_paths_match_haplotype(worker, index);
+        if (err != 0) {
+            PyThread_acquire_lock(work->lock, WAIT_LOCK);
+            if (work->error == 0) {
+                work->error = err;
+            }
+            PyThread_release_lock(work->lock);
+        }
+    }
+    if (worker->done != NULL) {
+        PyThread_release_lock(worker->done);
+    }
+}
+
+static int
+AncestorMatcher_alloc_workers(AncestorMatcher *self, size_t num_workers)
+{
+    int ret = -1;
+    int err;
+    ancestor_matcher_t *source = self->ancestor_matcher;
+    ancestor_matcher_t **workers;
+
+    if (num_workers <= self->num_workers) {
+        ret = 0;
+        goto out;
+    }
+    workers = PyMem_Realloc(self->workers, num_workers * sizeof(*workers));
+    if (workers == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    self->workers = workers;
+    while (self->num_workers < num_workers) {
+        workers[self->num_workers] = PyMem_Malloc(sizeof(ancestor_matcher_t));
+        if (workers[self->num_workers] == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        err = ancestor_matcher_alloc(workers[self->num_workers],
+                source->tree_sequence_builder, source->recombination_rate,
+                source->mismatch_rate, source->precision, source->flags);
+        if (err != 0) {
+            ancestor_matcher_free(workers[self->num_workers]);
+            PyMem_Free(workers[self->num_workers]);
+            handle_library_error(err);
+            goto out;
+        }
+        ancestor_matcher_set_traceback_memory_limit(workers[self->num_workers],
+                source->traceback_memory_limit);
+        self->num_workers++;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+static PyObject *
+AncestorMatcher_find_paths(AncestorMatcher *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *ret = NULL;
+    static char *kwlist[] = {"haplotypes", "start", "end", "num_threads", NULL};
+    PyObject *haplotypes = NULL;
+    PyObject *start = NULL;
+    PyObject *end = NULL;
+    int num_threads = 1;
+    PyArrayObject *haplotypes_array = NULL;
+    PyArrayObject *start_array = NULL;
+    PyArrayObject *end_array = NULL;
+    PyArrayObject *edge_offset = NULL;
+    PyArrayObject *left = NULL;
+    PyArrayObject *right = NULL;
+    PyArrayObject *parent = NULL;
+    PyArrayObject *mutation_offset = NULL;
+    PyArrayObject *mutation_site = NULL;
+    PyArrayObject *mutation_derived_state = NULL;
+    PyArrayObject *mean_traceback_size = NULL;
+    find_paths_work_t work;
+    find_paths_worker_t *workers = NULL;
+    frozen_indexes_t *indexes;
+    find_paths_result_t *result;
+    size_t num_haplotypes, num_sites, num_workers, num_edges, num_mutations, j;
+    npy_intp *shape;
+    npy_intp dims[1];
+    uint64_t *edge_offset_data, *mutation_offset_data;
+    uint32_t *left_data, *right_data;
+    int32_t *parent_data, *site_data;
+    int8_t *derived_state_data;
+    double *mean_traceback_size_data;
+
+    num_workers = 0;
+    memset(&work, 0, sizeof(work));
+    if (AncestorMatcher_check_state(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO|i", kwlist,
+                &haplotypes, &start, &end, &num_threads)) {
+        goto out;
+    }
+    num_sites = self->ancestor_matcher->num_sites;
+    haplotypes_array = (PyArrayObject *) PyArray_FROM_OTF(haplotypes, NPY_INT8,
+            NPY_ARRAY_IN_ARRAY);
+    if (haplotypes_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(haplotypes_array) != 2) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 2");
+        goto out;
+    }
+    shape = PyArray_DIMS(haplotypes_array);
+    num_haplotypes = (size_t) shape[0];
+    if (shape[1] != (npy_intp) num_sites) {
+        PyErr_SetString(PyExc_ValueError, "Incorrect size for input haplotypes.");
+        goto out;
+    }
+    start_array = (PyArrayObject *) PyArray_FROMANY(start, NPY_INT32, 1, 1,
+            NPY_ARRAY_IN_ARRAY);
+    if (start_array == NULL) {
+        goto out;
+    }
+    end_array = (PyArrayObject *) PyArray_FROMANY(end, NPY_INT32, 1, 1,
+            NPY_ARRAY_IN_ARRAY);
+    if (end_array == NULL) {
+        goto out;
+    }
+    if (PyArray_DIMS(start_array)[0] != (npy_intp) num_haplotypes
+            || PyArray_DIMS(end_array)[0] != (npy_intp) num_haplotypes) {
+        PyErr_SetString(PyExc_ValueError,
+                "start and end must have one value per haplotype");
+        goto out;
+    }
+    work.num_haplotypes = num_haplotypes;
+    work.num_sites = num_sites;
+    work.haplotypes = (const allele_t *) PyArray_DATA(haplotypes_array);
+    work.start = (const int32_t *) PyArray_DATA(start_array);
+    work.end = (const int32_t *) PyArray_DATA(end_array);
+    for (j = 0; j < num_haplotypes; j++) {
+        if (work.start[j] < 0 || work.start[j] >= work.end[j]
+                || work.end[j] > (int32_t) num_sites) {
+            PyErr_SetString(PyExc_ValueError, "Bad start/end values");
+            goto out;
+        }
+    }
+
+    num_workers = (size_t) TSK_MAX(1, TSK_MIN(num_threads, (int) num_haplotypes));
+    if (AncestorMatcher_alloc_workers(self, num_workers - 1) != 0) {
+        goto out;
+    }
+    work.results = PyMem_Calloc(TSK_MAX(1, num_haplotypes), sizeof(*work.results));
+    workers = PyMem_Calloc(num_workers, sizeof(*workers));
+    if (work.results == NULL || workers == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    work.lock = PyThread_allocate_lock();
+    if (work.lock == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < num_workers; j++) {
+        workers[j].work = &work;
+        workers[j].matcher = j == 0? self->ancestor_matcher: self->workers[j - 1];
+        workers[j].match = PyMem_Malloc(num_sites * sizeof(allele_t));
+        if (workers[j].match == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        if (j > 0) {
+            workers[j].done = PyThread_allocate_lock();
+            if (workers[j].done == NULL) {
+                PyErr_NoMemory();
+                goto out;
+            }
+        }
+    }
+
+    indexes = tree_sequence_builder_acquire_indexes(
+            self->ancestor_matcher->tree_sequence_builder);
+    for (j = 0; j < num_workers; j++) {
+        workers[j].matcher->indexes = indexes;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    /* The calling thread matches haplotypes alongside the workers. If a thread
+     * can't be started the remaining workers simply do more of the matching. */
+    for (j = 1; j < num_workers; j++) {
+        PyThread_acquire_lock(workers[j].done, WAIT_LOCK);
+        if (PyThread_start_new_thread(find_paths_worker_run, &workers[j])
+                == PYTHREAD_INVALID_THREAD_ID) {
+            PyThread_release_lock(workers[j].done);
+        }
+    }
+    find_paths_worker_run(&workers[0]);
+    for (j = 1; j < num_workers; j++) {
+        PyThread_acquire_lock(workers[j].done, WAIT_LOCK);
+        PyThread_release_lock(workers[j].done);
+    }
+    Py_END_ALLOW_THREADS
+    for (j = 0; j < num_workers; j++) {
+        workers[j].matcher->indexes = NULL;
+    }
+    frozen_indexes_release(indexes);
+    if (work.error != 0) {
+        handle_library_error(work.error);
+        goto out;
+    }
+
+    num_edges = 0;
+    num_mutations = 0;
+    for (j = 0; j < num_haplotypes; j++) {
+        num_edges += work.results[j].num_edges;
+        num_mutations += work.results[j].num_mutations;
+    }
+    dims[0] = (npy_intp) num_haplotypes + 1;
+    edge_offset = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_UINT64);
+    mutation_offset = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_UINT64);
+    dims[0] = (npy_intp) num_haplotypes;
+    mean_traceback_size = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_FLOAT64);
+    dims[0] = (npy_intp) num_edges;
+    left = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_UINT32);
+    right = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_UINT32);
+    parent = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_INT32);
+    dims[0] = (npy_intp) num_mutations;
+    mutation_site = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_INT32);
+    mutation_derived_state = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_INT8);
+    if (edge_offset == NULL || mutation_offset == NULL || mean_traceback_size == NULL
+            || left == NULL || right == NULL || parent == NULL
+            || mutation_site == NULL || mutation_derived_state == NULL) {
+        goto out;
+    }
+    edge_offset_data = (uint64_t *) PyArray_DATA(edge_offset);
+    mutation_offset_data = (uint64_t *) PyArray_DATA(mutation_offset);
+    mean_traceback_size_data = (double *) PyArray_DATA(mean_traceback_size);
+    left_data = (uint32_t *) PyArray_DATA(left);
+    right_data = (uint32_t *) PyArray_DATA(right);
+    parent_data = (int32_t *) PyArray_DATA(parent);
+    site_data = (int32_t *) PyArray_DATA(mutation_site);
+    derived_state_data = (int8_t *) PyArray_DATA(mutation_derived_state);
+    num_edges = 0;
+    num_mutations = 0;
+    for (j = 0; j < num_haplotypes; j++) {
+        result = &work.results[j];
+        edge_offset_data[j] = num_edges;
+        mutation_offset_data[j] = num_mutations;
+        mean_traceback_size_data[j] = result->mean_traceback_size;
+        memcpy(left_data + num_edges, result->left,
+                result->num_edges * sizeof(*result->left));
+        memcpy(right_data + num_edges, result->right,
+                result->num_edges * sizeof(*result->right));
+        memcpy(parent_data + num_edges, result->parent,
+                result->num_edges * sizeof(*result->parent));
+        memcpy(site_data + num_mutations, result->mutation_site,
+                result->num_mutations * sizeof(*result->mutation_site));
+        memcpy(derived_state_data + num_mutations, result->mutation_derived_state,
+                result->num_mutations * sizeof(*result->mutation_derived_state));
+        num_edges += result->num_edges;
+        num_mutations += result->num_mutations;
+    }
+    edge_offset_data[num_haplotypes] = num_edges;
+    mutation_offset_data[num_haplotypes] = num_mutations;
+
+    ret = Py_BuildValue("(OOOOOOOO)", edge_offset, left, right, parent,
+            mutation_offset, mutation_site, mutation_derived_state,
+            mean_traceback_size);
+out:
+    if (work.results != NULL) {
+        for (j = 0; j < work.num_haplotypes; j++) {
+            result = &work.results[j];
+            tsi_safe_free(result->left);
+            tsi_safe_free(result->right);
+            tsi_safe_free(result->parent);
+            tsi_safe_free(result->mutation_site);
+            tsi_safe_free(result->mutation_derived_state);
+        }
+        PyMem_Free(work.results);
+    }
+    if (workers != NULL) {
+        for (j = 0; j < num_workers; j++) {
+            PyMem_Free(workers[j].match);
+            if (workers[j].done != NULL) {
+                PyThread_free_lock(workers[j].done);
+            }
+        }
+        PyMem_Free(workers);
+    }
+    if (work.lock != NULL) {
+        PyThread_free_lock(work.lock);
+    }
+    Py_XDECREF(haplotypes_array);
+    Py_XDECREF(start_array);
+    Py_XDECREF(end_array);
+    Py_XDECREF(edge_offset);
+    Py_XDECREF(left);
+    Py_XDECREF(right);
+    Py_XDECREF(parent);
+    Py_XDECREF(mutation_offset);
+    Py_XDECREF(mutation_site);
+    Py_XDECREF(mutation_derived_state);
+    Py_XDECREF(mean_traceback_size);
+    return ret;
+}
+
 static PyObject *
 AncestorMatcher_get_traceback(AncestorMatcher *self, PyObject *args)
 {
     PyObject *ret = NULL;
     unsigned long site;
-    node_state_list_t *list;
+    int8_t *recombination_required = NULL;
     PyObject *dict = NULL;
     PyObject *key = NULL;
     PyObject *value = NULL;
-    int j;
+    size_t j;
+    int err;
 
     if (AncestorMatcher_check_state(self) != 0) {
         goto out;
@@ -1462,13 +2265,24 @@ AncestorMatcher_get_traceback(AncestorMatcher *self, PyObject *args)
         goto out;
     }
     dict = PyDict_New();
-    if (dict == NULL) {
+    recombination_required = PyMem_Malloc(
+            self->ancestor_matcher->num_nodes * sizeof(*recombination_required));
+    if (dict == NULL || recombination_required == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    err = ancestor_matcher_get_traceback(self->ancestor_matcher,
+            (tsk_id_t) site, recombination_required);
+    if (err != 0) {
+        handle_library_error(err);
         goto out;
     }
-    list = &self->ancestor_matcher->traceback[site];
-    for (j = 0; j < list->size; j++) {
-        key = Py_BuildValue("k", (unsigned long) list->node[j]);
-        value = Py_BuildValue("i", (int) list->recombination_required[j]);
+    for (j = 0; j < self->ancestor_matcher->num_nodes; j++) {
+        if (recombination_required[j] == -1) {
+            continue;
+        }
+        key = Py_BuildValue("k", (unsigned long) j);
+        value = Py_BuildValue("i", (int) recombination_required[j]);
         if (key == NULL || value == NULL) {
             goto out;
         }
@@ -1483,6 +2297,7 @@ AncestorMatcher_get_traceback(AncestorMatcher *self, PyObject *args)
     ret = dict;
     dict = NULL;
 out:
+    PyMem_Free(recombination_required);
     Py_XDECREF(key);
     Py_XDECREF(value);
     Py_XDECREF(dict);
@@ -1535,6 +2350,10 @@ static PyMethodDef AncestorMatcher_methods[] = {
     {"find_path", (PyCFunction) AncestorMatcher_find_path,
         METH_VARARGS|METH_KEYWORDS,
         "Returns a best match path for the specified haplotype through the ancestors."},
+    {"find_paths", (PyCFunction) AncestorMatcher_find_paths,
+        METH_VARARGS|METH_KEYWORDS,
+        "Returns the best match paths and mutations for a block of haplotypes, "
+        "matched using the specified number of threads."},
     {"get_traceback", (PyCFunction) AncestorMatcher_get_traceback,
         METH_VARARGS, "Returns the traceback likelihood dictionary at the specified site."},
     {NULL}  /* Sentinel */
@@ -1635,6 +2454,14 @@ init_tsinfer(void)
     }
     Py_INCREF(&AncestorBuilderType);
     PyModule_AddObject(module, "AncestorBuilder", (PyObject *) &AncestorBuilderType);
+    /* AncestorBuilderWorkspace type */
+    AncestorBuilderWorkspaceType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&AncestorBuilderWorkspaceType) < 0) {
+        INITERROR;
+    }
+    Py_INCREF(&AncestorBuilderWorkspaceType);
+    PyModule_AddObject(module, "AncestorBuilderWorkspace",
+            (PyObject *) &AncestorBuilderWorkspaceType);
     /* AncestorMatcher type */
     AncestorMatcherType.tp_new = PyType_GenericNew;
     if (PyType_Ready(&AncestorMatcherType) < 0) {
@@ -3,6 +3,7 @@ import os
 import pprint
 import random
 import sys
+import time
 
 import msprime
 import numpy as np
@@ -264,6 +265,57 @@ def build_profile_inputs(n, num_megabases):
 #     ancestor_data.finalise()
 
 
+def benchmark_find_path_by_start(n, num_megabases, num_bins=10, seed=1):
+    """
+    Prints the mean time taken to match an ancestor against the full ancestors
+    tree sequence, binned by the ancestor's start position. Before the builder
+    had a seek index this grew linearly with the start position.
+    """
+    ts = msprime.sim_ancestry(
+        n,
+        sequence_length=num_megabases * 10**6,
+        recombination_rate=1e-8,
+        population_size=10**4,
+        random_seed=seed,
+    )
+    ts = msprime.sim_mutations(ts, rate=1e-8, random_seed=seed)
+    sample_data = tsinfer.SampleData.from_tree_sequence(ts)
+    ancestor_data = tsinfer.generate_ancestors(sample_data)
+    ancestors_ts = tsinfer.match_ancestors(sample_data, ancestor_data)
+    matcher = tsinfer.AncestorMatcher(
+        sample_data, ancestor_data, ancestors_ts=ancestors_ts
+    )
+    print(
+        "ancestors =",
+        ancestor_data.num_ancestors,
+        "edges =",
+        ancestors_ts.num_edges,
+        "sites =",
+        ancestors_ts.num_sites,
+    )
+    num_sites = ancestors_ts.num_sites
+    bins = np.linspace(0, num_sites, num_bins + 1)
+    times = [[] for _ in range(num_bins)]
+    with matcher.matcher_instance() as low_level_matcher:
+        for ancestor in ancestor_data.ancestors():
+            before = time.perf_counter()
+            matcher.find_path(
+                low_level_matcher,
+                ancestor.id,
+                ancestor.full_haplotype,
+                ancestor.start,
+                ancestor.end,
+            )
+            duration = time.perf_counter() - before
+            times[np.searchsorted(bins, ancestor.start, side="right") - 1].append(
+                duration
+            )
+    print("start_site\tnum_ancestors\tmean_time_us")
+    for j in range(num_bins):
+        if len(times[j]) > 0:
+            print(f"{int(bins[j])}\t{len(times[j])}\t{np.mean(times[j]) * 1e6:.1f}")
+
+
 def copy_1kg():
     source = "tmp__NOBACKUP__/1kg_chr22.samples"
     sample_data = tsinfer.SampleData.load(source)
@@ -318,6 +370,8 @@ if __name__ == "__main__":
 
     # tutorial_samples()
 
+    # benchmark_find_path_by_start(1000, 10)
+
     # build_profile_inputs(10, 10)
     # build_profile_inputs(100, 10)
     # build_profile_inputs(1000, 100)
@@ -97,6 +97,19 @@ unpackbits(const uint8_t *restrict source, size_t len, allele_t *restrict dest)
     }
 }
 
+static inline unsigned int
+popcount64(uint64_t x)
+{
+#if defined(__GNUC__) || defined(__clang__)
+    return (unsigned int) __builtin_popcountll(x);
+#else
+    x = x - ((x >> 1) & 0x5555555555555555ULL);
+    x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL);
+    x = (x + (x >> 4)) & 0x0f0f0f0f0f0f0f0fULL;
+    return (unsigned int) ((x * 0x0101010101010101ULL) >> 56);
+#endif
+}
+
 static int
 cmp_time_map(const void *a, const void *b)
 {
@@ -410,6 +423,158 @@ ancestor_builder_get_consistent_samples(const ancestor_builder_t *self, tsk_id_t
     *num_samples = (size_t) k;
 }
 
+/* Returns word j of the specified one-bit encoded genotypes. Sample bitsets
+ * are loaded from the encoded genotypes in the same way, so that the bits for
+ * a given sample line up regardless of byte order. The encoding isn't padded
+ * to a whole number of words, so the last word is zero-filled. */
+static inline uint64_t
+ancestor_builder_get_genotype_word(
+    const ancestor_builder_t *self, const uint8_t *restrict encoded, size_t j)
+{
+    uint64_t word = 0;
+    size_t offset = j * sizeof(word);
+
+    if (offset + sizeof(word) <= self->encoded_genotypes_size) {
+        memcpy(&word, encoded + offset, sizeof(word));
+    } else {
+        memcpy(&word, encoded + offset, self->encoded_genotypes_size - offset);
+    }
+    return word;
+}
+
+/* Sets the sample bitset to the samples carrying the derived state at the
+ * specified site, and returns the number of these samples. */
+static size_t
+ancestor_builder_get_consistent_sample_bitset(const ancestor_builder_t *self,
+    tsk_id_t site, uint64_t *restrict sample_bitset, size_t num_words)
+{
+    const uint8_t *restrict encoded = self->sites[site].encoded_genotypes;
+    size_t j, count;
+
+    count = 0;
+    for (j = 0; j < num_words; j++) {
+        sample_bitset[j] = ancestor_builder_get_genotype_word(self, encoded, j);
+        count += popcount64(sample_bitset[j]);
+    }
+    return count;
+}
+
+/* Returns the number of samples in the bitset carrying the derived state
+ * at the specified site. */
+static size_t
+ancestor_builder_count_ones_bitset(const ancestor_builder_t *self, tsk_id_t site,
+    const uint64_t *restrict sample_bitset, size_t num_words)
+{
+    const uint8_t *restrict encoded = self->sites[site].encoded_genotypes;
+    size_t j, ones;
+
+    ones = 0;
+    for (j = 0; j < num_words; j++) {
+        ones += popcount64(
+            ancestor_builder_get_genotype_word(self, encoded, j) & sample_bitset[j]);
+    }
+    return ones;
+}
+
+/* Equivalent to ancestor_builder_compute_ancestral_states for one-bit encoded
+ * genotypes, where there is no missing data. The consensus is computed by
+ * counting the ones in the sample set word by word, and samples that disagree
+ * twice in a row are removed by masking them out of the sample set. */
+static int
+ancestor_builder_compute_ancestral_states_bitset(const ancestor_builder_t *self,
+    int direction, tsk_id_t focal_site, allele_t *ancestor,
+    ancestor_builder_workspace_t *workspace, tsk_id_t *last_site_ret)
+{
+    int ret = 0;
+    tsk_id_t last_site = focal_site;
+    int64_t l;
+    size_t j, ones, removed, sample_set_size, min_sample_set_size;
+    double focal_site_time = self->sites[focal_site].time;
+    const site_t *restrict sites = self->sites;
+    const size_t num_sites = self->num_sites;
+    const size_t num_words = workspace->num_words;
+    uint64_t *restrict sample_bitset = workspace->sample_bitset;
+    uint64_t *restrict disagree = workspace->disagree_bitset;
+    const uint8_t *restrict encoded;
+    uint64_t genotypes, mismatch, remove;
+    allele_t consensus;
+
+    sample_set_size = ancestor_builder_get_consistent_sample_bitset(
+        self, focal_site, sample_bitset, num_words);
+    assert(sample_set_size > 0);
+    min_sample_set_size = sample_set_size / 2;
+
+    for (l = focal_site + direction; l >= 0 && l < (int64_t) num_sites; l += direction) {
+        ancestor[l] = 0;
+        last_site = (tsk_id_t) l;
+        if (sites[l].time > focal_site_time) {
+            ones = ancestor_builder_count_ones_bitset(
+                self, (tsk_id_t) l, sample_bitset, num_words);
+            consensus = (allele_t)(ones >= sample_set_size - ones);
+            encoded = sites[l].encoded_genotypes;
+            removed = 0;
+            for (j = 0; j < num_words; j++) {
+                genotypes = ancestor_builder_get_genotype_word(self, encoded, j);
+                /* The samples that disagree with the consensus at this site */
+                mismatch = (consensus ? ~genotypes : genotypes) & sample_bitset[j];
+                /* Remove the samples that have disagreed twice in a row */
+                remove = disagree[j] & mismatch;
+                sample_bitset[j] &= ~remove;
+                disagree[j] = mismatch & ~remove;
+                removed += popcount64(remove);
+            }
+            ancestor[l] = consensus;
+            sample_set_size -= removed;
+            if (sample_set_size <= min_sample_set_size) {
+                break;
+            }
+        }
+    }
+    memset(disagree, 0, num_words * sizeof(*disagree));
+    *last_site_ret = last_site;
+    return ret;
+}
+
+/* Equivalent to ancestor_builder_compute_between_focal_sites for one-bit
+ * encoded genotypes. */
+static int
+ancestor_builder_compute_between_focal_sites_bitset(const ancestor_builder_t *self,
+    size_t num_focal_sites, const tsk_id_t *focal_sites, allele_t *ancestor,
+    ancestor_builder_workspace_t *workspace)
+{
+    int ret = 0;
+    tsk_id_t l;
+    size_t j, ones, sample_set_size;
+    double focal_site_time;
+    const site_t *restrict sites = self->sites;
+
+    assert(num_focal_sites > 0);
+    sample_set_size = ancestor_builder_get_consistent_sample_bitset(
+        self, focal_sites[0], workspace->sample_bitset, workspace->num_words);
+    if (sample_set_size == 0) {
+        ret = TSI_ERR_BAD_FOCAL_SITE;
+        goto out;
+    }
+    focal_site_time = self->sites[focal_sites[0]].time;
+
+    ancestor[focal_sites[0]] = 1;
+    for (j = 1; j < num_focal_sites; j++) {
+        ancestor[focal_sites[j]] = 1;
+        for (l = focal_sites[j - 1] + 1; l < focal_sites[j]; l++) {
+            ancestor[l] = 0;
+            if (sites[l].time > focal_site_time) {
+                ones = ancestor_builder_count_ones_bitset(
+                    self, l, workspace->sample_bitset, workspace->num_words);
+                if (ones >= sample_set_size - ones) {
+                    ancestor[l] = 1;
+                }
+            }
+        }
+    }
+out:
+    return ret;
+}
+
 static int
 ancestor_builder_compute_ancestral_states(const ancestor_builder_t *self, int direction,
     tsk_id_t focal_site, allele_t *ancestor, tsk_id_t *restrict sample_set,
@@ -430,7 +595,6 @@ ancestor_builder_compute_ancestral_states(const ancestor_builder_t *self, int di
     /* This can't happen because we've already tested for it in
      * ancestor_builder_compute_between_focal_sites */
     assert(sample_set_size > 0);
-    memset(disagree, 0, self->num_samples * sizeof(*disagree));
     min_sample_set_size = sample_set_size / 2;
 
     /* printf("site=%d, direction=%d min_sample_size=%d\n", (int) focal_site, direction,
@@ -479,6 +643,7 @@ ancestor_builder_compute_ancestral_states(const ancestor_builder_t *self, int di
                         /* This sample has disagreed with consensus twice in a row,
                          * so remove it */
                         /* printf("\t\tremoving %d\n", sample_set[j]); */
+                        disagree[u] = false;
                         sample_set[j] = -1;
                     }
                 }
@@ -508,6 +673,11 @@ ancestor_builder_compute_ancestral_states(const ancestor_builder_t *self, int di
             }
         }
     }
+    /* Only the remaining samples can have disagree flags set, so we reset
+     * these rather than the whole array for the next call. */
+    for (j = 0; j < sample_set_size; j++) {
+        disagree[sample_set[j]] = false;
+    }
     *last_site_ret = last_site;
     return ret;
 }
@@ -569,49 +739,131 @@ out:
     return ret;
 }
 
-/* Build the ancestors for sites in the specified focal sites */
+int
+ancestor_builder_workspace_alloc(
+    ancestor_builder_workspace_t *self, const ancestor_builder_t *builder)
+{
+    int ret = 0;
+
+    memset(self, 0, sizeof(*self));
+    self->num_samples = builder->num_samples;
+    if (builder->flags & TSI_GENOTYPE_ENCODING_ONE_BIT) {
+        self->num_words = (builder->encoded_genotypes_size + sizeof(uint64_t) - 1)
+                          / sizeof(uint64_t);
+        self->sample_bitset = malloc(self->num_words * sizeof(*self->sample_bitset));
+        self->disagree_bitset = calloc(self->num_words, sizeof(*self->disagree_bitset));
+        if (self->sample_bitset == NULL || self->disagree_bitset == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+    } else {
+        self->sample_set = malloc(builder->num_samples * sizeof(*self->sample_set));
+        self->disagree = calloc(builder->num_samples, sizeof(*self->disagree));
+        self->genotypes = malloc(builder->decoded_genotypes_size);
+        if (self->sample_set == NULL || self->disagree == NULL
+            || self->genotypes == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+    }
+out:
+    return ret;
+}
+
+int
+ancestor_builder_workspace_free(ancestor_builder_workspace_t *self)
+{
+    tsi_safe_free(self->sample_set);
+    tsi_safe_free(self->disagree);
+    tsi_safe_free(self->genotypes);
+    tsi_safe_free(self->sample_bitset);
+    tsi_safe_free(self->disagree_bitset);
+    return 0;
+}
+
+static int
+ancestor_builder_make_ancestor_bitset(const ancestor_builder_t *self,
+    size_t num_focal_sites, const tsk_id_t *focal_sites, tsk_id_t *ret_start,
+    tsk_id_t *ret_end, allele_t *ancestor, ancestor_builder_workspace_t *workspace)
+{
+    int ret = 0;
+    tsk_id_t last_site;
+
+    ret = ancestor_builder_compute_between_focal_sites_bitset(
+        self, num_focal_sites, focal_sites, ancestor, workspace);
+    if (ret != 0) {
+        goto out;
+    }
+    ret = ancestor_builder_compute_ancestral_states_bitset(
+        self, +1, focal_sites[num_focal_sites - 1], ancestor, workspace, &last_site);
+    if (ret != 0) {
+        goto out;
+    }
+    *ret_end = last_site + 1;
+    ret = ancestor_builder_compute_ancestral_states_bitset(
+        self, -1, focal_sites[0], ancestor, workspace, &last_site);
+    if (ret != 0) {
+        goto out;
+    }
+    *ret_start = last_site;
+out:
+    return ret;
+}
+
+/* Build the ancestors for sites in the specified focal sites, using the
+ * specified workspace for scratch memory. If workspace is NULL, a temporary
+ * workspace is allocated for the call. */
 int
 ancestor_builder_make_ancestor(const ancestor_builder_t *self, size_t num_focal_sites,
     const tsk_id_t *focal_sites, tsk_id_t *ret_start, tsk_id_t *ret_end,
-    allele_t *ancestor)
+    allele_t *ancestor, ancestor_builder_workspace_t *workspace)
 {
     int ret = 0;
     tsk_id_t focal_site, last_site;
-    tsk_id_t *sample_set = malloc(self->num_samples * sizeof(tsk_id_t));
-    bool *restrict disagree = calloc(self->num_samples, sizeof(*disagree));
-    allele_t *restrict genotypes = malloc(self->decoded_genotypes_size);
+    ancestor_builder_workspace_t local_workspace;
+    ancestor_builder_workspace_t *ws = workspace;
 
-    if (sample_set == NULL || disagree == NULL || genotypes == NULL) {
-        ret = TSI_ERR_NO_MEMORY;
-        goto out;
+    if (ws == NULL) {
+        ws = &local_workspace;
+        ret = ancestor_builder_workspace_alloc(ws, self);
+        if (ret != 0) {
+            goto out;
+        }
     }
+    assert(ws->num_samples == self->num_samples);
     memset(ancestor, 0xff, self->num_sites * sizeof(*ancestor));
 
+    if (self->flags & TSI_GENOTYPE_ENCODING_ONE_BIT) {
+        ret = ancestor_builder_make_ancestor_bitset(
+            self, num_focal_sites, focal_sites, ret_start, ret_end, ancestor, ws);
+        goto out;
+    }
+
     ret = ancestor_builder_compute_between_focal_sites(
-        self, num_focal_sites, focal_sites, ancestor, sample_set, genotypes);
+        self, num_focal_sites, focal_sites, ancestor, ws->sample_set, ws->genotypes);
     if (ret != 0) {
         goto out;
     }
 
     focal_site = focal_sites[num_focal_sites - 1];
-    ret = ancestor_builder_compute_ancestral_states(
-        self, +1, focal_site, ancestor, sample_set, disagree, &last_site, genotypes);
+    ret = ancestor_builder_compute_ancestral_states(self, +1, focal_site, ancestor,
+        ws->sample_set, ws->disagree, &last_site, ws->genotypes);
     if (ret != 0) {
         goto out;
     }
     *ret_end = last_site + 1;
 
     focal_site = focal_sites[0];
-    ret = ancestor_builder_compute_ancestral_states(
-        self, -1, focal_site, ancestor, sample_set, disagree, &last_site, genotypes);
+    ret = ancestor_builder_compute_ancestral_states(self, -1, focal_site, ancestor,
+        ws->sample_set, ws->disagree, &last_site, ws->genotypes);
     if (ret != 0) {
         goto out;
     }
     *ret_start = last_site;
 out:
-    tsi_safe_free(sample_set);
-    tsi_safe_free(disagree);
-    tsi_safe_free(genotypes);
+    if (workspace == NULL) {
+        ancestor_builder_workspace_free(&local_workspace);
+    }
     return ret;
 }
 
@@ -715,6 +967,26 @@ out:
     return ret;
 }
 
+/* Adds num_sites consecutive sites to the builder. The genotypes for site j
+ * are stored in row j of the (num_sites x num_samples) genotypes matrix. */
+int WARN_UNUSED
+ancestor_builder_add_sites(
+    ancestor_builder_t *self, size_t num_sites, double *time, allele_t *genotypes)
+{
+    int ret = 0;
+    size_t j;
+
+    for (j = 0; j < num_sites; j++) {
+        ret = ancestor_builder_add_site(
+            self, time[j], genotypes + j * self->num_samples);
+        if (ret != 0) {
+            goto out;
+        }
+    }
+out:
+    return ret;
+}
+
 /* Returns true if we should break the an ancestor that spans from focal
  * site a to focal site b */
 static bool
@@ -26,6 +26,54 @@
 #include <stdbool.h>
 #include <math.h>
 
+/* Traceback changes are stored as the old and new recombination_required
+ * states of a node, each of which is -1, 0 or 1, packed into one byte. */
+#define TRACEBACK_PACK_STATE(old, new) ((int8_t)(((old) + 1) | (((new) + 1) << 2)))
+#define TRACEBACK_OLD_STATE(packed) (((packed) &3) - 1)
+#define TRACEBACK_NEW_STATE(packed) (((packed) >> 2) - 1)
+/* Offset added to the traceback state to mark nodes seen at the current site */
+#define TRACEBACK_SEEN 4
+
+/* Doubles with magnitude at least 2^52 are all integers. */
+#define ROUND_EXACT_LIMIT 4503599627370496.0
+
+/* Rounds x to the number of decimal digits corresponding to scale, which is
+ * 10^ndigits as computed by pow in tsk_round, or zero if no rounding is to be
+ * done. The result is bit-identical to tsk_round(x, ndigits), but avoids the
+ * calls to pow and round. */
+static inline double
+round_scaled(double x, double scale)
+{
+    double y, t, frac;
+    int64_t i;
+
+    if (scale == 0) {
+        return x;
+    }
+    y = x * scale;
+    if (fabs(y) < ROUND_EXACT_LIMIT) {
+        /* Both the truncation and the fractional part are exact here. Ties
+         * are rounded to even, as in tsk_round. */
+        i = (int64_t) y;
+        t = (double) i;
+        frac = y - t;
+        if (frac > 0.5 || (frac == 0.5 && (i & 1))) {
+            t += 1;
+        } else if (frac < -0.5 || (frac == -0.5 && (i & 1))) {
+            t -= 1;
+        }
+        /* Keep the sign of zero, which round() also preserves. */
+        y = copysign(t, y);
+    }
+    return y / scale;
+}
+
+double
+tsi_round(double x, unsigned int ndigits)
+{
+    return round_scaled(x, ndigits < 22 ? pow(10.0, (double) ndigits) : 0);
+}
+
 static inline bool
 is_nonzero_root(const tsk_id_t u, const tsk_id_t *restrict parent,
     const tsk_id_t *restrict left_child)
@@ -62,7 +110,8 @@ ancestor_matcher_check_state(ancestor_matcher_t *self)
 int
 ancestor_matcher_print_state(ancestor_matcher_t *self, FILE *out)
 {
-    int j, k;
+    int j;
+    size_t k;
     tsk_id_t u;
 
     fprintf(out, "Ancestor matcher state\n");
@@ -84,17 +133,18 @@ ancestor_matcher_print_state(ancestor_matcher_t *self, FILE *out)
         u = self->likelihood_nodes[j];
         fprintf(out, "\t%d -> %f\n", u, self->likelihood[u]);
     }
-    fprintf(out, "traceback\n");
-    for (j = 0; j < (int) self->num_sites; j++) {
-        fprintf(out, "\t%d:%d (%d)\t", (int) j, self->max_likelihood_node[j],
-            self->traceback[j].size);
-        for (k = 0; k < self->traceback[j].size; k++) {
-            fprintf(out, "(%d, %d)", self->traceback[j].node[k],
-                self->traceback[j].recombination_required[k]);
+    fprintf(out, "traceback: start=%d end=%d size=%d max_size=%d\n",
+        (int) self->traceback.start, (int) self->traceback.end,
+        (int) self->traceback.size, (int) self->traceback.max_size);
+    for (j = self->traceback.start; j < self->traceback.end; j++) {
+        fprintf(out, "\t%d:%d\t", (int) j, self->max_likelihood_node[j]);
+        for (k = self->traceback.offset[j]; k < self->traceback.offset[j + 1]; k++) {
+            fprintf(out, "(%d, %d->%d)", self->traceback.node[k],
+                TRACEBACK_OLD_STATE(self->traceback.state[k]),
+                TRACEBACK_NEW_STATE(self->traceback.state[k]));
         }
         fprintf(out, "\n");
     }
-    tsk_blkalloc_print_state(&self->traceback_allocator, out);
 
     /* ancestor_matcher_check_state(self); */
     return 0;
@@ -111,6 +161,7 @@ ancestor_matcher_alloc(ancestor_matcher_t *self,
     /* All allocs for arrays related to nodes are done in expand_nodes */
     self->flags = flags;
     self->precision = precision;
+    self->precision_scale = precision < 22 ? pow(10.0, (double) precision) : 0;
     self->max_nodes = 0;
     self->tree_sequence_builder = tree_sequence_builder;
     self->num_sites = tree_sequence_builder->num_sites;
@@ -118,27 +169,21 @@ ancestor_matcher_alloc(ancestor_matcher_t *self,
         = malloc(self->num_sites * sizeof(*self->recombination_rate));
     self->mismatch_rate = malloc(self->num_sites * sizeof(*self->mismatch_rate));
     self->output.max_size = self->num_sites; /* We can probably make this smaller */
-    self->traceback = calloc(self->num_sites, sizeof(node_state_list_t));
+    self->traceback.offset = malloc((self->num_sites + 1) * sizeof(size_t));
     self->max_likelihood_node = malloc(self->num_sites * sizeof(tsk_id_t));
     self->output.left = malloc(self->output.max_size * sizeof(tsk_id_t));
     self->output.right = malloc(self->output.max_size * sizeof(tsk_id_t));
     self->output.parent = malloc(self->output.max_size * sizeof(tsk_id_t));
     if (self->recombination_rate == NULL || self->mismatch_rate == NULL
-        || self->traceback == NULL || self->max_likelihood_node == NULL
+        || self->traceback.offset == NULL || self->max_likelihood_node == NULL
         || self->output.left == NULL || self->output.right == NULL
         || self->output.parent == NULL) {
         ret = TSI_ERR_NO_MEMORY;
         goto out;
     }
-    /* Alloc in 64MiB blocks. */
-    self->traceback_block_size = 64 * 1024 * 1024;
-    /* If the traceback allocator is using more than 2GiB of RAM free it, so
+    /* If the traceback is using more than 2GiB of RAM free it, so
      * that other threads can use the memory */
     self->traceback_realloc_size = 2L * 1024L * 1024L * 1024L;
-    ret = tsk_blkalloc_init(&self->traceback_allocator, self->traceback_block_size);
-    if (ret != 0) {
-        goto out;
-    }
     memcpy(self->recombination_rate, recombination_rate,
         self->num_sites * sizeof(*self->recombination_rate));
     memcpy(self->mismatch_rate, mismatch_rate,
@@ -163,12 +208,16 @@ ancestor_matcher_free(ancestor_matcher_t *self)
     tsi_safe_free(self->likelihood_nodes);
     tsi_safe_free(self->likelihood_nodes_tmp);
     tsi_safe_free(self->allelic_state);
+    tsi_safe_free(self->allelic_state_path);
     tsi_safe_free(self->max_likelihood_node);
-    tsi_safe_free(self->traceback);
+    tsi_safe_free(self->traceback_state);
+    tsi_safe_free(self->traceback_nodes);
+    tsi_safe_free(self->traceback.node);
+    tsi_safe_free(self->traceback.state);
+    tsi_safe_free(self->traceback.offset);
     tsi_safe_free(self->output.left);
     tsi_safe_free(self->output.right);
     tsi_safe_free(self->output.parent);
-    tsk_blkalloc_free(&self->traceback_allocator);
     return 0;
 }
 
@@ -193,81 +242,122 @@ ancestor_matcher_delete_likelihood(
     return 0;
 }
 
-/* Store the recombination_required state in the traceback */
+static int WARN_UNUSED
+ancestor_matcher_expand_traceback(ancestor_matcher_t *self, size_t min_size)
+{
+    int ret = 0;
+    const size_t entry_size
+        = sizeof(*self->traceback.node) + sizeof(*self->traceback.state);
+    const size_t limit = self->traceback_memory_limit;
+    size_t max_size = TSK_MAX(min_size, TSK_MAX(2 * self->traceback.max_size, 1024));
+    void *tmp;
+
+    if (limit > 0 && max_size * entry_size > limit) {
+        max_size = limit / entry_size;
+        if (max_size < min_size) {
+            ret = TSI_ERR_TRACEBACK_MEMORY_LIMIT;
+            goto out;
+        }
+    }
+    tmp = realloc(self->traceback.node, max_size * sizeof(*self->traceback.node));
+    if (tmp == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    self->traceback.node = tmp;
+    tmp = realloc(self->traceback.state, max_size * sizeof(*self->traceback.state));
+    if (tmp == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    self->traceback.state = tmp;
+    self->traceback.max_size = max_size;
+out:
+    return ret;
+}
+
+static inline void
+ancestor_matcher_add_traceback_change(
+    ancestor_matcher_t *self, tsk_id_t u, int8_t old_state, int8_t new_state)
+{
+    const size_t k = self->traceback.size;
+
+    assert(k < self->traceback.max_size);
+    self->traceback.node[k] = u;
+    self->traceback.state[k] = TRACEBACK_PACK_STATE(old_state, new_state);
+    self->traceback.size++;
+}
+
+/* Store the changes in recombination_required state since the previous site
+ * in the traceback. */
 static int WARN_UNUSED
 ancestor_matcher_store_traceback(ancestor_matcher_t *self, const tsk_id_t site_id)
 {
     int ret = 0;
     tsk_id_t u;
     int j;
-    int8_t *restrict list_R;
-    tsk_id_t *restrict list_node;
-    node_state_list_t *restrict list;
-    node_state_list_t *restrict T = self->traceback;
+    int8_t *restrict state = self->traceback_state;
+    tsk_id_t *restrict prev_nodes = self->traceback_nodes;
     const tsk_id_t *restrict nodes = self->likelihood_nodes;
     const int8_t *restrict R = self->recombination_required;
     const int num_likelihood_nodes = self->num_likelihood_nodes;
-    bool match;
-
-    /* Check to see if the previous site has the same recombination_required. If so,
-     * we can reuse the same list. */
-    match = false;
-    if (site_id > 0) {
-        list = &T[site_id - 1];
-        if (list->size == num_likelihood_nodes) {
-            list_node = list->node;
-            list_R = list->recombination_required;
-            match = true;
-            for (j = 0; j < num_likelihood_nodes; j++) {
-                if (list_node[j] != nodes[j] || list_R[j] != R[nodes[j]]) {
-                    match = false;
-                    break;
-                }
-            }
-        }
-    }
+    const int num_prev_nodes = self->num_traceback_nodes;
+    const size_t max_changes = (size_t)(num_likelihood_nodes + num_prev_nodes);
 
-    if (match) {
-        T[site_id].size = T[site_id - 1].size;
-        T[site_id].node = T[site_id - 1].node;
-        T[site_id].recombination_required = T[site_id - 1].recombination_required;
-    } else {
-        list_node = tsk_blkalloc_get(&self->traceback_allocator,
-            (size_t) num_likelihood_nodes * sizeof(tsk_id_t));
-        list_R = tsk_blkalloc_get(
-            &self->traceback_allocator, (size_t) num_likelihood_nodes * sizeof(int8_t));
-        if (list_node == NULL || list_R == NULL) {
-            ret = TSI_ERR_NO_MEMORY;
+    if (self->traceback.size + max_changes > self->traceback.max_size) {
+        ret = ancestor_matcher_expand_traceback(
+            self, self->traceback.size + max_changes);
+        if (ret != 0) {
             goto out;
         }
-        T[site_id].node = list_node;
-        T[site_id].recombination_required = list_R;
-        T[site_id].size = num_likelihood_nodes;
-        for (j = 0; j < num_likelihood_nodes; j++) {
-            u = nodes[j];
-            list_node[j] = u;
-            list_R[j] = R[u];
+    }
+    /* Record nodes whose state differs from the previous site, and mark the
+     * nodes we've seen by offsetting their state. */
+    for (j = 0; j < num_likelihood_nodes; j++) {
+        u = nodes[j];
+        if (state[u] != R[u]) {
+            ancestor_matcher_add_traceback_change(self, u, state[u], R[u]);
+        }
+        state[u] = (int8_t)(R[u] + TRACEBACK_SEEN);
+    }
+    /* Nodes from the previous site that we haven't seen have left the list */
+    for (j = 0; j < num_prev_nodes; j++) {
+        u = prev_nodes[j];
+        if (state[u] < TRACEBACK_SEEN - 1) {
+            ancestor_matcher_add_traceback_change(self, u, state[u], -1);
+            state[u] = -1;
         }
     }
+    for (j = 0; j < num_likelihood_nodes; j++) {
+        state[nodes[j]] = (int8_t)(state[nodes[j]] - TRACEBACK_SEEN);
+    }
+    memcpy(prev_nodes, nodes, (size_t) num_likelihood_nodes * sizeof(*nodes));
+    self->num_traceback_nodes = num_likelihood_nodes;
+    self->traceback.offset[site_id + 1] = self->traceback.size;
     self->total_traceback_size += (size_t) num_likelihood_nodes;
 out:
     return ret;
 }
 
 /* Sets the specified allelic state array to reflect the mutations at the
- * specified site. */
+ * specified site. The mutations are read from the frozen indexes, as the
+ * builder's mutation lists may be modified while we are matching. */
 static inline void
 ancestor_matcher_set_allelic_state(
     ancestor_matcher_t *self, const tsk_id_t site, allele_t *restrict allelic_state)
 {
-    mutation_list_node_t *mutation;
+    const frozen_indexes_t *indexes = self->match_indexes;
+    const tsk_id_t *restrict node = indexes->mutations.node;
+    const allele_t *restrict derived_state = indexes->mutations.derived_state;
+    size_t j;
 
     /* FIXME assuming that 0 is always the ancestral state */
     allelic_state[0] = 0;
 
-    for (mutation = self->tree_sequence_builder->sites.mutations[site]; mutation != NULL;
-         mutation = mutation->next) {
-        allelic_state[mutation->node] = mutation->derived_state;
+    for (j = indexes->mutations.offset[site]; j < indexes->mutations.offset[site + 1];
+         j++) {
+        assert(node[j] < (tsk_id_t) self->num_nodes);
+        allelic_state[node[j]] = derived_state[j];
     }
 }
 
@@ -276,12 +366,14 @@ static inline void
 ancestor_matcher_unset_allelic_state(
     ancestor_matcher_t *self, const tsk_id_t site, allele_t *restrict allelic_state)
 {
-    mutation_list_node_t *mutation;
+    const frozen_indexes_t *indexes = self->match_indexes;
+    const tsk_id_t *restrict node = indexes->mutations.node;
+    size_t j;
 
     allelic_state[0] = NULL_NODE;
-    for (mutation = self->tree_sequence_builder->sites.mutations[site]; mutation != NULL;
-         mutation = mutation->next) {
-        allelic_state[mutation->node] = TSK_NULL;
+    for (j = indexes->mutations.offset[site]; j < indexes->mutations.offset[site + 1];
+         j++) {
+        allelic_state[node[j]] = TSK_NULL;
     }
 }
 
@@ -294,15 +386,20 @@ ancestor_matcher_update_site_likelihood_values(ancestor_matcher_t *self,
     const int num_likelihood_nodes = self->num_likelihood_nodes;
     const tsk_id_t *restrict L_nodes = self->likelihood_nodes;
     allele_t *restrict allelic_state = self->allelic_state;
+    tsk_id_t *restrict path = self->allelic_state_path;
     int8_t *restrict recombination_required = self->recombination_required;
     int j;
+    size_t path_length = 0;
+    size_t k;
     tsk_id_t u, v, max_L_node;
+    allele_t u_state;
     double max_L, p_last, p_no_recomb, p_recomb, p_t, p_e;
     const double rho = self->recombination_rate[site];
     const double mu = self->mismatch_rate[site];
-    const double n = (double) self->tree_sequence_builder->num_match_nodes;
+    const double n = self->match_num_match_nodes;
     const double num_alleles
         = (double) self->tree_sequence_builder->sites.num_alleles[site];
+    const double precision_scale = self->precision_scale;
 
     if (state >= num_alleles) {
         ret = TSI_ERR_BAD_HAPLOTYPE_ALLELE;
@@ -318,14 +415,20 @@ ancestor_matcher_update_site_likelihood_values(ancestor_matcher_t *self,
      * self->num_likelihood_nodes); */
     for (j = 0; j < num_likelihood_nodes; j++) {
         u = L_nodes[j];
-        /* Get the allelic state at u. */
-        /* TODO we can cache the states here to save some time. One nice way we could
-         * do the caching is to save the L_node index in the allelic_state array as
-         * we traverse upwards, and then keep an array of the L_node states which
-         * we then look up. This would save a second upward traversal to mark the
-         * array after we've found the state value. */
+        /* Get the allelic state at u. The state is then written into every node
+         * on the path we traversed, so that later lookups stop as soon as they
+         * reach a node we have already seen. The nodes we write to are recorded
+         * in path so that they can be reset at the end of the site. */
+        v = u;
+        while (allelic_state[v] == TSK_NULL) {
+            v = parent[v];
+        }
+        u_state = allelic_state[v];
         v = u;
         while (allelic_state[v] == TSK_NULL) {
+            allelic_state[v] = u_state;
+            path[path_length] = v;
+            path_length++;
             v = parent[v];
         }
         p_last = L[u];
@@ -339,7 +442,7 @@ ancestor_matcher_update_site_likelihood_values(ancestor_matcher_t *self,
             recombination_required[u] = true;
         }
         p_e = mu;
-        if (allelic_state[v] == state || state == TSK_MISSING_DATA) {
+        if (u_state == state || state == TSK_MISSING_DATA) {
             p_e = 1 - (num_alleles - 1) * mu;
         }
         L[u] = p_t * p_e;
@@ -349,6 +452,11 @@ ancestor_matcher_update_site_likelihood_values(ancestor_matcher_t *self,
             max_L_node = u;
         }
     }
+    /* Reset the states we filled in on the way up. These nodes were not
+     * mutation nodes, so the unset below doesn't touch them. */
+    for (k = 0; k < path_length; k++) {
+        allelic_state[path[k]] = TSK_NULL;
+    }
     /* ancestor_matcher_print_state(self, stdout); */
     if (max_L <= 0) {
         if (mu <= 0 || mu >= 1) {
@@ -368,7 +476,7 @@ ancestor_matcher_update_site_likelihood_values(ancestor_matcher_t *self,
     /* Renormalise the likelihoods. */
     for (j = 0; j < num_likelihood_nodes; j++) {
         u = L_nodes[j];
-        L[u] = tsk_round(L[u] / max_L, self->precision);
+        L[u] = round_scaled(L[u] / max_L, precision_scale);
     }
     ancestor_matcher_unset_allelic_state(self, site, allelic_state);
 out:
@@ -445,25 +553,28 @@ ancestor_matcher_update_site_state(ancestor_matcher_t *self, const tsk_id_t site
     double *restrict L_cache)
 {
     int ret = 0;
-    mutation_list_node_t *mutation = self->tree_sequence_builder->sites.mutations[site];
-    tsk_id_t u;
+    const frozen_indexes_t *indexes = self->match_indexes;
+    const tsk_id_t *restrict node = indexes->mutations.node;
+    tsk_id_t u, v;
+    size_t j;
 
     assert(self->num_likelihood_nodes > 0);
 
     if (self->flags & TSI_EXTENDED_CHECKS) {
         ancestor_matcher_check_state(self);
     }
-    for (mutation = self->tree_sequence_builder->sites.mutations[site]; mutation != NULL;
-         mutation = mutation->next) {
+    for (j = indexes->mutations.offset[site]; j < indexes->mutations.offset[site + 1];
+         j++) {
+        v = node[j];
         /* Insert a new L-value for the mutation node if needed */
-        if (L[mutation->node] == NULL_LIKELIHOOD) {
-            u = mutation->node;
+        if (L[v] == NULL_LIKELIHOOD) {
+            u = v;
             while (L[u] == NULL_LIKELIHOOD) {
                 u = parent[u];
                 assert(u != NULL_NODE);
             }
-            L[mutation->node] = L[u];
-            self->likelihood_nodes[self->num_likelihood_nodes] = mutation->node;
+            L[v] = L[u];
+            self->likelihood_nodes[self->num_likelihood_nodes] = v;
             self->num_likelihood_nodes++;
         }
     }
@@ -511,6 +622,9 @@ ancestor_matcher_expand_nodes(ancestor_matcher_t *self)
     tsi_safe_free(self->likelihood_nodes);
     tsi_safe_free(self->likelihood_nodes_tmp);
     tsi_safe_free(self->allelic_state);
+    tsi_safe_free(self->allelic_state_path);
+    tsi_safe_free(self->traceback_state);
+    tsi_safe_free(self->traceback_nodes);
 
     assert(self->max_nodes > 0);
     self->parent = malloc(self->max_nodes * sizeof(*self->parent));
@@ -526,12 +640,18 @@ ancestor_matcher_expand_nodes(ancestor_matcher_t *self)
     self->likelihood_nodes_tmp
         = malloc(self->max_nodes * sizeof(*self->likelihood_nodes_tmp));
     self->allelic_state = malloc(self->max_nodes * sizeof(*self->allelic_state));
+    self->allelic_state_path
+        = malloc(self->max_nodes * sizeof(*self->allelic_state_path));
+    self->traceback_state = malloc(self->max_nodes * sizeof(*self->traceback_state));
+    self->traceback_nodes = malloc(self->max_nodes * sizeof(*self->traceback_nodes));
 
     if (self->parent == NULL || self->left_child == NULL || self->right_child == NULL
         || self->left_sib == NULL || self->right_sib == NULL
         || self->recombination_required == NULL || self->likelihood == NULL
         || self->likelihood_cache == NULL || self->likelihood_nodes == NULL
-        || self->likelihood_nodes_tmp == NULL || self->allelic_state == NULL) {
+        || self->likelihood_nodes_tmp == NULL || self->allelic_state == NULL
+        || self->allelic_state_path == NULL || self->traceback_state == NULL
+        || self->traceback_nodes == NULL) {
         goto out;
     }
     ret = 0;
@@ -543,32 +663,46 @@ static int
 ancestor_matcher_reset(ancestor_matcher_t *self)
 {
     int ret = 0;
+    const frozen_indexes_t *indexes = self->indexes;
+
+    if (indexes == NULL) {
+        indexes = self->tree_sequence_builder->frozen;
+    }
+    self->match_indexes = indexes;
+    self->match_num_match_nodes = (double) indexes->num_match_nodes;
+    if (self->num_match_nodes > 0) {
+        self->match_num_match_nodes = (double) self->num_match_nodes;
+    }
 
     /* TODO realloc when this grows */
-    if (self->max_nodes != self->tree_sequence_builder->max_nodes) {
-        self->max_nodes = self->tree_sequence_builder->max_nodes;
+    if (self->max_nodes != indexes->max_nodes) {
+        self->max_nodes = indexes->max_nodes;
         ret = ancestor_matcher_expand_nodes(self);
         if (ret != 0) {
             goto out;
         }
     }
-    self->num_nodes = self->tree_sequence_builder->num_nodes;
+    self->num_nodes = indexes->num_nodes;
     assert(self->num_nodes <= self->max_nodes);
 
     memset(self->allelic_state, 0xff, self->num_nodes * sizeof(*self->allelic_state));
 
-    if (self->traceback_allocator.total_size > self->traceback_realloc_size) {
-        tsk_blkalloc_free(&self->traceback_allocator);
-        ret = tsk_blkalloc_init(&self->traceback_allocator, self->traceback_block_size);
-        if (ret != 0) {
-            goto out;
-        }
-    } else {
-        ret = tsk_blkalloc_reset(&self->traceback_allocator);
-        if (ret != 0) {
-            goto out;
-        }
+    memset(
+        self->traceback_state, 0xff, self->num_nodes * sizeof(*self->traceback_state));
+    self->num_traceback_nodes = 0;
+
+    if (self->traceback.max_size
+            * (sizeof(*self->traceback.node) + sizeof(*self->traceback.state))
+        > self->traceback_realloc_size) {
+        tsi_safe_free(self->traceback.node);
+        tsi_safe_free(self->traceback.state);
+        self->traceback.node = NULL;
+        self->traceback.state = NULL;
+        self->traceback.max_size = 0;
     }
+    self->traceback.size = 0;
+    self->traceback.start = 0;
+    self->traceback.end = 0;
     self->total_traceback_size = 0;
     self->num_likelihood_nodes = 0;
     ancestor_matcher_reset_tree(self);
@@ -576,42 +710,22 @@ out:
     return ret;
 }
 
-/* Resets the recombination_required array from the traceback at the specified site.
+/* Reverts the changes to the traceback state made at the specified site, so that
+ * the state reflects the previous site.
  */
 static inline void
-ancestor_matcher_set_recombination_required(
-    ancestor_matcher_t *self, tsk_id_t site, int8_t *restrict recombination_required)
+ancestor_matcher_unwind_traceback(ancestor_matcher_t *self, tsk_id_t site)
 {
-    int j;
-    const int8_t *restrict R = self->traceback[site].recombination_required;
-    const tsk_id_t *restrict node = self->traceback[site].node;
-    const int size = self->traceback[site].size;
+    size_t k;
+    int8_t *restrict state = self->traceback_state;
+    const tsk_id_t *restrict node = self->traceback.node;
+    const int8_t *restrict packed = self->traceback.state;
 
-    /* We always set recombination_required for node 0 to false for the cases
-     * where no recombination is needed at a particular site (which are
-     * encoded by a traceback of size 0) */
-    recombination_required[0] = 0;
-    for (j = 0; j < size; j++) {
-        recombination_required[node[j]] = R[j];
+    for (k = self->traceback.offset[site]; k < self->traceback.offset[site + 1]; k++) {
+        state[node[k]] = (int8_t) TRACEBACK_OLD_STATE(packed[k]);
     }
 }
 
-/* Unsets the likelihood array from the traceback at the specified site.
- */
-static inline void
-ancestor_matcher_unset_recombination_required(
-    ancestor_matcher_t *self, tsk_id_t site, int8_t *restrict recombination_required)
-{
-    int j;
-    const tsk_id_t *restrict node = self->traceback[site].node;
-    const int size = self->traceback[site].size;
-
-    for (j = 0; j < size; j++) {
-        recombination_required[node[j]] = -1;
-    }
-    recombination_required[0] = -1;
-}
-
 static int WARN_UNUSED
 ancestor_matcher_run_traceback(ancestor_matcher_t *self, tsk_id_t start, tsk_id_t end,
     allele_t *TSK_UNUSED(haplotype), allele_t *match)
@@ -623,11 +737,11 @@ ancestor_matcher_run_traceback(ancestor_matcher_t *self, tsk_id_t start, tsk_id_
     tsk_id_t left, right, pos;
     tsk_id_t *restrict parent = self->parent;
     allele_t *restrict allelic_state = self->allelic_state;
-    int8_t *restrict recombination_required = self->recombination_required;
-    const edge_t *restrict in = self->tree_sequence_builder->right_index_edges;
-    const edge_t *restrict out = self->tree_sequence_builder->left_index_edges;
-    int_fast32_t in_index = (int_fast32_t) self->tree_sequence_builder->num_edges - 1;
-    int_fast32_t out_index = (int_fast32_t) self->tree_sequence_builder->num_edges - 1;
+    const int8_t *restrict recombination_required = self->traceback_state;
+    const edge_t *restrict in = self->match_indexes->right_index_edges;
+    const edge_t *restrict out = self->match_indexes->left_index_edges;
+    int_fast32_t in_index = (int_fast32_t) self->match_indexes->num_edges - 1;
+    int_fast32_t out_index = (int_fast32_t) self->match_indexes->num_edges - 1;
 
     /* Prepare for the traceback and get the memory ready for recording
      * the output edges. */
@@ -640,10 +754,10 @@ ancestor_matcher_run_traceback(ancestor_matcher_t *self, tsk_id_t start, tsk_id_
     self->output.parent[self->output.size] = max_likelihood_node;
     assert(self->output.parent[self->output.size] != NULL_NODE);
 
-    /* Now go through the trees in reverse and run the traceback */
+    /* Now go through the trees in reverse and run the traceback. At this point
+     * the traceback state holds the recombination_required values for the
+     * last site. */
     memset(parent, 0xff, self->num_nodes * sizeof(*parent));
-    memset(
-        recombination_required, 0xff, self->num_nodes * sizeof(*recombination_required));
     pos = (tsk_id_t) self->num_sites;
 
     while (pos > start) {
@@ -679,16 +793,15 @@ ancestor_matcher_run_traceback(ancestor_matcher_t *self, tsk_id_t start, tsk_id_
             match[l] = allelic_state[v];
             ancestor_matcher_unset_allelic_state(self, l, allelic_state);
 
-            /* Mark the traceback nodes on the tree */
-            ancestor_matcher_set_recombination_required(self, l, recombination_required);
-
             /* Traverse up the tree from the current node. The first marked node that we
-             * meed tells us whether we need to recombine */
+             * meed tells us whether we need to recombine. Node 0 is treated as not
+             * requiring recombination unless it is marked (sites where no
+             * recombination is needed can have no marked nodes at all) */
             while (u != 0 && recombination_required[u] == -1) {
                 u = parent[u];
                 assert(u != NULL_NODE);
             }
-            if (recombination_required[u] && l > start) {
+            if (recombination_required[u] == 1 && l > start) {
                 max_likelihood_node = self->max_likelihood_node[l - 1];
                 assert(max_likelihood_node != NULL_NODE);
                 self->output.left[self->output.size] = l;
@@ -698,9 +811,8 @@ ancestor_matcher_run_traceback(ancestor_matcher_t *self, tsk_id_t start, tsk_id_
                 self->output.right[self->output.size] = l;
                 self->output.parent[self->output.size] = max_likelihood_node;
             }
-            /* Unset the values in the tree for the next site. */
-            ancestor_matcher_unset_recombination_required(
-                self, l, recombination_required);
+            /* Move the traceback state back to the previous site. */
+            ancestor_matcher_unwind_traceback(self, l);
         }
     }
 
@@ -778,10 +890,14 @@ ancestor_matcher_run_forwards_match(
     tsk_id_t *restrict left_sib = self->left_sib;
     tsk_id_t *restrict right_sib = self->right_sib;
     tsk_id_t pos, left, right;
-    const edge_t *restrict in = self->tree_sequence_builder->left_index_edges;
-    const edge_t *restrict out = self->tree_sequence_builder->right_index_edges;
-    const int_fast32_t M = (tsk_id_t) self->tree_sequence_builder->num_edges;
+    const frozen_indexes_t *indexes = self->match_indexes;
+    const edge_t *restrict in = indexes->left_index_edges;
+    const edge_t *restrict out = indexes->right_index_edges;
+    const int_fast32_t M = (tsk_id_t) indexes->num_edges;
     int_fast32_t in_index, out_index, l, remove_start;
+    const tsk_id_t checkpoint = frozen_indexes_find_checkpoint(indexes, start);
+    const tsk_id_t *restrict checkpoint_edges;
+    size_t j, num_checkpoint_edges;
 
     /* Load the tree for start */
     left = 0;
@@ -792,10 +908,30 @@ ancestor_matcher_run_forwards_match(
     if (in_index < M && start < in[in_index].left) {
         right = in[in_index].left;
     }
+    if (checkpoint >= 0) {
+        /* Seek directly to the closest checkpointed tree at or before start
+         * and then build the remaining trees sequentially from there. */
+        checkpoint_edges
+            = indexes->seek_index.edges + indexes->seek_index.offset[checkpoint];
+        num_checkpoint_edges = indexes->seek_index.offset[checkpoint + 1]
+                               - indexes->seek_index.offset[checkpoint];
+        for (j = 0; j < num_checkpoint_edges; j++) {
+            insert_edge(in[checkpoint_edges[j]], parent, left_child, right_child,
+                left_sib, right_sib);
+        }
+        left = indexes->seek_index.position[checkpoint];
+        in_index = indexes->seek_index.in_index[checkpoint];
+        out_index = indexes->seek_index.out_index[checkpoint];
+        right = (tsk_id_t) self->num_sites;
+        if (in_index < M) {
+            right = TSK_MIN(right, in[in_index].left);
+        }
+        if (out_index < M) {
+            right = TSK_MIN(right, out[out_index].right);
+        }
+        pos = right;
+    }
 
-    /* TODO there's probably quite a big gain to made here by seeking
-     * directly to the tree that we're interested in rather than just
-     * building the trees sequentially */
     while (in_index < M && out_index < M && in[in_index].left <= start) {
         while (out_index < M && out[out_index].right == pos) {
             remove_edge(
@@ -975,6 +1111,7 @@ ancestor_matcher_find_path(ancestor_matcher_t *self, tsk_id_t start, tsk_id_t en
     if (ret != 0) {
         goto out;
     }
+    self->traceback.offset[start] = 0;
     ret = ancestor_matcher_run_forwards_match(self, start, end, haplotype);
     if (ret != 0) {
         goto out;
@@ -983,9 +1120,10 @@ ancestor_matcher_find_path(ancestor_matcher_t *self, tsk_id_t start, tsk_id_t en
     if (ret != 0) {
         goto out;
     }
+    /* Keep the traceback so that it can be inspected until the next call */
+    self->traceback.start = start;
+    self->traceback.end = end;
     /* Reset some memory for the next call */
-    memset(
-        self->traceback + start, 0, ((size_t)(end - start)) * sizeof(*self->traceback));
     memset(self->max_likelihood_node + start, 0xff,
         ((size_t)(end - start)) * sizeof(*self->max_likelihood_node));
 
@@ -1006,8 +1144,51 @@ ancestor_matcher_get_mean_traceback_size(ancestor_matcher_t *self)
 size_t
 ancestor_matcher_get_total_memory(ancestor_matcher_t *self)
 {
-    size_t total = self->traceback_allocator.total_size;
-    /* TODO add contributions from other objects */
-
+    size_t total;
+    const size_t node_size
+        = 5 * sizeof(tsk_id_t) /* quintuply linked tree */
+          + sizeof(*self->recombination_required) + sizeof(*self->likelihood)
+          + sizeof(*self->likelihood_cache) + sizeof(*self->likelihood_nodes)
+          + sizeof(*self->likelihood_nodes_tmp) + sizeof(*self->allelic_state)
+          + sizeof(*self->allelic_state_path) + 3 * sizeof(double)
+          + sizeof(*self->traceback_state) + sizeof(*self->traceback_nodes);
+    const size_t site_size
+        = sizeof(*self->recombination_rate) + sizeof(*self->mismatch_rate)
+          + sizeof(*self->max_likelihood_node) + sizeof(*self->traceback.offset);
+
+    total = self->traceback.max_size
+            * (sizeof(*self->traceback.node) + sizeof(*self->traceback.state));
+    total += self->max_nodes * node_size;
+    total += self->num_sites * site_size;
+    total += self->output.max_size * 3 * sizeof(tsk_id_t);
     return total;
 }
+
+void
+ancestor_matcher_set_traceback_memory_limit(ancestor_matcher_t *self, size_t limit)
+{
+    self->traceback_memory_limit = limit;
+}
+
+/* Writes the recombination_required state of all nodes at the specified site
+ * for the most recent match into the specified array, which must have space
+ * for num_nodes values. Nodes not in the traceback at this site are -1. */
+int
+ancestor_matcher_get_traceback(
+    ancestor_matcher_t *self, tsk_id_t site, int8_t *recombination_required)
+{
+    tsk_id_t l;
+    size_t k;
+
+    memset(
+        recombination_required, 0xff, self->num_nodes * sizeof(*recombination_required));
+    if (site >= self->traceback.start && site < self->traceback.end) {
+        for (l = self->traceback.start; l <= site; l++) {
+            for (k = self->traceback.offset[l]; k < self->traceback.offset[l + 1]; k++) {
+                recombination_required[self->traceback.node[k]]
+                    = (int8_t) TRACEBACK_NEW_STATE(self->traceback.state[k]);
+            }
+        }
+    }
+    return 0;
+}
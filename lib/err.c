@@ -109,6 +109,22 @@ tsi_strerror(int err)
         case TSI_ERR_IO:
             ret = tsk_strerror(TSK_ERR_IO);
             break;
+        case TSI_ERR_TRACEBACK_MEMORY_LIMIT:
+            ret = "The traceback for this match needs more memory than the "
+                  "matcher's traceback memory limit allows.";
+            break;
+        case TSI_ERR_BAD_SNAPSHOT:
+            ret = "Bad snapshot: not a tree sequence builder snapshot, or written "
+                  "by an incompatible version.";
+            break;
+        case TSI_ERR_SNAPSHOT_SITES_MISMATCH:
+            ret = "The snapshot's sites are not the same as the tree sequence "
+                  "builder's.";
+            break;
+        case TSI_ERR_SNAPSHOT_NONEMPTY_BUILDER:
+            ret = "A snapshot can only be restored into an empty tree sequence "
+                  "builder.";
+            break;
     }
     return ret;
 }
@@ -27,6 +27,10 @@
 #define TSI_ERR_MATCH_IMPOSSIBLE_ZERO_RECOMB_PRECISION              -23
 #define TSI_ERR_ONE_BIT_NON_BINARY                                  -24
 #define TSI_ERR_IO                                                  -25
+#define TSI_ERR_TRACEBACK_MEMORY_LIMIT                              -26
+#define TSI_ERR_BAD_SNAPSHOT                                        -27
+#define TSI_ERR_SNAPSHOT_SITES_MISMATCH                             -28
+#define TSI_ERR_SNAPSHOT_NONEMPTY_BUILDER                           -29
 // clang-format on
 
 #ifdef __GNUC__
@@ -0,0 +1,287 @@
+/*
+** Copyright (C) 2020-2023 University of Oxford
+**
+** This file is part of tsinfer.
+**
+** tsinfer is free software: you can redistribute it and/or modify
+** it under the terms of the GNU General Public License as published by
+** the Free Software Foundation, either version 3 of the License, or
+** (at your option) any later version.
+**
+** tsinfer is distributed in the hope that it will be useful,
+** but WITHOUT ANY WARRANTY; without even the implied warranty of
+** MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+** GNU General Public License for more details.
+**
+** You should have received a copy of the GNU General Public License
+** along with tsinfer.  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+ * Microbenchmark for the ancestor matcher. Builds a tree sequence from
+ * mosaic haplotypes using the ancestor builder, and then reports the
+ * per-site throughput of find_path when matching the ancestors and when
+ * matching the samples against the final builder.
+ *
+ * Usage: benchmark [num_samples] [num_sites] [num_repeats] [seed]
+ */
+
+#include "tsinfer.h"
+#include "tskit.h"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+
+#define NUM_FOUNDERS 32
+
+static void
+fatal_error(const char *msg, int err)
+{
+    fprintf(stderr, "%s: %d: %s\n", msg, err, tsi_strerror(err));
+    exit(EXIT_FAILURE);
+}
+
+static void *
+xmalloc(size_t size)
+{
+    void *ret = malloc(size);
+    if (ret == NULL) {
+        fprintf(stderr, "Out of memory\n");
+        exit(EXIT_FAILURE);
+    }
+    return ret;
+}
+
+static double
+uniform(void)
+{
+    return (double) rand() / ((double) RAND_MAX + 1.0);
+}
+
+/* Each sample copies from a set of founder haplotypes, switching founder
+ * at random and with occasional mismatches, so that the inferred trees
+ * have realistic shared structure. */
+static allele_t *
+generate_haplotypes(size_t num_samples, size_t num_sites, int seed)
+{
+    size_t j, k, founder;
+    allele_t *founders = xmalloc(NUM_FOUNDERS * num_sites * sizeof(*founders));
+    allele_t *haplotypes = xmalloc(num_samples * num_sites * sizeof(*haplotypes));
+    allele_t *h;
+
+    srand((unsigned int) seed);
+    for (j = 0; j < NUM_FOUNDERS * num_sites; j++) {
+        founders[j] = (allele_t)(uniform() < 0.3);
+    }
+    for (j = 0; j < num_samples; j++) {
+        h = haplotypes + j * num_sites;
+        founder = (size_t) rand() % NUM_FOUNDERS;
+        for (k = 0; k < num_sites; k++) {
+            if (uniform() < 0.01) {
+                founder = (size_t) rand() % NUM_FOUNDERS;
+            }
+            h[k] = founders[founder * num_sites + k];
+            if (uniform() < 0.005) {
+                h[k] = (allele_t) !h[k];
+            }
+        }
+    }
+    free(founders);
+    return haplotypes;
+}
+
+static double
+elapsed(clock_t start)
+{
+    return (double) (clock() - start) / CLOCKS_PER_SEC;
+}
+
+/* Returns the time spent in find_path. If add is true, the path and the
+ * mutations needed to explain the haplotype are added to the builder. */
+static double
+match_haplotype(tree_sequence_builder_t *tsb, ancestor_matcher_t *matcher,
+    tsk_id_t child, tsk_id_t start, tsk_id_t end, allele_t *haplotype, allele_t *match,
+    tsk_id_t *mutation_site, allele_t *mutation_derived_state, bool add)
+{
+    int ret;
+    size_t num_edges, num_mutations;
+    tsk_id_t *left, *right, *parent;
+    tsk_id_t k;
+    clock_t t = clock();
+    double duration;
+
+    ret = ancestor_matcher_find_path(
+        matcher, start, end, haplotype, match, &num_edges, &left, &right, &parent);
+    duration = elapsed(t);
+    if (ret != 0) {
+        fatal_error("find_path", ret);
+    }
+    if (add) {
+        ret = tree_sequence_builder_add_path(
+            tsb, child, num_edges, left, right, parent, TSI_COMPRESS_PATH);
+        if (ret != 0) {
+            fatal_error("add_path", ret);
+        }
+        num_mutations = 0;
+        for (k = start; k < end; k++) {
+            if (haplotype[k] != match[k]) {
+                mutation_site[num_mutations] = k;
+                mutation_derived_state[num_mutations] = haplotype[k];
+                num_mutations++;
+            }
+        }
+        ret = tree_sequence_builder_add_mutations(
+            tsb, child, num_mutations, mutation_site, mutation_derived_state);
+        if (ret != 0) {
+            fatal_error("add_mutations", ret);
+        }
+    }
+    return duration;
+}
+
+int
+main(int argc, char **argv)
+{
+    size_t num_samples = argc > 1 ? (size_t) atoi(argv[1]) : 500;
+    size_t num_sites = argc > 2 ? (size_t) atoi(argv[2]) : 5000;
+    int num_repeats = argc > 3 ? atoi(argv[3]) : 1;
+    int seed = argc > 4 ? atoi(argv[4]) : 42;
+    ancestor_builder_t ancestor_builder;
+    ancestor_builder_workspace_t workspace;
+    ancestor_matcher_t matcher;
+    tree_sequence_builder_t tsb;
+    ancestor_descriptor_t ad;
+    allele_t *haplotypes = generate_haplotypes(num_samples, num_sites, seed);
+    allele_t *genotypes = xmalloc(num_samples * sizeof(*genotypes));
+    allele_t *haplotype = xmalloc(num_sites * sizeof(*haplotype));
+    allele_t *match = xmalloc(num_sites * sizeof(*match));
+    allele_t *mutation_derived_state
+        = xmalloc(num_sites * sizeof(*mutation_derived_state));
+    tsk_id_t *mutation_site = xmalloc(num_sites * sizeof(*mutation_site));
+    double *recombination_rate = xmalloc(num_sites * sizeof(*recombination_rate));
+    double *mismatch_rate = xmalloc(num_sites * sizeof(*mismatch_rate));
+    double time, ancestor_time, sample_time;
+    size_t ancestor_sites, j, k;
+    tsk_id_t start, end, child, root_left, root_right, root_parent;
+    int r, ret;
+
+    for (j = 0; j < num_sites; j++) {
+        recombination_rate[j] = 1e-2;
+        mismatch_rate[j] = 1e-6;
+    }
+    ret = ancestor_builder_alloc(&ancestor_builder, num_samples, num_sites, -1, 0);
+    if (ret != 0) {
+        fatal_error("ancestor_builder_alloc", ret);
+    }
+    ret = tree_sequence_builder_alloc(&tsb, num_sites, NULL, 1024, 1024, 0);
+    if (ret != 0) {
+        fatal_error("tree_sequence_builder_alloc", ret);
+    }
+    ret = ancestor_matcher_alloc(
+        &matcher, &tsb, recombination_rate, mismatch_rate, 13, 0);
+    if (ret != 0) {
+        fatal_error("ancestor_matcher_alloc", ret);
+    }
+    for (k = 0; k < num_sites; k++) {
+        time = 0;
+        for (j = 0; j < num_samples; j++) {
+            genotypes[j] = haplotypes[j * num_sites + k];
+            time += genotypes[j];
+        }
+        ret = ancestor_builder_add_site(&ancestor_builder, time, genotypes);
+        if (ret != 0) {
+            fatal_error("add_site", ret);
+        }
+    }
+    ret = ancestor_builder_finalise(&ancestor_builder);
+    if (ret != 0) {
+        fatal_error("finalise", ret);
+    }
+    ret = ancestor_builder_workspace_alloc(&workspace, &ancestor_builder);
+    if (ret != 0) {
+        fatal_error("workspace_alloc", ret);
+    }
+
+    /* The virtual root and the ultimate ancestor */
+    tree_sequence_builder_add_node(&tsb, ancestor_builder.descriptors[0].time + 2, 0);
+    tree_sequence_builder_add_node(&tsb, ancestor_builder.descriptors[0].time + 1, 0);
+    root_left = 0;
+    root_right = (tsk_id_t) num_sites;
+    root_parent = 0;
+    ret = tree_sequence_builder_add_path(
+        &tsb, 1, 1, &root_left, &root_right, &root_parent, 0);
+    if (ret != 0) {
+        fatal_error("add_path", ret);
+    }
+
+    ancestor_time = 0;
+    ancestor_sites = 0;
+    time = -1;
+    for (j = 0; j < ancestor_builder.num_ancestors; j++) {
+        ad = ancestor_builder.descriptors[j];
+        if (ad.time != time) {
+            ret = tree_sequence_builder_freeze_indexes(&tsb);
+            if (ret != 0) {
+                fatal_error("freeze_indexes", ret);
+            }
+            time = ad.time;
+        }
+        ret = ancestor_builder_make_ancestor(&ancestor_builder, ad.num_focal_sites,
+            ad.focal_sites, &start, &end, haplotype, &workspace);
+        if (ret == TSI_ERR_BAD_FOCAL_SITE) {
+            continue;
+        }
+        if (ret != 0) {
+            fatal_error("make_ancestor", ret);
+        }
+        child = tree_sequence_builder_add_node(&tsb, ad.time, 0);
+        if (child < 0) {
+            fatal_error("add_node", child);
+        }
+        ancestor_time += match_haplotype(&tsb, &matcher, child, start, end, haplotype,
+            match, mutation_site, mutation_derived_state, true);
+        ancestor_sites += (size_t)(end - start);
+    }
+    ret = tree_sequence_builder_freeze_indexes(&tsb);
+    if (ret != 0) {
+        fatal_error("freeze_indexes", ret);
+    }
+
+    /* Samples are matched against the full builder but not added, so that
+     * each repeat does exactly the same work. */
+    sample_time = 0;
+    for (r = 0; r < num_repeats; r++) {
+        for (j = 0; j < num_samples; j++) {
+            sample_time += match_haplotype(&tsb, &matcher, 0, 0, (tsk_id_t) num_sites,
+                haplotypes + j * num_sites, match, mutation_site, mutation_derived_state,
+                false);
+        }
+    }
+
+    printf("samples=%d sites=%d ancestors=%d nodes=%d edges=%d\n", (int) num_samples,
+        (int) num_sites, (int) ancestor_builder.num_ancestors,
+        (int) tree_sequence_builder_get_num_nodes(&tsb),
+        (int) tree_sequence_builder_get_num_edges(&tsb));
+    printf("match_ancestors: %.3fs %.1f ns/site\n", ancestor_time,
+        1e9 * ancestor_time / (double) ancestor_sites);
+    printf("match_samples:   %.3fs %.1f ns/site\n", sample_time,
+        1e9 * sample_time
+            / ((double) num_repeats * (double) num_samples * (double) num_sites));
+    printf("mean traceback size: %.1f\n",
+        ancestor_matcher_get_mean_traceback_size(&matcher));
+
+    ancestor_builder_workspace_free(&workspace);
+    ancestor_builder_free(&ancestor_builder);
+    ancestor_matcher_free(&matcher);
+    tree_sequence_builder_free(&tsb);
+    free(haplotypes);
+    free(genotypes);
+    free(haplotype);
+    free(match);
+    free(mutation_site);
+    free(mutation_derived_state);
+    free(recombination_rate);
+    free(mismatch_rate);
+    return EXIT_SUCCESS;
+}
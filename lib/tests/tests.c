@@ -184,6 +184,191 @@ verify_restore_tsb(tree_sequence_builder_t *tsb, tsk_table_collection_t *tables)
     free(mut_parent);
 }
 
+/* Check that the sorted edges dumped from the specified tree_sequence_builder
+ * are identical to the sorted edges in the specified tables, and that the
+ * mutation parents it computes are the same as tskit's.
+ */
+static void
+verify_sorted_dump(tree_sequence_builder_t *tsb, tsk_table_collection_t *tables)
+{
+    int ret;
+    size_t j;
+    size_t num_edges = tree_sequence_builder_get_num_edges(tsb);
+    tsk_table_collection_t other_tables;
+    tsk_id_t *left = malloc(TSK_MAX(1, num_edges) * sizeof(*left));
+    tsk_id_t *right = malloc(TSK_MAX(1, num_edges) * sizeof(*right));
+    tsk_id_t *parent = malloc(TSK_MAX(1, num_edges) * sizeof(*parent));
+    tsk_id_t *child = malloc(TSK_MAX(1, num_edges) * sizeof(*child));
+
+    CU_ASSERT_FATAL(left != NULL && right != NULL && parent != NULL && child != NULL);
+    ret = tree_sequence_builder_dump_sorted_edges(tsb, left, right, parent, child);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    CU_ASSERT_EQUAL_FATAL(tables->edges.num_rows, num_edges);
+    for (j = 0; j < num_edges; j++) {
+        CU_ASSERT_EQUAL(tables->edges.left[j], left[j]);
+        CU_ASSERT_EQUAL(tables->edges.right[j], right[j]);
+        CU_ASSERT_EQUAL(tables->edges.parent[j], parent[j]);
+        CU_ASSERT_EQUAL(tables->edges.child[j], child[j]);
+    }
+
+    ret = tsk_table_collection_copy(tables, &other_tables, 0);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    ret = tsk_table_collection_build_index(&other_tables, 0);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    ret = tsk_table_collection_compute_mutation_parents(&other_tables, 0);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    CU_ASSERT_TRUE(
+        tsk_mutation_table_equals(&tables->mutations, &other_tables.mutations, 0));
+
+    tsk_table_collection_free(&other_tables);
+    free(left);
+    free(right);
+    free(parent);
+    free(child);
+}
+
+/* Check that a snapshot of the specified tree_sequence_builder restores to
+ * the state reflected in the specified tables.
+ */
+static void
+verify_restore_snapshot(tree_sequence_builder_t *tsb, tsk_table_collection_t *tables)
+{
+    int ret;
+    long size;
+    tree_sequence_builder_t other_tsb;
+    tsk_table_collection_t other_tables;
+    FILE *file = tmpfile();
+    char *snapshot;
+
+    CU_ASSERT_FATAL(file != NULL);
+    ret = tree_sequence_builder_dump_snapshot(tsb, file);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    size = ftell(file);
+    CU_ASSERT_FATAL(size > 0);
+    snapshot = malloc((size_t) size);
+    CU_ASSERT_FATAL(snapshot != NULL);
+    rewind(file);
+    CU_ASSERT_EQUAL_FATAL(fread(snapshot, 1, (size_t) size, file), (size_t) size);
+    fclose(file);
+
+    ret = tree_sequence_builder_alloc(
+        &other_tsb, tsb->num_sites, tsb->sites.num_alleles, 1, 1, 0);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    ret = tree_sequence_builder_restore_snapshot(
+        &other_tsb, snapshot, sizeof(tsi_snapshot_header_t) - 1);
+    CU_ASSERT_EQUAL_FATAL(ret, TSI_ERR_BAD_SNAPSHOT);
+    ret = tree_sequence_builder_restore_snapshot(
+        &other_tsb, snapshot, (size_t) size - 1);
+    CU_ASSERT_EQUAL_FATAL(ret, TSI_ERR_BAD_SNAPSHOT);
+    ret = tree_sequence_builder_restore_snapshot(&other_tsb, snapshot, (size_t) size);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    ret = tree_sequence_builder_restore_snapshot(&other_tsb, snapshot, (size_t) size);
+    CU_ASSERT_EQUAL_FATAL(ret, TSI_ERR_SNAPSHOT_NONEMPTY_BUILDER);
+
+    dump_tree_sequence_builder(&other_tsb, &other_tables, 0);
+    CU_ASSERT_TRUE_FATAL(tsk_table_collection_equals(tables, &other_tables, 0));
+
+    tree_sequence_builder_free(&other_tsb);
+    tsk_table_collection_free(&other_tables);
+    free(snapshot);
+}
+
+/* Verifies that the builder's frozen indexes are identical to the state of
+ * its dynamic indexes, however they were built. */
+static void
+verify_frozen_indexes(tree_sequence_builder_t *tsb)
+{
+    avl_node_t *a;
+    const edge_t *edge;
+    const mutation_list_node_t *mutation;
+    size_t j, k;
+
+    CU_ASSERT_EQUAL_FATAL(tsb->frozen->num_edges, avl_count(&tsb->left_index));
+    j = 0;
+    for (a = tsb->left_index.head; a != NULL; a = a->next) {
+        edge = &((indexed_edge_t *) a->item)->edge;
+        CU_ASSERT_FATAL(
+            memcmp(tsb->frozen->left_index_edges + j, edge, sizeof(*edge)) == 0);
+        j++;
+    }
+    j = 0;
+    for (a = tsb->right_index.head; a != NULL; a = a->next) {
+        edge = &((indexed_edge_t *) a->item)->edge;
+        CU_ASSERT_FATAL(
+            memcmp(tsb->frozen->right_index_edges + j, edge, sizeof(*edge)) == 0);
+        j++;
+    }
+    CU_ASSERT_EQUAL_FATAL(tsb->index_log.size, 0);
+
+    CU_ASSERT_EQUAL_FATAL(tsb->frozen->mutations.num_mutations, tsb->num_mutations);
+    CU_ASSERT_EQUAL_FATAL(tsb->frozen->mutations.offset[0], 0);
+    for (j = 0; j < tsb->num_sites; j++) {
+        k = tsb->frozen->mutations.offset[j];
+        for (mutation = tsb->sites.mutations[j]; mutation != NULL;
+             mutation = mutation->next) {
+            CU_ASSERT_FATAL(k < tsb->frozen->mutations.offset[j + 1]);
+            CU_ASSERT_EQUAL_FATAL(tsb->frozen->mutations.node[k], mutation->node);
+            CU_ASSERT_EQUAL_FATAL(
+                tsb->frozen->mutations.derived_state[k], mutation->derived_state);
+            k++;
+        }
+        CU_ASSERT_EQUAL_FATAL(k, tsb->frozen->mutations.offset[j + 1]);
+    }
+    CU_ASSERT_EQUAL_FATAL(
+        tsb->frozen->mutations.offset[tsb->num_sites], tsb->num_mutations);
+    CU_ASSERT_EQUAL_FATAL(tsb->mutation_log.size, 0);
+}
+
+/* Verifies that each seek index checkpoint contains exactly the frozen edges
+ * that intersect with its position. */
+static void
+verify_seek_index(frozen_indexes_t *indexes, size_t num_sites)
+{
+    size_t j, k, num_tree_edges;
+    tsk_id_t pos, in_index, out_index;
+    const edge_t *in = indexes->left_index_edges;
+    const edge_t *out = indexes->right_index_edges;
+    const tsk_id_t *edges;
+    bool *in_tree = calloc(indexes->num_edges, sizeof(*in_tree));
+
+    CU_ASSERT_FATAL(in_tree != NULL);
+    for (j = 0; j < indexes->seek_index.num_checkpoints; j++) {
+        pos = indexes->seek_index.position[j];
+        in_index = indexes->seek_index.in_index[j];
+        out_index = indexes->seek_index.out_index[j];
+        if (j > 0) {
+            CU_ASSERT_FATAL(indexes->seek_index.position[j - 1] < pos);
+        }
+        CU_ASSERT_EQUAL_FATAL(frozen_indexes_find_checkpoint(indexes, pos), j);
+        CU_ASSERT_FATAL(in_index > 0 && in[in_index - 1].left == pos);
+        CU_ASSERT_FATAL(
+            in_index == (tsk_id_t) indexes->num_edges || in[in_index].left > pos);
+        CU_ASSERT_FATAL(out_index == 0 || out[out_index - 1].right <= pos);
+        CU_ASSERT_FATAL(out[out_index].right > pos);
+
+        edges = indexes->seek_index.edges + indexes->seek_index.offset[j];
+        num_tree_edges
+            = indexes->seek_index.offset[j + 1] - indexes->seek_index.offset[j];
+        for (k = 0; k < num_tree_edges; k++) {
+            CU_ASSERT_FATAL(edges[k] < in_index);
+            CU_ASSERT_FATAL(!in_tree[edges[k]]);
+            in_tree[edges[k]] = true;
+        }
+        for (k = 0; k < indexes->num_edges; k++) {
+            CU_ASSERT_EQUAL_FATAL(in_tree[k], in[k].left <= pos && pos < in[k].right);
+            in_tree[k] = false;
+        }
+    }
+    if (indexes->seek_index.num_checkpoints > 0) {
+        CU_ASSERT_EQUAL(
+            frozen_indexes_find_checkpoint(indexes, indexes->seek_index.position[0] - 1),
+            -1);
+        CU_ASSERT_EQUAL(frozen_indexes_find_checkpoint(indexes, (tsk_id_t) num_sites),
+            (tsk_id_t) indexes->seek_index.num_checkpoints - 1);
+    }
+    free(in_tree);
+}
+
 /* Verifies the tree sequence encodes the specified set of sample haplotypes. */
 static void
 verify_round_trip(tsk_table_collection_t *tables, size_t num_samples, size_t num_sites,
@@ -336,6 +521,7 @@ run_random_data(size_t num_samples, size_t num_sites, int seed,
 {
     tsk_table_collection_t tables;
     ancestor_builder_t ancestor_builder;
+    ancestor_builder_workspace_t workspace;
     ancestor_matcher_t ancestor_matcher;
     tree_sequence_builder_t tsb;
     ancestor_descriptor_t ad;
@@ -344,13 +530,16 @@ run_random_data(size_t num_samples, size_t num_sites, int seed,
     allele_t **samples = generate_random_haplotypes(num_samples, num_sites, 2, seed);
     allele_t *genotypes = malloc(num_samples * sizeof(*genotypes));
     allele_t *haplotype = malloc(num_sites * sizeof(*haplotype));
+    allele_t *haplotype_copy = malloc(num_sites * sizeof(*haplotype_copy));
     double time;
-    tsk_id_t child, start, end;
-    size_t j, k;
+    tsk_id_t child, start, end, start_copy, end_copy;
+    frozen_indexes_t *indexes;
+    size_t j, k, num_mutations;
     int ret;
 
     CU_ASSERT_FATAL(genotypes != NULL);
     CU_ASSERT_FATAL(haplotype != NULL);
+    CU_ASSERT_FATAL(haplotype_copy != NULL);
     CU_ASSERT_FATAL(recombination_rates != NULL);
     CU_ASSERT_FATAL(mismatch_rates != NULL);
 
@@ -383,6 +572,8 @@ run_random_data(size_t num_samples, size_t num_sites, int seed,
     ret = ancestor_builder_finalise(&ancestor_builder);
     CU_ASSERT_EQUAL_FATAL(ret, 0);
     ancestor_builder_print_state(&ancestor_builder, _devnull);
+    ret = ancestor_builder_workspace_alloc(&workspace, &ancestor_builder);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
 
     initialise_builder(&tsb, ancestor_builder.descriptors[0].time);
 
@@ -394,6 +585,7 @@ run_random_data(size_t num_samples, size_t num_sites, int seed,
             /* printf("NEW EPOCH: %f\n", ad.time); */
             ret = tree_sequence_builder_freeze_indexes(&tsb);
             CU_ASSERT_EQUAL_FATAL(ret, 0);
+            verify_frozen_indexes(&tsb);
             time = ad.time;
         }
         ret = tree_sequence_builder_add_node(&tsb, ad.time, 0);
@@ -401,10 +593,29 @@ run_random_data(size_t num_samples, size_t num_sites, int seed,
         child = ret;
         /* Build the ancestral haplotype */
         ret = ancestor_builder_make_ancestor(&ancestor_builder, ad.num_focal_sites,
-            ad.focal_sites, &start, &end, haplotype);
+            ad.focal_sites, &start, &end, haplotype, &workspace);
+        /* The reused workspace must give the same result as a fresh one,
+         * and leave the disagree flags clear for the next call. */
+        CU_ASSERT_EQUAL_FATAL(
+            ret, ancestor_builder_make_ancestor(&ancestor_builder, ad.num_focal_sites,
+                     ad.focal_sites, &start_copy, &end_copy, haplotype_copy, NULL));
+        if (ancestor_builder_options & TSI_GENOTYPE_ENCODING_ONE_BIT) {
+            for (k = 0; k < workspace.num_words; k++) {
+                CU_ASSERT_FATAL(workspace.disagree_bitset[k] == 0);
+            }
+        } else {
+            for (k = 0; k < num_samples; k++) {
+                CU_ASSERT_FATAL(!workspace.disagree[k]);
+            }
+        }
         /* With random data we could ask for an ancestor for a focal site at freq 0 */
         if (ret != TSI_ERR_BAD_FOCAL_SITE) {
             CU_ASSERT_EQUAL_FATAL(ret, 0);
+            CU_ASSERT_EQUAL_FATAL(start, start_copy);
+            CU_ASSERT_EQUAL_FATAL(end, end_copy);
+            CU_ASSERT_FATAL(memcmp(haplotype + start, haplotype_copy + start,
+                                (size_t)(end - start) * sizeof(*haplotype))
+                            == 0);
             add_haplotype(&tsb, &ancestor_matcher, child, start, end, haplotype);
             /* printf("\n"); */
             /* tree_sequence_builder_print_state(&tsb, stdout); */
@@ -415,19 +626,42 @@ run_random_data(size_t num_samples, size_t num_sites, int seed,
     /* Add the samples */
     ret = tree_sequence_builder_freeze_indexes(&tsb);
     CU_ASSERT_EQUAL_FATAL(ret, 0);
+    verify_frozen_indexes(&tsb);
+    verify_seek_index(tsb.frozen, tsb.num_sites);
+    indexes = tree_sequence_builder_acquire_indexes(&tsb);
+    CU_ASSERT_EQUAL_FATAL(indexes->num_references, 2);
+    num_mutations = tsb.num_mutations;
     for (j = 0; j < num_samples; j++) {
         ret = tree_sequence_builder_add_node(&tsb, 0, TSK_NODE_IS_SAMPLE);
         CU_ASSERT_FATAL(ret >= 0);
         child = ret;
         add_haplotype(&tsb, &ancestor_matcher, child, 0, num_sites, samples[j]);
     }
+    /* Refreezing releases the builder's reference, but the indexes we hold
+     * must be unaffected. */
+    CU_ASSERT_EQUAL_FATAL(tsb.frozen, indexes);
+    ret = tree_sequence_builder_freeze_indexes(&tsb);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    CU_ASSERT_FATAL(tsb.frozen != indexes);
+    CU_ASSERT_EQUAL_FATAL(indexes->num_references, 1);
+    CU_ASSERT_EQUAL_FATAL(tsb.frozen->num_nodes, tsb.num_nodes);
+    CU_ASSERT_FATAL(indexes->num_nodes < tsb.num_nodes);
+    CU_ASSERT_EQUAL_FATAL(indexes->mutations.num_mutations, num_mutations);
+    CU_ASSERT_EQUAL_FATAL(indexes->mutations.offset[tsb.num_sites], num_mutations);
+    verify_frozen_indexes(&tsb);
+    verify_seek_index(indexes, tsb.num_sites);
+    verify_seek_index(tsb.frozen, tsb.num_sites);
+    frozen_indexes_release(indexes);
     ancestor_matcher_print_state(&ancestor_matcher, _devnull);
     tree_sequence_builder_print_state(&tsb, _devnull);
 
     dump_tree_sequence_builder(&tsb, &tables, 0);
     verify_round_trip(&tables, num_samples, num_sites, samples);
     verify_restore_tsb(&tsb, &tables);
+    verify_sorted_dump(&tsb, &tables);
+    verify_restore_snapshot(&tsb, &tables);
 
+    ancestor_builder_workspace_free(&workspace);
     ancestor_builder_free(&ancestor_builder);
     tree_sequence_builder_free(&tsb);
     ancestor_matcher_free(&ancestor_matcher);
@@ -438,6 +672,7 @@ run_random_data(size_t num_samples, size_t num_sites, int seed,
     }
     free(samples);
     free(haplotype);
+    free(haplotype_copy);
     free(genotypes);
     free(recombination_rates);
     free(mismatch_rates);
@@ -450,6 +685,8 @@ test_ancestor_builder_errors(void)
     ancestor_builder_t ancestor_builder;
     allele_t genotypes_ones[4] = { 1, 1, 1, 1 };
     allele_t genotypes_zeros[4] = { 0, 0, 0, 0 };
+    allele_t genotypes_block[6] = { 1, 0, 0, 1, 1, 1 };
+    double times[3] = { 1, 1, 2 };
     tsk_id_t start, end;
     allele_t haplotype[4];
     FILE *mmap_file;
@@ -493,9 +730,108 @@ test_ancestor_builder_errors(void)
     CU_ASSERT_EQUAL_FATAL(ret, 0);
     ret = ancestor_builder_make_ancestor(&ancestor_builder,
         ancestor_builder.descriptors[0].num_focal_sites,
-        ancestor_builder.descriptors[0].focal_sites, &start, &end, haplotype);
+        ancestor_builder.descriptors[0].focal_sites, &start, &end, haplotype, NULL);
     CU_ASSERT_EQUAL_FATAL(ret, TSI_ERR_BAD_FOCAL_SITE);
     ancestor_builder_free(&ancestor_builder);
+
+    /* Adding a block of sites stops at the first site that doesn't fit */
+    ret = ancestor_builder_alloc(&ancestor_builder, 2, 2, -1, 0);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    ret = ancestor_builder_add_sites(&ancestor_builder, 3, times, genotypes_block);
+    CU_ASSERT_EQUAL_FATAL(ret, TSI_ERR_TOO_MANY_SITES);
+    CU_ASSERT_EQUAL_FATAL(ancestor_builder.num_sites, 2);
+    ancestor_builder_free(&ancestor_builder);
+}
+
+static void
+verify_one_bit_encoding_equivalence(size_t num_samples, size_t num_sites, int seed)
+{
+    int ret, ret_one_bit;
+    ancestor_builder_t builder, builder_one_bit;
+    ancestor_builder_workspace_t workspace, workspace_one_bit;
+    allele_t **samples = generate_random_haplotypes(num_samples, num_sites, 2, seed);
+    allele_t *genotypes = malloc(num_samples * sizeof(*genotypes));
+    allele_t *haplotype = malloc(num_sites * sizeof(*haplotype));
+    allele_t *haplotype_one_bit = malloc(num_sites * sizeof(*haplotype_one_bit));
+    tsk_id_t start, end, start_one_bit, end_one_bit;
+    ancestor_descriptor_t ad;
+    double time;
+    size_t j, k;
+
+    CU_ASSERT_FATAL(genotypes != NULL);
+    CU_ASSERT_FATAL(haplotype != NULL);
+    CU_ASSERT_FATAL(haplotype_one_bit != NULL);
+    ret = ancestor_builder_alloc(&builder, num_samples, num_sites, -1, 0);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    ret = ancestor_builder_alloc(
+        &builder_one_bit, num_samples, num_sites, -1, TSI_GENOTYPE_ENCODING_ONE_BIT);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    for (j = 0; j < num_sites; j++) {
+        time = 0;
+        for (k = 0; k < num_samples; k++) {
+            genotypes[k] = samples[k][j];
+            time += genotypes[k];
+        }
+        ret = ancestor_builder_add_site(&builder, time, genotypes);
+        CU_ASSERT_EQUAL_FATAL(ret, 0);
+        ret = ancestor_builder_add_site(&builder_one_bit, time, genotypes);
+        CU_ASSERT_EQUAL_FATAL(ret, 0);
+    }
+    ret = ancestor_builder_finalise(&builder);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    ret = ancestor_builder_finalise(&builder_one_bit);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    CU_ASSERT_EQUAL_FATAL(builder.num_ancestors, builder_one_bit.num_ancestors);
+    ret = ancestor_builder_workspace_alloc(&workspace, &builder);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    ret = ancestor_builder_workspace_alloc(&workspace_one_bit, &builder_one_bit);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    CU_ASSERT_FATAL(workspace_one_bit.num_words * 64 >= num_samples);
+
+    for (j = 0; j < builder.num_ancestors; j++) {
+        /* The order of the descriptors can differ between encodings, so make
+         * the same ancestor with both builders */
+        ad = builder.descriptors[j];
+        ret = ancestor_builder_make_ancestor(&builder, ad.num_focal_sites,
+            ad.focal_sites, &start, &end, haplotype, &workspace);
+        ret_one_bit = ancestor_builder_make_ancestor(&builder_one_bit,
+            ad.num_focal_sites, ad.focal_sites, &start_one_bit, &end_one_bit,
+            haplotype_one_bit, &workspace_one_bit);
+        CU_ASSERT_EQUAL_FATAL(ret, ret_one_bit);
+        if (ret == 0) {
+            CU_ASSERT_EQUAL_FATAL(start, start_one_bit);
+            CU_ASSERT_EQUAL_FATAL(end, end_one_bit);
+            CU_ASSERT_FATAL(memcmp(haplotype + start, haplotype_one_bit + start,
+                                (size_t)(end - start) * sizeof(*haplotype))
+                            == 0);
+        }
+    }
+
+    ancestor_builder_workspace_free(&workspace);
+    ancestor_builder_workspace_free(&workspace_one_bit);
+    ancestor_builder_free(&builder);
+    ancestor_builder_free(&builder_one_bit);
+    for (j = 0; j < num_samples; j++) {
+        free(samples[j]);
+    }
+    free(samples);
+    free(genotypes);
+    free(haplotype);
+    free(haplotype_one_bit);
+}
+
+static void
+test_ancestor_builder_one_bit_encoding(void)
+{
+    size_t num_samples[] = { 2, 7, 8, 9, 63, 64, 65, 130, 257 };
+    size_t j;
+    int seed;
+
+    for (j = 0; j < sizeof(num_samples) / sizeof(*num_samples); j++) {
+        for (seed = 1; seed < 4; seed++) {
+            verify_one_bit_encoding_equivalence(num_samples[j], 50, seed);
+        }
+    }
 }
 
 static void
@@ -523,7 +859,7 @@ test_ancestor_builder_one_site(void)
 
     focal_sites[0] = 0;
     ret = ancestor_builder_make_ancestor(
-        &ancestor_builder, 1, focal_sites, &start, &end, ancestor);
+        &ancestor_builder, 1, focal_sites, &start, &end, ancestor, NULL);
     CU_ASSERT_EQUAL_FATAL(ret, 0);
     CU_ASSERT_EQUAL(start, 0);
     CU_ASSERT_EQUAL(end, 1);
@@ -543,6 +879,7 @@ test_matching_one_site(void)
     allele_t match[1];
     double recombination_rate = 0;
     double mismatch_rate = 0;
+    int8_t recombination_required[2];
     size_t num_edges;
     tsk_id_t *left, *right, *parent;
 
@@ -584,6 +921,20 @@ test_matching_one_site(void)
     CU_ASSERT_EQUAL(right[0], 1);
     CU_ASSERT_EQUAL(parent[0], 1);
     CU_ASSERT_EQUAL(match[0], 0);
+    ret = ancestor_matcher_get_traceback(&ancestor_matcher, 0, recombination_required);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    CU_ASSERT_EQUAL(recombination_required[0], -1);
+    CU_ASSERT_EQUAL(recombination_required[1], 0);
+
+    ancestor_matcher_set_traceback_memory_limit(&ancestor_matcher, 1);
+    ret = ancestor_matcher_find_path(
+        &ancestor_matcher, 0, 1, haplotype, match, &num_edges, &left, &right, &parent);
+    CU_ASSERT_EQUAL_FATAL(ret, TSI_ERR_TRACEBACK_MEMORY_LIMIT);
+    ancestor_matcher_set_traceback_memory_limit(&ancestor_matcher, 0);
+    ret = ancestor_matcher_find_path(
+        &ancestor_matcher, 0, 1, haplotype, match, &num_edges, &left, &right, &parent);
+    CU_ASSERT_EQUAL_FATAL(ret, 0);
+    CU_ASSERT_EQUAL(parent[0], 1);
 
     dump_tree_sequence_builder(&tsb, &tables, 0);
     CU_ASSERT_EQUAL(tables.sequence_length, 1);
@@ -676,6 +1027,7 @@ test_matching_one_site_many_alleles(void)
     CU_ASSERT_EQUAL(tables.edges.num_rows, num_nodes - 1);
     CU_ASSERT_EQUAL(tables.sites.num_rows, 1);
     CU_ASSERT_EQUAL(tables.mutations.num_rows, num_nodes - 2);
+    verify_sorted_dump(&tsb, &tables);
 
     ancestor_matcher_free(&ancestor_matcher);
     tree_sequence_builder_free(&tsb);
@@ -985,6 +1337,42 @@ test_packbits_errors(void)
     CU_ASSERT_EQUAL_FATAL(ret, TSI_ERR_ONE_BIT_NON_BINARY);
 }
 
+static void
+verify_round(double x)
+{
+    unsigned int ndigits;
+    double a, b;
+
+    for (ndigits = 0; ndigits < 25; ndigits++) {
+        a = tsi_round(x, ndigits);
+        b = tsk_round(x, ndigits);
+        /* Compare the bits so that the sign of zero is checked too. */
+        CU_ASSERT_FATAL(memcmp(&a, &b, sizeof(double)) == 0);
+    }
+}
+
+static void
+test_round(void)
+{
+    double special[] = { 0.0, -0.0, 0.5, -0.5, 1.5, -1.5, 2.5, -2.5, 0.25, 0.125, 0.375,
+        -0.375, 0.05, 0.15, 0.45, 1, -1, 0.999999, 1e-300, -1e-300, DBL_MIN, DBL_MAX,
+        -DBL_MAX, 4503599627370495.5, 4503599627370496.0, 1e15 + 0.5, -1e15 - 0.5, 1e17,
+        1e25 };
+    size_t j;
+    int k;
+
+    for (j = 0; j < sizeof(special) / sizeof(*special); j++) {
+        verify_round(special[j]);
+    }
+    srand(42);
+    for (k = 0; k < 100000; k++) {
+        verify_round((double) rand() / RAND_MAX);
+        verify_round(-(double) rand() / RAND_MAX);
+        /* Exact binary fractions land on ties for small ndigits. */
+        verify_round((double) (rand() % 4096) / 4096.0);
+    }
+}
+
 static void
 test_strerror(void)
 {
@@ -1056,6 +1444,8 @@ main(int argc, char **argv)
     CU_TestInfo tests[] = {
         { "test_ancestor_builder_errors", test_ancestor_builder_errors },
         { "test_ancestor_builder_one_site", test_ancestor_builder_one_site },
+        { "test_ancestor_builder_one_bit_encoding",
+            test_ancestor_builder_one_bit_encoding },
         /* TODO more ancestor builder tests */
         { "test_matching_one_site", test_matching_one_site },
         { "test_matching_one_site_many_alleles", test_matching_one_site_many_alleles },
@@ -1076,6 +1466,7 @@ main(int argc, char **argv)
         { "test_packbits_3", test_packbits_3 },
         { "test_packbits_4", test_packbits_4 },
         { "test_packbits_errors", test_packbits_errors },
+        { "test_round", test_round },
 
         { "test_strerror", test_strerror },
 
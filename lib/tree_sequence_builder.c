@@ -34,6 +34,17 @@
  * hack though, and we should have a better approach. */
 #define PC_ANCESTOR_INCREMENT (1.0 / (1LL << 32))
 
+/* The minimum number of edge insertions and removals between seek index
+ * checkpoints. Checkpoints are also spaced so that the number of edges
+ * stored in a checkpoint is no more than the number of edge events since
+ * the previous one, so that the total size of the seek index is bounded by
+ * twice the number of edges. */
+#define SEEK_INDEX_MIN_EVENTS 256
+
+/* The minimum number of index changes we record before falling back to
+ * rebuilding the frozen indexes from the AVL trees. */
+#define INDEX_LOG_MIN_SIZE 1024
+
 static int
 cmp_edge_left_increasing_time(const void *a, const void *b)
 {
@@ -64,6 +75,20 @@ cmp_edge_right_decreasing_time(const void *a, const void *b)
     return ret;
 }
 
+/* Orders nodes by increasing time, breaking ties by ID. This is the order
+ * of edge parents in a sorted tskit edge table. */
+static int
+cmp_node_time(const void *a, const void *b)
+{
+    const node_time_t *ia = (const node_time_t *) a;
+    const node_time_t *ib = (const node_time_t *) b;
+    int ret = (ia->time > ib->time) - (ia->time < ib->time);
+    if (ret == 0) {
+        ret = (ia->node > ib->node) - (ia->node < ib->node);
+    }
+    return ret;
+}
+
 static int
 cmp_edge_path(const void *a, const void *b)
 {
@@ -84,6 +109,35 @@ cmp_edge_path(const void *a, const void *b)
     return ret;
 }
 
+/* Orders index changes so that changes to identical edges are adjacent. */
+static int
+cmp_edge_change(const void *a, const void *b)
+{
+    const edge_change_t *ca = (const edge_change_t *) a;
+    const edge_change_t *cb = (const edge_change_t *) b;
+    int ret = cmp_edge_path(&ca->edge, &cb->edge);
+    if (ret == 0) {
+        ret = (ca->removed < cb->removed) - (ca->removed > cb->removed);
+    }
+    return ret;
+}
+
+static int
+cmp_edge_change_left(const void *a, const void *b)
+{
+    const edge_change_t *ca = (const edge_change_t *) a;
+    const edge_change_t *cb = (const edge_change_t *) b;
+    return cmp_edge_left_increasing_time(&ca->edge, &cb->edge);
+}
+
+static int
+cmp_edge_change_right(const void *a, const void *b)
+{
+    const edge_change_t *ca = (const edge_change_t *) a;
+    const edge_change_t *cb = (const edge_change_t *) b;
+    return cmp_edge_right_decreasing_time(&ca->edge, &cb->edge);
+}
+
 static void
 print_edge_path(indexed_edge_t *head, FILE *out)
 {
@@ -164,7 +218,12 @@ tree_sequence_builder_print_state(tree_sequence_builder_t *self, FILE *out)
     fprintf(out, "num_nodes = %d\n", (int) self->num_nodes);
     fprintf(out, "num_edges = %d\n", (int) tree_sequence_builder_get_num_edges(self));
     fprintf(out, "num_match_nodes  = %d\n", (int) self->num_match_nodes);
-    fprintf(out, "num_frozen_edges = %d\n", (int) self->num_edges);
+    fprintf(out, "num_frozen_edges = %d\n", (int) self->frozen->num_edges);
+    fprintf(out, "num_frozen_nodes = %d\n", (int) self->frozen->num_nodes);
+    fprintf(
+        out, "num_checkpoints = %d\n", (int) self->frozen->seek_index.num_checkpoints);
+    fprintf(out, "index_log = %d changes (overflow = %d)\n", (int) self->index_log.size,
+        (int) self->index_log.overflow);
     fprintf(out, "max_nodes = %d\n", (int) self->max_nodes);
     fprintf(out, "nodes_chunk_size = %d\n", (int) self->nodes_chunk_size);
     fprintf(out, "edges_chunk_size = %d\n", (int) self->edges_chunk_size);
@@ -252,6 +311,11 @@ tree_sequence_builder_alloc(tree_sequence_builder_t *self, size_t num_sites,
     avl_init_tree(&self->left_index, cmp_edge_left_increasing_time, NULL);
     avl_init_tree(&self->right_index, cmp_edge_right_decreasing_time, NULL);
     avl_init_tree(&self->path_index, cmp_edge_path, NULL);
+    /* Start with empty frozen indexes */
+    ret = tree_sequence_builder_freeze_indexes(self);
+    if (ret != 0) {
+        goto out;
+    }
 
     for (j = 0; j < num_sites; j++) {
         if (num_alleles == NULL) {
@@ -276,8 +340,9 @@ tree_sequence_builder_free(tree_sequence_builder_t *self)
     tsi_safe_free(self->node_flags);
     tsi_safe_free(self->sites.mutations);
     tsi_safe_free(self->sites.num_alleles);
-    tsi_safe_free(self->left_index_edges);
-    tsi_safe_free(self->right_index_edges);
+    tsi_safe_free(self->index_log.changes);
+    tsi_safe_free(self->mutation_log.changes);
+    frozen_indexes_release(self->frozen);
     tsk_blkalloc_free(&self->tsk_blkalloc);
     object_heap_free(&self->avl_node_heap);
     object_heap_free(&self->edge_heap);
@@ -390,6 +455,35 @@ out:
     return ret;
 }
 
+/* Records an added mutation, so that it can be merged into the frozen
+ * mutations. */
+static int WARN_UNUSED
+tree_sequence_builder_log_mutation(
+    tree_sequence_builder_t *self, tsk_id_t site, tsk_id_t node, allele_t derived_state)
+{
+    int ret = 0;
+    mutation_change_t *tmp;
+    size_t max_size;
+
+    if (self->mutation_log.size == self->mutation_log.max_size) {
+        max_size = TSK_MAX(64, 2 * self->mutation_log.max_size);
+        tmp = realloc(self->mutation_log.changes, max_size * sizeof(*tmp));
+        if (tmp == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+        self->mutation_log.changes = tmp;
+        self->mutation_log.max_size = max_size;
+    }
+    self->mutation_log.changes[self->mutation_log.size].site = site;
+    self->mutation_log.changes[self->mutation_log.size].node = node;
+    self->mutation_log.changes[self->mutation_log.size].derived_state = derived_state;
+    self->mutation_log.changes[self->mutation_log.size].id = self->num_mutations;
+    self->mutation_log.size++;
+out:
+    return ret;
+}
+
 int WARN_UNUSED
 tree_sequence_builder_add_mutation(
     tree_sequence_builder_t *self, tsk_id_t site, tsk_id_t node, allele_t derived_state)
@@ -417,6 +511,10 @@ tree_sequence_builder_add_mutation(
             goto out;
         }
     }
+    ret = tree_sequence_builder_log_mutation(self, site, node, derived_state);
+    if (ret != 0) {
+        goto out;
+    }
 
     list_node = tsk_blkalloc_get(&self->tsk_blkalloc, sizeof(mutation_list_node_t));
     if (list_node == NULL) {
@@ -440,6 +538,44 @@ out:
     return ret;
 }
 
+/* Records a change to the dynamic indexes, so that it can be merged into
+ * the frozen indexes. */
+static int WARN_UNUSED
+tree_sequence_builder_log_index_change(
+    tree_sequence_builder_t *self, const indexed_edge_t *edge, bool removed)
+{
+    int ret = 0;
+    edge_change_t *tmp;
+    size_t max_size;
+
+    if (self->index_log.overflow) {
+        goto out;
+    }
+    if (self->frozen == NULL
+        || self->index_log.size
+               >= TSK_MAX(INDEX_LOG_MIN_SIZE, self->frozen->num_edges)) {
+        /* Merging this many changes is no cheaper than a full rebuild */
+        self->index_log.overflow = true;
+        goto out;
+    }
+    if (self->index_log.size == self->index_log.max_size) {
+        max_size = TSK_MAX(64, 2 * self->index_log.max_size);
+        tmp = realloc(self->index_log.changes, max_size * sizeof(*tmp));
+        if (tmp == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+        self->index_log.changes = tmp;
+        self->index_log.max_size = max_size;
+    }
+    self->index_log.changes[self->index_log.size].edge = *edge;
+    self->index_log.changes[self->index_log.size].edge.next = NULL;
+    self->index_log.changes[self->index_log.size].removed = removed;
+    self->index_log.size++;
+out:
+    return ret;
+}
+
 static int WARN_UNUSED
 tree_sequence_builder_unindex_edge(tree_sequence_builder_t *self, indexed_edge_t *edge)
 {
@@ -460,6 +596,8 @@ tree_sequence_builder_unindex_edge(tree_sequence_builder_t *self, indexed_edge_t
     assert(avl_node != NULL);
     avl_unlink_node(&self->path_index, avl_node);
     tree_sequence_builder_free_avl_node(self, avl_node);
+
+    ret = tree_sequence_builder_log_index_change(self, edge, true);
     return ret;
 }
 
@@ -492,6 +630,8 @@ tree_sequence_builder_index_edge(tree_sequence_builder_t *self, indexed_edge_t *
     }
     avl_node = avl_insert_node(&self->path_index, avl_node);
     assert(avl_node != NULL);
+
+    ret = tree_sequence_builder_log_index_change(self, edge, false);
 out:
     return ret;
 }
@@ -882,49 +1022,395 @@ out:
     return ret;
 }
 
-/* Freeze the tree traversal indexes from the state of the dynamic AVL
- * tree based indexes. This is done because it is *much* more efficient
- * to get the edges sequentially than to find the randomly around memory
- *
- * This also means that edges and mutations added will have no effect
- * on matching *until* freeze_indexes is called.
- */
-int
-tree_sequence_builder_freeze_indexes(tree_sequence_builder_t *self)
+/* Build the seek index by sweeping along the frozen indexes and recording
+ * the set of edges in the tree at regularly spaced insertion positions.
+ * Because each child has at most one edge in any tree, we can keep track
+ * of the edges in the current tree using a child-indexed map into an
+ * unordered array of left_index_edges indexes. */
+static int WARN_UNUSED
+frozen_indexes_build_seek_index(frozen_indexes_t *self)
 {
     int ret = 0;
-    avl_node_t *restrict a;
-    size_t j = 0;
+    const edge_t *restrict in = self->left_index_edges;
+    const edge_t *restrict out = self->right_index_edges;
+    const tsk_id_t M = (tsk_id_t) self->num_edges;
+    const size_t max_checkpoints = 1 + 2 * self->num_edges / SEEK_INDEX_MIN_EVENTS;
+    tsk_id_t *tree_edges = malloc(TSK_MAX(1, self->num_edges) * sizeof(*tree_edges));
+    tsk_id_t *tree_edge_index
+        = malloc(TSK_MAX(1, self->num_nodes) * sizeof(*tree_edge_index));
+    tsk_id_t in_index, out_index, pos, c, last;
+    size_t num_tree_edges, num_events, num_checkpoints, offset;
+
+    self->seek_index.num_checkpoints = 0;
+    self->seek_index.position = malloc(max_checkpoints * sizeof(tsk_id_t));
+    self->seek_index.in_index = malloc(max_checkpoints * sizeof(tsk_id_t));
+    self->seek_index.out_index = malloc(max_checkpoints * sizeof(tsk_id_t));
+    self->seek_index.offset = malloc((max_checkpoints + 1) * sizeof(size_t));
+    self->seek_index.edges = malloc(TSK_MAX(1, 2 * self->num_edges) * sizeof(tsk_id_t));
+    if (tree_edges == NULL || tree_edge_index == NULL
+        || self->seek_index.position == NULL || self->seek_index.in_index == NULL
+        || self->seek_index.out_index == NULL || self->seek_index.offset == NULL
+        || self->seek_index.edges == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+
+    in_index = 0;
+    out_index = 0;
+    num_tree_edges = 0;
+    num_events = 0;
+    num_checkpoints = 0;
+    offset = 0;
+    while (in_index < M) {
+        pos = in[in_index].left;
+        while (out_index < M && out[out_index].right <= pos) {
+            c = out[out_index].child;
+            last = tree_edges[num_tree_edges - 1];
+            tree_edges[tree_edge_index[c]] = last;
+            tree_edge_index[in[last].child] = tree_edge_index[c];
+            num_tree_edges--;
+            out_index++;
+            num_events++;
+        }
+        while (in_index < M && in[in_index].left == pos) {
+            tree_edge_index[in[in_index].child] = (tsk_id_t) num_tree_edges;
+            tree_edges[num_tree_edges] = in_index;
+            num_tree_edges++;
+            in_index++;
+            num_events++;
+        }
+        if (num_events >= SEEK_INDEX_MIN_EVENTS && num_events >= num_tree_edges) {
+            assert(num_checkpoints < max_checkpoints);
+            assert(offset + num_tree_edges <= 2 * self->num_edges);
+            self->seek_index.position[num_checkpoints] = pos;
+            self->seek_index.in_index[num_checkpoints] = in_index;
+            self->seek_index.out_index[num_checkpoints] = out_index;
+            self->seek_index.offset[num_checkpoints] = offset;
+            memcpy(self->seek_index.edges + offset, tree_edges,
+                num_tree_edges * sizeof(*tree_edges));
+            offset += num_tree_edges;
+            num_checkpoints++;
+            num_events = 0;
+        }
+    }
+    self->seek_index.offset[num_checkpoints] = offset;
+    self->seek_index.num_checkpoints = num_checkpoints;
+out:
+    tsi_safe_free(tree_edges);
+    tsi_safe_free(tree_edge_index);
+    return ret;
+}
 
+static void
+frozen_indexes_free(frozen_indexes_t *self)
+{
     tsi_safe_free(self->left_index_edges);
     tsi_safe_free(self->right_index_edges);
-    self->num_edges = avl_count(&self->left_index);
-    assert(self->num_edges == avl_count(&self->right_index));
+    tsi_safe_free(self->seek_index.position);
+    tsi_safe_free(self->seek_index.in_index);
+    tsi_safe_free(self->seek_index.out_index);
+    tsi_safe_free(self->seek_index.offset);
+    tsi_safe_free(self->seek_index.edges);
+    tsi_safe_free(self->mutations.offset);
+    tsi_safe_free(self->mutations.node);
+    tsi_safe_free(self->mutations.derived_state);
+    free(self);
+}
 
-    self->left_index_edges = malloc(self->num_edges * sizeof(*self->left_index_edges));
-    self->right_index_edges = malloc(self->num_edges * sizeof(*self->right_index_edges));
-    if (self->left_index_edges == NULL || self->right_index_edges == NULL) {
-        ret = TSI_ERR_NO_MEMORY;
-        goto out;
+/* Releases a reference to the specified frozen indexes, freeing them
+ * when the last reference has been released. */
+void
+frozen_indexes_release(frozen_indexes_t *self)
+{
+    if (self != NULL) {
+        assert(self->num_references > 0);
+        self->num_references--;
+        if (self->num_references == 0) {
+            frozen_indexes_free(self);
+        }
+    }
+}
+
+/* Returns a new reference to the current frozen indexes, which remain
+ * valid until released even if the builder is subsequently refrozen. */
+frozen_indexes_t *
+tree_sequence_builder_acquire_indexes(tree_sequence_builder_t *self)
+{
+    self->frozen->num_references++;
+    return self->frozen;
+}
+
+/* Returns the index of the last seek index checkpoint at or before the
+ * specified position, or -1 if there is no such checkpoint. */
+tsk_id_t
+frozen_indexes_find_checkpoint(const frozen_indexes_t *self, tsk_id_t position)
+{
+    const tsk_id_t *restrict checkpoint_position = self->seek_index.position;
+    tsk_id_t low = 0;
+    tsk_id_t high = (tsk_id_t) self->seek_index.num_checkpoints;
+    tsk_id_t mid;
+
+    /* Find the first checkpoint with position > the specified position */
+    while (low < high) {
+        mid = low + (high - low) / 2;
+        if (checkpoint_position[mid] <= position) {
+            low = mid + 1;
+        } else {
+            high = mid;
+        }
     }
+    return low - 1;
+}
+
+/* Copy the edges in the dynamic AVL tree indexes into the frozen indexes. */
+static void
+tree_sequence_builder_copy_indexes(
+    tree_sequence_builder_t *self, frozen_indexes_t *frozen)
+{
+    avl_node_t *restrict a;
+    size_t j;
 
     j = 0;
     for (a = self->left_index.head; a != NULL; a = a->next) {
-        self->left_index_edges[j] = ((indexed_edge_t *) a->item)->edge;
+        frozen->left_index_edges[j] = ((indexed_edge_t *) a->item)->edge;
         j++;
     }
     j = 0;
     for (a = self->right_index.head; a != NULL; a = a->next) {
-        self->right_index_edges[j] = ((indexed_edge_t *) a->item)->edge;
+        frozen->right_index_edges[j] = ((indexed_edge_t *) a->item)->edge;
         j++;
     }
+}
+
+/* Apply the specified changes, sorted using the specified comparator, to the
+ * source edges in the same order and write the result to dest. Unchanged runs
+ * of edges are copied in bulk, so the cost is dominated by a binary search
+ * for each change rather than a comparison for each edge. */
+static void
+tree_sequence_builder_merge_index(tree_sequence_builder_t *self, const edge_t *source,
+    size_t num_source, const edge_change_t *changes, size_t num_changes,
+    int (*cmp)(const void *, const void *), edge_t *dest)
+{
+    size_t j, low, high, mid;
+    size_t cursor = 0;
+    size_t num_dest = 0;
+    edge_change_t x;
+
+    for (j = 0; j < num_changes; j++) {
+        /* Find the first source edge not ordered before the change */
+        low = cursor;
+        high = num_source;
+        while (low < high) {
+            mid = low + (high - low) / 2;
+            x.edge.edge = source[mid];
+            x.edge.time = self->time[source[mid].child];
+            if (cmp(&x, &changes[j]) < 0) {
+                low = mid + 1;
+            } else {
+                high = mid;
+            }
+        }
+        memcpy(dest + num_dest, source + cursor, (low - cursor) * sizeof(*dest));
+        num_dest += low - cursor;
+        cursor = low;
+        if (changes[j].removed) {
+            assert(cursor < num_source);
+            x.edge.edge = source[cursor];
+            assert(cmp_edge_path(&x.edge, &changes[j].edge) == 0);
+            cursor++;
+        } else {
+            dest[num_dest] = changes[j].edge.edge;
+            num_dest++;
+        }
+    }
+    memcpy(dest + num_dest, source + cursor, (num_source - cursor) * sizeof(*dest));
+}
+
+/* Build the frozen indexes by merging the changes recorded since the last
+ * freeze into the previously frozen indexes. */
+static void
+tree_sequence_builder_merge_indexes(
+    tree_sequence_builder_t *self, frozen_indexes_t *frozen)
+{
+    const frozen_indexes_t *previous = self->frozen;
+    edge_change_t *changes = self->index_log.changes;
+    size_t j, k, num_changes;
+    int net;
+
+    /* Sort so that changes to the same edge are adjacent, and cancel out
+     * edges that were added and removed since the last freeze. */
+    qsort(changes, self->index_log.size, sizeof(*changes), cmp_edge_change);
+    num_changes = 0;
+    j = 0;
+    while (j < self->index_log.size) {
+        net = 0;
+        for (k = j; k < self->index_log.size
+                    && cmp_edge_path(&changes[k].edge, &changes[j].edge) == 0;
+             k++) {
+            net += changes[k].removed ? -1 : 1;
+        }
+        assert(net >= -1 && net <= 1);
+        if (net != 0) {
+            changes[num_changes] = changes[j];
+            changes[num_changes].removed = net < 0;
+            num_changes++;
+        }
+        j = k;
+    }
+
+    qsort(changes, num_changes, sizeof(*changes), cmp_edge_change_left);
+    tree_sequence_builder_merge_index(self, previous->left_index_edges,
+        previous->num_edges, changes, num_changes, cmp_edge_change_left,
+        frozen->left_index_edges);
+    qsort(changes, num_changes, sizeof(*changes), cmp_edge_change_right);
+    tree_sequence_builder_merge_index(self, previous->right_index_edges,
+        previous->num_edges, changes, num_changes, cmp_edge_change_right,
+        frozen->right_index_edges);
+}
+
+/* Orders mutation changes by site, and then in the order they were added. */
+static int
+cmp_mutation_change(const void *a, const void *b)
+{
+    const mutation_change_t *ca = (const mutation_change_t *) a;
+    const mutation_change_t *cb = (const mutation_change_t *) b;
+    int ret = (ca->site > cb->site) - (ca->site < cb->site);
+    if (ret == 0) {
+        ret = (ca->id > cb->id) - (ca->id < cb->id);
+    }
+    return ret;
+}
+
+/* Build the frozen mutations by inserting the mutations added since the last
+ * freeze after the previously frozen mutations at their sites. Unchanged runs
+ * of mutations are copied in bulk. */
+static void
+tree_sequence_builder_merge_mutations(
+    tree_sequence_builder_t *self, frozen_indexes_t *frozen)
+{
+    const frozen_indexes_t *previous = self->frozen;
+    const mutation_change_t *changes = self->mutation_log.changes;
+    const size_t num_changes = self->mutation_log.size;
+    size_t *offset = frozen->mutations.offset;
+    tsk_id_t *node = frozen->mutations.node;
+    allele_t *derived_state = frozen->mutations.derived_state;
+    size_t site, end, j, k, shift;
+
+    assert(previous->mutations.num_mutations + num_changes
+           == frozen->mutations.num_mutations);
+    qsort(
+        self->mutation_log.changes, num_changes, sizeof(*changes), cmp_mutation_change);
+    site = 0;
+    k = 0;
+    shift = 0;
+    j = 0;
+    while (j < num_changes) {
+        /* The offsets of the sites up to and including this one are shifted
+         * by the number of mutations inserted at earlier sites */
+        for (; site <= (size_t) changes[j].site; site++) {
+            offset[site] = previous->mutations.offset[site] + shift;
+        }
+        end = previous->mutations.offset[site];
+        memcpy(
+            node + k + shift, previous->mutations.node + k, (end - k) * sizeof(*node));
+        memcpy(derived_state + k + shift, previous->mutations.derived_state + k,
+            (end - k) * sizeof(*derived_state));
+        k = end;
+        for (; j < num_changes && (size_t) changes[j].site + 1 == site; j++) {
+            node[k + shift] = changes[j].node;
+            derived_state[k + shift] = changes[j].derived_state;
+            shift++;
+        }
+    }
+    for (; site <= self->num_sites; site++) {
+        offset[site] = previous->mutations.offset[site] + shift;
+    }
+    end = previous->mutations.num_mutations;
+    memcpy(node + k + shift, previous->mutations.node + k, (end - k) * sizeof(*node));
+    memcpy(derived_state + k + shift, previous->mutations.derived_state + k,
+        (end - k) * sizeof(*derived_state));
+}
+
+/* Freeze the tree traversal indexes from the state of the dynamic AVL
+ * tree based indexes. This is done because it is *much* more efficient
+ * to get the edges sequentially than to find the randomly around memory
+ *
+ * The mutations at each site are also copied, so that matchers never read
+ * the builder's mutation lists. This means that edges and mutations added
+ * will have no effect on matching *until* freeze_indexes is called, and that
+ * they can be added while other threads are matching against the frozen
+ * indexes. The previously frozen indexes are released, and remain valid for
+ * any holders of references to them.
+ *
+ * Where possible, we avoid traversing the AVL trees by merging the changes
+ * made since the last freeze into the previously frozen indexes.
+ */
+int
+tree_sequence_builder_freeze_indexes(tree_sequence_builder_t *self)
+{
+    int ret = 0;
+    frozen_indexes_t *frozen = calloc(1, sizeof(*frozen));
+
+    if (frozen == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    frozen->num_references = 1;
+    frozen->num_nodes = self->num_nodes;
+    frozen->max_nodes = self->max_nodes;
+    frozen->num_match_nodes = self->num_match_nodes;
+    frozen->num_edges = avl_count(&self->left_index);
+    assert(frozen->num_edges == avl_count(&self->right_index));
+    frozen->mutations.num_mutations = self->num_mutations;
+
+    frozen->left_index_edges
+        = malloc(TSK_MAX(1, frozen->num_edges) * sizeof(*frozen->left_index_edges));
+    frozen->right_index_edges
+        = malloc(TSK_MAX(1, frozen->num_edges) * sizeof(*frozen->right_index_edges));
+    frozen->mutations.offset
+        = calloc(self->num_sites + 1, sizeof(*frozen->mutations.offset));
+    frozen->mutations.node
+        = malloc(TSK_MAX(1, self->num_mutations) * sizeof(*frozen->mutations.node));
+    frozen->mutations.derived_state = malloc(
+        TSK_MAX(1, self->num_mutations) * sizeof(*frozen->mutations.derived_state));
+    if (frozen->left_index_edges == NULL || frozen->right_index_edges == NULL
+        || frozen->mutations.offset == NULL || frozen->mutations.node == NULL
+        || frozen->mutations.derived_state == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+
+    if (self->frozen == NULL || self->index_log.overflow) {
+        tree_sequence_builder_copy_indexes(self, frozen);
+    } else {
+        tree_sequence_builder_merge_indexes(self, frozen);
+    }
+    if (self->frozen == NULL) {
+        /* The builder has just been allocated, so there are no mutations */
+        assert(self->num_mutations == 0);
+    } else {
+        tree_sequence_builder_merge_mutations(self, frozen);
+    }
+    ret = frozen_indexes_build_seek_index(frozen);
+    if (ret != 0) {
+        goto out;
+    }
+    frozen_indexes_release(self->frozen);
+    self->frozen = frozen;
+    frozen = NULL;
+    self->index_log.size = 0;
+    self->index_log.overflow = false;
+    self->mutation_log.size = 0;
 out:
+    if (frozen != NULL) {
+        frozen_indexes_free(frozen);
+    }
     return ret;
 }
 
 int
-tree_sequence_builder_restore_nodes(
-    tree_sequence_builder_t *self, size_t num_nodes, uint32_t *flags, double *time)
+tree_sequence_builder_restore_nodes(tree_sequence_builder_t *self, size_t num_nodes,
+    const uint32_t *flags, const double *time)
 {
     int ret = -1;
     size_t j;
@@ -942,7 +1428,8 @@ out:
 
 int
 tree_sequence_builder_restore_edges(tree_sequence_builder_t *self, size_t num_edges,
-    tsk_id_t *left, tsk_id_t *right, tsk_id_t *parent, tsk_id_t *child)
+    const tsk_id_t *left, const tsk_id_t *right, const tsk_id_t *parent,
+    const tsk_id_t *child)
 {
     int ret = -1;
     size_t j;
@@ -988,7 +1475,8 @@ out:
 
 int
 tree_sequence_builder_restore_mutations(tree_sequence_builder_t *self,
-    size_t num_mutations, tsk_id_t *site, tsk_id_t *node, allele_t *derived_state)
+    size_t num_mutations, const tsk_id_t *site, const tsk_id_t *node,
+    const allele_t *derived_state)
 {
     int ret = 0;
     size_t j = 0;
@@ -1000,6 +1488,7 @@ tree_sequence_builder_restore_mutations(tree_sequence_builder_t *self,
             goto out;
         }
     }
+    ret = tree_sequence_builder_freeze_indexes(self);
 out:
     return ret;
 }
@@ -1041,6 +1530,123 @@ tree_sequence_builder_dump_edges(tree_sequence_builder_t *self, tsk_id_t *left,
     return ret;
 }
 
+/* Dump the edges in the order required by tskit, i.e., sorted by parent time,
+ * then parent ID, then child ID and then left coordinate. Within each path
+ * the edges are already in left order, so we only need to sort the nodes by
+ * time and then place the edges for each parent in a single counting pass
+ * over the paths in child order. */
+int
+tree_sequence_builder_dump_sorted_edges(tree_sequence_builder_t *self, tsk_id_t *left,
+    tsk_id_t *right, tsk_id_t *parent, tsk_id_t *child)
+{
+    int ret = 0;
+    const size_t num_nodes = self->num_nodes;
+    node_time_t *order = malloc(TSK_MAX(1, num_nodes) * sizeof(*order));
+    size_t *offset = calloc(TSK_MAX(1, num_nodes), sizeof(*offset));
+    size_t j, u, total, count;
+    indexed_edge_t *e;
+
+    if (order == NULL || offset == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    for (u = 0; u < num_nodes; u++) {
+        order[u].time = self->time[u];
+        order[u].node = (tsk_id_t) u;
+        for (e = self->path[u]; e != NULL; e = e->next) {
+            offset[e->edge.parent]++;
+        }
+    }
+    qsort(order, num_nodes, sizeof(*order), cmp_node_time);
+    total = 0;
+    for (j = 0; j < num_nodes; j++) {
+        u = (size_t) order[j].node;
+        count = offset[u];
+        offset[u] = total;
+        total += count;
+    }
+    for (u = 0; u < num_nodes; u++) {
+        for (e = self->path[u]; e != NULL; e = e->next) {
+            j = offset[e->edge.parent];
+            offset[e->edge.parent]++;
+            left[j] = e->edge.left;
+            right[j] = e->edge.right;
+            parent[j] = e->edge.parent;
+            child[j] = e->edge.child;
+        }
+    }
+out:
+    tsi_safe_free(order);
+    tsi_safe_free(offset);
+    return ret;
+}
+
+/* Compute the parent of each mutation, in the order they are dumped, by
+ * sweeping along the edge indexes and walking up the tree at each site
+ * until we find a node with a mutation at that site. */
+static int
+tree_sequence_builder_compute_mutation_parents(
+    tree_sequence_builder_t *self, tsk_id_t *mutation_parent)
+{
+    int ret = 0;
+    const size_t num_nodes = self->num_nodes;
+    tsk_id_t *tree_parent = malloc(TSK_MAX(1, num_nodes) * sizeof(*tree_parent));
+    tsk_id_t *node_mutation = malloc(TSK_MAX(1, num_nodes) * sizeof(*node_mutation));
+    avl_node_t *in = self->left_index.head;
+    avl_node_t *out = self->right_index.head;
+    const indexed_edge_t *edge;
+    mutation_list_node_t *m;
+    tsk_id_t l, u, j, first;
+    size_t k;
+
+    if (tree_parent == NULL || node_mutation == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    for (k = 0; k < num_nodes; k++) {
+        tree_parent[k] = NULL_NODE;
+        node_mutation[k] = TSK_NULL;
+    }
+    j = 0;
+    for (l = 0; l < (tsk_id_t) self->num_sites; l++) {
+        while (out != NULL && ((indexed_edge_t *) out->item)->edge.right <= l) {
+            edge = (indexed_edge_t *) out->item;
+            tree_parent[edge->edge.child] = NULL_NODE;
+            out = out->next;
+        }
+        while (in != NULL && ((indexed_edge_t *) in->item)->edge.left <= l) {
+            edge = (indexed_edge_t *) in->item;
+            tree_parent[edge->edge.child] = edge->edge.parent;
+            in = in->next;
+        }
+        first = j;
+        for (m = self->sites.mutations[l]; m != NULL; m = m->next) {
+            node_mutation[m->node] = j;
+            j++;
+        }
+        j = first;
+        for (m = self->sites.mutations[l]; m != NULL; m = m->next) {
+            mutation_parent[j] = TSK_NULL;
+            for (u = tree_parent[m->node]; u != NULL_NODE; u = tree_parent[u]) {
+                if (node_mutation[u] != TSK_NULL) {
+                    mutation_parent[j] = node_mutation[u];
+                    break;
+                }
+            }
+            j++;
+        }
+        for (m = self->sites.mutations[l]; m != NULL; m = m->next) {
+            node_mutation[m->node] = TSK_NULL;
+        }
+    }
+out:
+    tsi_safe_free(tree_parent);
+    tsi_safe_free(node_mutation);
+    return ret;
+}
+
+/* Dump the mutations in site order. If parent is not NULL, the parent of
+ * each mutation within the dumped mutations is also computed. */
 int
 tree_sequence_builder_dump_mutations(tree_sequence_builder_t *self, tsk_id_t *site,
     tsk_id_t *node, allele_t *derived_state, tsk_id_t *parent)
@@ -1055,12 +1661,239 @@ tree_sequence_builder_dump_mutations(tree_sequence_builder_t *self, tsk_id_t *si
             site[j] = l;
             node[j] = u->node;
             derived_state[j] = u->derived_state;
-            /* For now we don't compute the mutation parent. We'd need to
-             * update the data structures in here to do this. */
-            parent[j] = -1;
             j++;
         }
     }
+    if (parent != NULL) {
+        ret = tree_sequence_builder_compute_mutation_parents(self, parent);
+    }
+    return ret;
+}
+
+/* The offsets of the arrays in a snapshot with the specified header. */
+typedef struct {
+    size_t num_alleles;
+    size_t time;
+    size_t flags;
+    size_t left;
+    size_t right;
+    size_t parent;
+    size_t child;
+    size_t site;
+    size_t node;
+    size_t derived_state;
+    size_t size;
+} snapshot_layout_t;
+
+static size_t
+snapshot_layout_add(size_t *offset, size_t num_items, size_t item_size)
+{
+    size_t ret = *offset;
+
+    *offset = (ret + num_items * item_size + 7) & ~((size_t) 7);
+    return ret;
+}
+
+static void
+snapshot_layout_init(snapshot_layout_t *self, const tsi_snapshot_header_t *header)
+{
+    size_t offset = sizeof(*header);
+
+    self->num_alleles
+        = snapshot_layout_add(&offset, header->num_sites, sizeof(uint32_t));
+    self->time = snapshot_layout_add(&offset, header->num_nodes, sizeof(double));
+    self->flags = snapshot_layout_add(&offset, header->num_nodes, sizeof(uint32_t));
+    self->left = snapshot_layout_add(&offset, header->num_edges, sizeof(tsk_id_t));
+    self->right = snapshot_layout_add(&offset, header->num_edges, sizeof(tsk_id_t));
+    self->parent = snapshot_layout_add(&offset, header->num_edges, sizeof(tsk_id_t));
+    self->child = snapshot_layout_add(&offset, header->num_edges, sizeof(tsk_id_t));
+    self->site = snapshot_layout_add(&offset, header->num_mutations, sizeof(tsk_id_t));
+    self->node = snapshot_layout_add(&offset, header->num_mutations, sizeof(tsk_id_t));
+    self->derived_state
+        = snapshot_layout_add(&offset, header->num_mutations, sizeof(allele_t));
+    self->size = offset;
+}
+
+static const void *
+snapshot_get_array(const void *snapshot, size_t offset)
+{
+    return (const char *) snapshot + offset;
+}
+
+/* Writes the specified array followed by padding up to the next multiple
+ * of 8 bytes. */
+static int WARN_UNUSED
+snapshot_write_array(FILE *file, const void *array, size_t size)
+{
+    int ret = 0;
+    const char padding[8] = { 0 };
+    size_t padding_size = ((size + 7) & ~((size_t) 7)) - size;
+
+    if (fwrite(array, 1, size, file) != size
+        || fwrite(padding, 1, padding_size, file) != padding_size) {
+        ret = TSI_ERR_IO;
+    }
+    return ret;
+}
+
+/* Writes a snapshot of the nodes, edges and mutations in the builder to the
+ * specified file, which can be restored using
+ * tree_sequence_builder_restore_snapshot. */
+int
+tree_sequence_builder_dump_snapshot(tree_sequence_builder_t *self, FILE *file)
+{
+    int ret = 0;
+    tsi_snapshot_header_t header;
+    size_t j;
+    const size_t num_edges = tree_sequence_builder_get_num_edges(self);
+    uint32_t *num_alleles = malloc(TSK_MAX(1, self->num_sites) * sizeof(*num_alleles));
+    uint32_t *flags = malloc(TSK_MAX(1, self->num_nodes) * sizeof(*flags));
+    double *time = malloc(TSK_MAX(1, self->num_nodes) * sizeof(*time));
+    tsk_id_t *left = malloc(TSK_MAX(1, num_edges) * sizeof(*left));
+    tsk_id_t *right = malloc(TSK_MAX(1, num_edges) * sizeof(*right));
+    tsk_id_t *parent = malloc(TSK_MAX(1, num_edges) * sizeof(*parent));
+    tsk_id_t *child = malloc(TSK_MAX(1, num_edges) * sizeof(*child));
+    tsk_id_t *site = malloc(TSK_MAX(1, self->num_mutations) * sizeof(*site));
+    tsk_id_t *node = malloc(TSK_MAX(1, self->num_mutations) * sizeof(*node));
+    allele_t *derived_state
+        = malloc(TSK_MAX(1, self->num_mutations) * sizeof(*derived_state));
+    /* The arrays in the order they are stored in the snapshot */
+    const struct {
+        const void *data;
+        size_t size;
+    } arrays[] = {
+        { num_alleles, self->num_sites * sizeof(*num_alleles) },
+        { time, self->num_nodes * sizeof(*time) },
+        { flags, self->num_nodes * sizeof(*flags) },
+        { left, num_edges * sizeof(*left) },
+        { right, num_edges * sizeof(*right) },
+        { parent, num_edges * sizeof(*parent) },
+        { child, num_edges * sizeof(*child) },
+        { site, self->num_mutations * sizeof(*site) },
+        { node, self->num_mutations * sizeof(*node) },
+        { derived_state, self->num_mutations * sizeof(*derived_state) },
+    };
+
+    if (num_alleles == NULL || flags == NULL || time == NULL || left == NULL
+        || right == NULL || parent == NULL || child == NULL || site == NULL
+        || node == NULL || derived_state == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, TSI_SNAPSHOT_MAGIC, sizeof(TSI_SNAPSHOT_MAGIC));
+    header.version = TSI_SNAPSHOT_VERSION;
+    header.num_sites = self->num_sites;
+    header.num_nodes = self->num_nodes;
+    header.num_edges = num_edges;
+    header.num_mutations = self->num_mutations;
+
+    for (j = 0; j < self->num_sites; j++) {
+        num_alleles[j] = (uint32_t) self->sites.num_alleles[j];
+    }
+    ret = tree_sequence_builder_dump_nodes(self, flags, time);
+    if (ret != 0) {
+        goto out;
+    }
+    ret = tree_sequence_builder_dump_edges(self, left, right, parent, child);
+    if (ret != 0) {
+        goto out;
+    }
+    ret = tree_sequence_builder_dump_mutations(self, site, node, derived_state, NULL);
+    if (ret != 0) {
+        goto out;
+    }
+
+    if (fwrite(&header, sizeof(header), 1, file) != 1) {
+        ret = TSI_ERR_IO;
+        goto out;
+    }
+    for (j = 0; j < sizeof(arrays) / sizeof(*arrays); j++) {
+        ret = snapshot_write_array(file, arrays[j].data, arrays[j].size);
+        if (ret != 0) {
+            goto out;
+        }
+    }
+out:
+    tsi_safe_free(num_alleles);
+    tsi_safe_free(flags);
+    tsi_safe_free(time);
+    tsi_safe_free(left);
+    tsi_safe_free(right);
+    tsi_safe_free(parent);
+    tsi_safe_free(child);
+    tsi_safe_free(site);
+    tsi_safe_free(node);
+    tsi_safe_free(derived_state);
+    return ret;
+}
+
+/* Restores the state of an empty builder from the specified snapshot, which
+ * must remain valid only for the duration of the call. The snapshot is not
+ * modified, so it can be a read-only memory mapping of the snapshot file. */
+int
+tree_sequence_builder_restore_snapshot(
+    tree_sequence_builder_t *self, const void *snapshot, size_t size)
+{
+    int ret = 0;
+    tsi_snapshot_header_t header;
+    snapshot_layout_t layout;
+    const uint32_t *num_alleles;
+    size_t j;
+
+    if (size < sizeof(header)) {
+        ret = TSI_ERR_BAD_SNAPSHOT;
+        goto out;
+    }
+    memcpy(&header, snapshot, sizeof(header));
+    if (memcmp(header.magic, TSI_SNAPSHOT_MAGIC, sizeof(TSI_SNAPSHOT_MAGIC)) != 0
+        || header.version != TSI_SNAPSHOT_VERSION
+        /* Bound the counts so that computing the layout cannot overflow */
+        || header.num_sites > size || header.num_nodes > size || header.num_edges > size
+        || header.num_mutations > size) {
+        ret = TSI_ERR_BAD_SNAPSHOT;
+        goto out;
+    }
+    snapshot_layout_init(&layout, &header);
+    if (layout.size != size) {
+        ret = TSI_ERR_BAD_SNAPSHOT;
+        goto out;
+    }
+    if (header.num_sites != self->num_sites) {
+        ret = TSI_ERR_SNAPSHOT_SITES_MISMATCH;
+        goto out;
+    }
+    num_alleles = snapshot_get_array(snapshot, layout.num_alleles);
+    for (j = 0; j < self->num_sites; j++) {
+        if (num_alleles[j] != self->sites.num_alleles[j]) {
+            ret = TSI_ERR_SNAPSHOT_SITES_MISMATCH;
+            goto out;
+        }
+    }
+    if (self->num_nodes != 0) {
+        ret = TSI_ERR_SNAPSHOT_NONEMPTY_BUILDER;
+        goto out;
+    }
+
+    ret = tree_sequence_builder_restore_nodes(self, header.num_nodes,
+        snapshot_get_array(snapshot, layout.flags),
+        snapshot_get_array(snapshot, layout.time));
+    if (ret != 0) {
+        goto out;
+    }
+    ret = tree_sequence_builder_restore_edges(self, header.num_edges,
+        snapshot_get_array(snapshot, layout.left),
+        snapshot_get_array(snapshot, layout.right),
+        snapshot_get_array(snapshot, layout.parent),
+        snapshot_get_array(snapshot, layout.child));
+    if (ret != 0) {
+        goto out;
+    }
+    ret = tree_sequence_builder_restore_mutations(self, header.num_mutations,
+        snapshot_get_array(snapshot, layout.site),
+        snapshot_get_array(snapshot, layout.node),
+        snapshot_get_array(snapshot, layout.derived_state));
+out:
     return ret;
 }
 
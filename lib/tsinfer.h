@@ -45,6 +45,9 @@
 
 #define TSI_NODE_IS_PC_ANCESTOR ((tsk_flags_t)(1u << 16))
 
+#define TSI_SNAPSHOT_MAGIC "tsisnap"
+#define TSI_SNAPSHOT_VERSION 1
+
 typedef int8_t allele_t;
 
 typedef struct {
@@ -54,12 +57,48 @@ typedef struct {
     tsk_id_t child;
 } edge_t;
 
+typedef struct {
+    double time;
+    tsk_id_t node;
+} node_time_t;
+
 typedef struct _indexed_edge_t {
     edge_t edge;
     double time;
     struct _indexed_edge_t *next;
 } indexed_edge_t;
 
+/* The header of a tree sequence builder snapshot. It is followed by the
+ * num_alleles (uint32), node time (float64) and flags (uint32), edge left, right,
+ * parent and child (int32), and mutation site, node (int32) and derived_state
+ * (int8) arrays, each starting at a multiple of 8 bytes from the start of the
+ * snapshot. Edges are sorted by child and left, and mutations by site in the
+ * order they were added. Values are in native byte order, so that a snapshot
+ * can be used directly from a memory mapped file. */
+typedef struct {
+    char magic[8];
+    uint32_t version;
+    uint32_t flags;
+    uint64_t num_sites;
+    uint64_t num_nodes;
+    uint64_t num_edges;
+    uint64_t num_mutations;
+} tsi_snapshot_header_t;
+
+/* An edge added to or removed from the builder's indexes. */
+typedef struct {
+    indexed_edge_t edge;
+    bool removed;
+} edge_change_t;
+
+/* A mutation added to the builder. The id is the order in which it was added. */
+typedef struct {
+    tsk_id_t site;
+    tsk_id_t node;
+    allele_t derived_state;
+    size_t id;
+} mutation_change_t;
+
 typedef struct _node_segment_list_node_t {
     tsk_id_t start;
     tsk_id_t end;
@@ -124,17 +163,65 @@ typedef struct {
     size_t mmap_size;
 } ancestor_builder_t;
 
+/* Scratch buffers used when making an ancestor. A workspace can be reused for
+ * any number of calls to ancestor_builder_make_ancestor, but must not be
+ * shared between threads. The disagree flags are all false between calls.
+ * With one-bit genotype encoding the sample set and disagree flags are held
+ * instead as bitsets of num_words words, in the same layout as the encoded
+ * genotypes, and the other buffers are not allocated. */
+typedef struct {
+    size_t num_samples;
+    tsk_id_t *sample_set;
+    bool *disagree;
+    allele_t *genotypes;
+    size_t num_words;
+    uint64_t *sample_bitset;
+    uint64_t *disagree_bitset;
+} ancestor_builder_workspace_t;
+
 typedef struct _mutation_list_node_t {
     tsk_id_t node;
     allele_t derived_state;
     struct _mutation_list_node_t *next;
 } mutation_list_node_t;
 
+/* The static tree generation indexes. We populate these at the end of each
+ * epoch using the order defined by the builder's AVL trees. Along with the
+ * edges we keep checkpoints of the tree state, so that we can seek directly
+ * to the tree at a given site. Checkpoint j is at site position[j], and
+ * records the positions in the edge indexes along with the left_index_edges
+ * in the tree, which are stored in edges[offset[j]:offset[j + 1]].
+ *
+ * The numbers of nodes and match nodes in the builder at the time are also
+ * recorded, along with the mutations at each site in the order they were
+ * added, so that the indexes are a self-contained snapshot for matching.
+ * The mutations at site j are node[offset[j]:offset[j + 1]] and
+ * derived_state[offset[j]:offset[j + 1]].
+ * Matchers can hold a reference to a snapshot while the builder is modified
+ * and refrozen; it is freed when the last reference is released. */
 typedef struct {
-    int32_t size;
-    tsk_id_t *node;
-    int8_t *recombination_required;
-} node_state_list_t;
+    edge_t *left_index_edges;
+    edge_t *right_index_edges;
+    size_t num_edges;
+    size_t num_nodes;
+    size_t max_nodes;
+    size_t num_match_nodes;
+    struct {
+        tsk_id_t *position;
+        tsk_id_t *in_index;
+        tsk_id_t *out_index;
+        size_t *offset;
+        tsk_id_t *edges;
+        size_t num_checkpoints;
+    } seek_index;
+    struct {
+        size_t *offset;
+        tsk_id_t *node;
+        allele_t *derived_state;
+        size_t num_mutations;
+    } mutations;
+    size_t num_references;
+} frozen_indexes_t;
 
 typedef struct {
     int flags;
@@ -162,21 +249,47 @@ typedef struct {
     avl_tree_t left_index;
     avl_tree_t right_index;
     avl_tree_t path_index;
-    /* The static tree generation indexes. We populate these at the end of each
-     * epoch using the order defined by the AVL trees. */
-    edge_t *left_index_edges;
-    edge_t *right_index_edges;
-    size_t num_edges; /* the number of edges in the frozen indexes */
+    /* The indexes as of the last call to freeze_indexes */
+    frozen_indexes_t *frozen;
+    /* The changes to the dynamic indexes since the last call to freeze_indexes,
+     * which are merged into the frozen indexes when they are next frozen. If
+     * there are too many changes for this to be worthwhile we stop recording
+     * them and rebuild the frozen indexes from the AVL trees instead. */
+    struct {
+        edge_change_t *changes;
+        size_t size;
+        size_t max_size;
+        bool overflow;
+    } index_log;
+    /* The mutations added since the last call to freeze_indexes, which are
+     * merged into the frozen mutations when they are next frozen. */
+    struct {
+        mutation_change_t *changes;
+        size_t size;
+        size_t max_size;
+    } mutation_log;
 } tree_sequence_builder_t;
 
 typedef struct {
     int flags;
     tree_sequence_builder_t *tree_sequence_builder;
+    /* The frozen indexes to match against. If NULL, the builder's current
+     * indexes are used; otherwise the caller must hold a reference to them
+     * for the duration of the match. */
+    frozen_indexes_t *indexes;
+    /* If nonzero, overrides the number of match nodes recorded in the
+     * indexes when computing the recombination probabilities. */
+    size_t num_match_nodes;
+    /* The indexes and number of match nodes used for the current match */
+    const frozen_indexes_t *match_indexes;
+    double match_num_match_nodes;
     size_t num_nodes;
     size_t num_sites;
     size_t max_nodes;
     /* Input LS model rates */
     unsigned int precision;
+    /* 10^precision, or zero if the precision is too large to have an effect */
+    double precision_scale;
     double *recombination_rate;
     double *mismatch_rate;
     /* The quintuply linked tree */
@@ -188,6 +301,8 @@ typedef struct {
     double *likelihood;
     double *likelihood_cache;
     allele_t *allelic_state;
+    /* Nodes whose allelic state was filled in during a likelihood update. */
+    tsk_id_t *allelic_state_path;
     int num_likelihood_nodes;
     /* At each site, record a node with the maximum likelihood. */
     tsk_id_t *max_likelihood_node;
@@ -195,11 +310,28 @@ typedef struct {
     int8_t *recombination_required;
     tsk_id_t *likelihood_nodes_tmp;
     tsk_id_t *likelihood_nodes;
-    node_state_list_t *traceback;
-    tsk_blkalloc_t traceback_allocator;
+    /* The traceback is stored as the changes in each node's recombination_required
+     * state from one site to the next. The changes for site j are in
+     * [offset[j], offset[j + 1]), and each records the node along with its old
+     * and new states packed into a single byte. */
+    struct {
+        tsk_id_t *node;
+        int8_t *state;
+        size_t *offset;
+        size_t size;
+        size_t max_size;
+        tsk_id_t start;
+        tsk_id_t end;
+    } traceback;
+    /* The recombination_required state of each node at the current site, and
+     * the nodes with a non-null state. */
+    int8_t *traceback_state;
+    tsk_id_t *traceback_nodes;
+    int num_traceback_nodes;
     size_t total_traceback_size;
-    size_t traceback_block_size;
     size_t traceback_realloc_size;
+    /* If nonzero, the maximum number of bytes used to store the traceback. */
+    size_t traceback_memory_limit;
     struct {
         tsk_id_t *left;
         tsk_id_t *right;
@@ -215,11 +347,16 @@ int ancestor_builder_free(ancestor_builder_t *self);
 int ancestor_builder_print_state(ancestor_builder_t *self, FILE *out);
 int ancestor_builder_add_site(
     ancestor_builder_t *self, double time, allele_t *genotypes);
+int ancestor_builder_add_sites(
+    ancestor_builder_t *self, size_t num_sites, double *time, allele_t *genotypes);
 int ancestor_builder_finalise(ancestor_builder_t *self);
 int ancestor_builder_make_ancestor(const ancestor_builder_t *self,
     size_t num_focal_sites, const tsk_id_t *focal_sites, tsk_id_t *start, tsk_id_t *end,
-    allele_t *haplotype);
+    allele_t *haplotype, ancestor_builder_workspace_t *workspace);
 size_t ancestor_builder_get_memsize(const ancestor_builder_t *self);
+int ancestor_builder_workspace_alloc(
+    ancestor_builder_workspace_t *self, const ancestor_builder_t *builder);
+int ancestor_builder_workspace_free(ancestor_builder_workspace_t *self);
 
 int ancestor_matcher_alloc(ancestor_matcher_t *self,
     tree_sequence_builder_t *tree_sequence_builder, double *recombination_rate,
@@ -231,6 +368,9 @@ int ancestor_matcher_find_path(ancestor_matcher_t *self, tsk_id_t start, tsk_id_
 int ancestor_matcher_print_state(ancestor_matcher_t *self, FILE *out);
 double ancestor_matcher_get_mean_traceback_size(ancestor_matcher_t *self);
 size_t ancestor_matcher_get_total_memory(ancestor_matcher_t *self);
+void ancestor_matcher_set_traceback_memory_limit(ancestor_matcher_t *self, size_t limit);
+int ancestor_matcher_get_traceback(
+    ancestor_matcher_t *self, tsk_id_t site, int8_t *recombination_required);
 
 int tree_sequence_builder_alloc(tree_sequence_builder_t *self, size_t num_sites,
     tsk_size_t *num_alleles, size_t nodes_chunk_size, size_t edges_chunk_size,
@@ -246,28 +386,39 @@ int tree_sequence_builder_add_mutation(
 int tree_sequence_builder_add_mutations(tree_sequence_builder_t *self, tsk_id_t node,
     size_t num_mutations, tsk_id_t *site, allele_t *derived_state);
 int tree_sequence_builder_freeze_indexes(tree_sequence_builder_t *self);
+frozen_indexes_t *tree_sequence_builder_acquire_indexes(tree_sequence_builder_t *self);
+void frozen_indexes_release(frozen_indexes_t *self);
+tsk_id_t frozen_indexes_find_checkpoint(const frozen_indexes_t *self, tsk_id_t position);
 
 size_t tree_sequence_builder_get_num_nodes(tree_sequence_builder_t *self);
 size_t tree_sequence_builder_get_num_edges(tree_sequence_builder_t *self);
 size_t tree_sequence_builder_get_num_mutations(tree_sequence_builder_t *self);
 
 /* Restore the state of a previous tree sequence builder. */
-int tree_sequence_builder_restore_nodes(
-    tree_sequence_builder_t *self, size_t num_nodes, uint32_t *flags, double *time);
+int tree_sequence_builder_restore_nodes(tree_sequence_builder_t *self, size_t num_nodes,
+    const uint32_t *flags, const double *time);
 int tree_sequence_builder_restore_edges(tree_sequence_builder_t *self, size_t num_edges,
-    tsk_id_t *left, tsk_id_t *right, tsk_id_t *parent, tsk_id_t *child);
+    const tsk_id_t *left, const tsk_id_t *right, const tsk_id_t *parent,
+    const tsk_id_t *child);
 int tree_sequence_builder_restore_mutations(tree_sequence_builder_t *self,
-    size_t num_mutations, tsk_id_t *site, tsk_id_t *node, allele_t *derived_state);
+    size_t num_mutations, const tsk_id_t *site, const tsk_id_t *node,
+    const allele_t *derived_state);
+int tree_sequence_builder_restore_snapshot(
+    tree_sequence_builder_t *self, const void *snapshot, size_t size);
 
 /* Dump the state */
 int tree_sequence_builder_dump_nodes(
     tree_sequence_builder_t *self, uint32_t *flags, double *time);
 int tree_sequence_builder_dump_edges(tree_sequence_builder_t *self, tsk_id_t *left,
     tsk_id_t *right, tsk_id_t *parent, tsk_id_t *children);
+int tree_sequence_builder_dump_sorted_edges(tree_sequence_builder_t *self,
+    tsk_id_t *left, tsk_id_t *right, tsk_id_t *parent, tsk_id_t *child);
 int tree_sequence_builder_dump_mutations(tree_sequence_builder_t *self, tsk_id_t *site,
     tsk_id_t *node, allele_t *derived_state, tsk_id_t *parent);
+int tree_sequence_builder_dump_snapshot(tree_sequence_builder_t *self, FILE *file);
 
 int packbits(const allele_t *restrict source, size_t len, uint8_t *restrict dest);
+double tsi_round(double x, unsigned int ndigits);
 void unpackbits(const uint8_t *restrict source, size_t len, allele_t *restrict dest);
 
 #define tsi_safe_free(pointer)                                                          \
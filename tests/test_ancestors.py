@@ -20,12 +20,17 @@
 Tests for the ancestor handling code.
 """
 import itertools
+import logging
+import time as time_
 
+import numba
 import numpy as np
 import pytest
 
 from tsinfer import ancestors
 
+logger = logging.getLogger(__name__)
+
 
 class TestGroupAncestorsLinesweep:
     merging_fixed_test_cases = [
@@ -151,7 +156,7 @@ class TestGroupAncestorsLinesweep:
             new_start,
             new_end,
             new_time,
-            old_indexes,
+            old_offsets,
             sort_indices,
         ) = ancestors.merge_overlapping_ancestors(
             np.array(case["start"]),
@@ -161,6 +166,11 @@ class TestGroupAncestorsLinesweep:
         assert list(new_start) == case["new_start"]
         assert list(new_end) == case["new_end"]
         assert list(new_time) == case["new_time"]
+        assert len(old_offsets) == len(new_start) + 1
+        old_indexes = {
+            j: list(range(old_offsets[j], old_offsets[j + 1]))
+            for j in range(len(new_start))
+        }
         assert old_indexes == case["old_indexes"]
         assert list(sort_indices) == case["sort_indices"]
 
@@ -274,3 +284,220 @@ class TestGroupAncestorsLinesweep:
                     assert group_ids[anc_a] > group_ids[anc_b]
                 else:
                     assert group_ids[anc_a] < group_ids[anc_b]
+
+    @pytest.mark.parametrize("seed", range(50))
+    def test_grouping_longest_path(self, seed):
+        # Each ancestor's group is the length of the longest chain of overlapping,
+        # successively younger ancestors that ends with it, where overlapping
+        # same-age ancestors are treated as one.
+        rng = np.random.RandomState(seed)
+        n = 100
+        start = rng.randint(0, 200, size=n)
+        end = start + rng.randint(1, 100, size=n)
+        time = rng.randint(0, 40, size=n)
+        output = ancestors.group_ancestors_by_linesweep(start, end, time)
+        group_ids = np.full(n, -1, dtype=np.int32)
+        for group_id, group in output.items():
+            group_ids[group] = group_id
+        unit = np.full(n, -1, dtype=np.int32)
+        num_units = 0
+        for t in np.unique(time):
+            max_right = -1
+            for j in sorted(np.where(time == t)[0], key=lambda j: start[j]):
+                if start[j] >= max_right:
+                    num_units += 1
+                unit[j] = num_units - 1
+                max_right = max(max_right, end[j])
+        depth = np.zeros(num_units, dtype=np.int32)
+        for t in np.unique(time)[::-1]:
+            for j in np.where(time == t)[0]:
+                older = (time > t) & (start < end[j]) & (start[j] < end)
+                if np.any(older):
+                    depth[unit[j]] = max(depth[unit[j]], 1 + np.max(depth[unit[older]]))
+        np.testing.assert_array_equal(group_ids, depth[unit])
+
+
+@numba.njit
+def find_groups_by_scan(children_data, children_indices, incoming_edge_count):
+    # The original implementation of find_groups, which scans all the nodes for
+    # each group. Used as a reference and benchmark baseline.
+    n = len(children_indices) - 1
+    group_id = np.full(n, -1, dtype=np.int32)
+    current_group = 0
+    while True:
+        no_incoming = np.where(incoming_edge_count == 0)[0]
+        if len(no_incoming) == 0:
+            break
+        for i in no_incoming:
+            incoming_edge_count[i] = -1
+            incoming_edge_count[
+                children_data[children_indices[i] : children_indices[i + 1]]
+            ] -= 1
+        group_id[no_incoming] = current_group
+        current_group += 1
+    return group_id
+
+
+class TestFindGroups:
+    def synthetic_ancestors(self, n, num_sites, seed):
+        # Older ancestors are longer, as in real data.
+        rng = np.random.RandomState(seed)
+        time = rng.randint(1, n // 10 + 2, size=n).astype(np.float64)
+        length = num_sites * (time / np.max(time)) ** 2 * rng.uniform(0.5, 1, size=n)
+        start = rng.randint(0, num_sites, size=n)
+        end = np.minimum(start + length.astype(np.int64) + 1, num_sites)
+        return start, end, time
+
+    def linesweep_graph(self, start, end, time):
+        new_start, new_end, new_time, _, _ = ancestors.merge_overlapping_ancestors(
+            start, end, time
+        )
+        n = len(new_time)
+        event_times = np.concatenate([new_time, new_time])
+        event_pos = np.concatenate([new_start, new_end])
+        event_index = np.concatenate([np.arange(n), np.arange(n)])
+        event_type = np.concatenate(
+            [np.ones(n, dtype=np.int8), np.zeros(n, dtype=np.int8)]
+        )
+        order = np.lexsort((event_type, event_pos))
+        return ancestors.run_linesweep(
+            event_times[order], event_index[order], event_type[order], new_time
+        )
+
+    def verify(self, children_data, children_indices, incoming_edge_count):
+        expected = find_groups_by_scan(
+            children_data, children_indices, incoming_edge_count.copy()
+        )
+        group_id = ancestors.find_groups(
+            children_data, children_indices, incoming_edge_count.copy()
+        )
+        np.testing.assert_array_equal(group_id, expected)
+        return group_id
+
+    def test_empty(self):
+        group_id = self.verify(
+            np.zeros(0, dtype=np.int32),
+            np.zeros(1, dtype=np.int32),
+            np.zeros(0, dtype=np.int32),
+        )
+        assert len(group_id) == 0
+
+    def test_chain(self):
+        group_id = self.verify(
+            np.array([1, 2, 3], dtype=np.int32),
+            np.array([0, 1, 2, 3, 3], dtype=np.int32),
+            np.array([0, 1, 1, 1], dtype=np.int32),
+        )
+        assert list(group_id) == [0, 1, 2, 3]
+
+    def test_diamond(self):
+        group_id = self.verify(
+            np.array([1, 2, 3, 3, 2], dtype=np.int32),
+            np.array([0, 2, 3, 4, 4, 5], dtype=np.int32),
+            np.array([0, 1, 2, 2, 0], dtype=np.int32),
+        )
+        assert list(group_id) == [0, 1, 1, 2, 0]
+
+    def test_cycle_not_grouped(self):
+        group_id = self.verify(
+            np.array([1, 2, 1], dtype=np.int32),
+            np.array([0, 1, 2, 3], dtype=np.int32),
+            np.array([0, 2, 1], dtype=np.int32),
+        )
+        assert list(group_id) == [0, -1, -1]
+
+    @pytest.mark.parametrize("seed", range(20))
+    def test_synthetic(self, seed):
+        graph = self.linesweep_graph(*self.synthetic_ancestors(500, 1000, seed))
+        self.verify(*graph)
+
+    @pytest.mark.parametrize("seed", range(20))
+    def test_linesweep_graph_closure(self, seed):
+        # The linesweep graph has at most two edges per ancestor, and it has the
+        # same transitive closure as the full older-to-younger overlap relation.
+        rng = np.random.RandomState(seed)
+        n = 80
+        start = rng.randint(0, 100, size=n)
+        end = start + rng.randint(1, 50, size=n)
+        time = rng.randint(0, 20, size=n).astype(np.float64)
+        new_start, new_end, new_time, _, _ = ancestors.merge_overlapping_ancestors(
+            start, end, time
+        )
+        children_data, children_indices, incoming_edge_count = self.linesweep_graph(
+            start, end, time
+        )
+        m = len(new_time)
+        assert len(children_data) <= 2 * m
+        assert np.sum(incoming_edge_count) == len(children_data)
+        reachable = np.zeros((m, m), dtype=bool)
+        for j in range(m):
+            reachable[
+                j, children_data[children_indices[j] : children_indices[j + 1]]
+            ] = 1
+        expected = (
+            (new_start[:, None] < new_end[None, :])
+            & (new_start[None, :] < new_end[:, None])
+            & (new_time[:, None] > new_time[None, :])
+        )
+        assert np.all(expected[reachable])
+        for k in range(m):
+            reachable |= reachable[:, k : k + 1] & reachable[k : k + 1, :]
+            expected |= expected[:, k : k + 1] & expected[k : k + 1, :]
+        assert np.array_equal(reachable, expected)
+
+    @pytest.mark.slow
+    def test_benchmark(self):
+        graph = self.linesweep_graph(*self.synthetic_ancestors(100_000, 100_000, 1))
+        # Warm up the JIT
+        self.verify(*self.linesweep_graph(*self.synthetic_ancestors(100, 100, 1)))
+        timings = {}
+        results = {}
+        for func in [find_groups_by_scan, ancestors.find_groups]:
+            before = time_.perf_counter()
+            results[func.__name__] = func(graph[0], graph[1], graph[2].copy())
+            timings[func.__name__] = time_.perf_counter() - before
+        group_id = results["find_groups"]
+        # Timings are only logged: wall-clock comparisons are too noisy to
+        # assert on in CI.
+        logger.info(
+            f"find_groups on {len(group_id)} ancestors in {np.max(group_id) + 1} "
+            f"groups: {timings}"
+        )
+        assert np.max(group_id) > 100
+        assert np.array_equal(group_id, results["find_groups_by_scan"])
+
+
+class TestFindDependencyGroups:
+    def verify(self, start, end, group, num_sites):
+        start = np.array(start, dtype=np.int32)
+        end = np.array(end, dtype=np.int32)
+        group = np.array(group, dtype=np.int32)
+        dependency = ancestors.find_dependency_groups(start, end, group, num_sites)
+        assert dependency.shape == start.shape
+        for j in range(len(start)):
+            expected = -1
+            for k in range(len(start)):
+                if group[k] < group[j] and start[k] < end[j] and start[j] < end[k]:
+                    expected = max(expected, group[k])
+            assert dependency[j] == expected
+        return dependency
+
+    def test_empty(self):
+        self.verify([], [], [], 10)
+
+    def test_single_site(self):
+        assert list(self.verify([0, 0, 0], [1, 1, 1], [0, 1, 1], 1)) == [-1, 0, 0]
+
+    def test_skips_non_overlapping_groups(self):
+        dependency = self.verify([0, 5, 0, 2], [5, 10, 2, 4], [0, 1, 2, 3], 10)
+        assert list(dependency) == [-1, -1, 0, 0]
+
+    @pytest.mark.parametrize("seed", range(50))
+    def test_random_cases(self, seed):
+        rng = np.random.RandomState(seed)
+        n = 60
+        num_sites = rng.randint(1, 100)
+        start = rng.randint(0, num_sites, size=n)
+        end = start + 1 + rng.randint(0, num_sites - start)
+        group = np.sort(rng.randint(0, 10, size=n))
+        self.verify(start, end, group, num_sites)
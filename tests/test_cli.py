@@ -200,6 +200,7 @@ class TestCommandsDefaults(TestCli):
         output_trees = os.path.join(self.tempdir.name, "output.trees")
         self.run_command(["infer", self.sample_file, "-O", output_trees])
         self.run_command(["verify", self.sample_file, output_trees])
+        self.run_command(["verify", self.sample_file, output_trees, "-t", "2"])
 
     @pytest.mark.skipif(
         sys.platform == "win32",
@@ -41,6 +41,7 @@ from tskit import MetadataSchema
 import tsinfer
 import tsinfer.exceptions as exceptions
 import tsinfer.formats as formats
+import tsinfer.threads as threads
 
 IS_WINDOWS = sys.platform == "win32"
 
@@ -2532,6 +2533,73 @@ class TestAncestorData(DataContainerMixin):
         )
 
 
+class TestChunkIterator:
+    """
+    Tests for the chunk iterator and its read-ahead of chunks.
+    """
+
+    def make_array(self, shape=(23, 11, 2), chunks=(4, 3, 2)):
+        data = np.arange(np.prod(shape), dtype=np.int32).reshape(shape)
+        return data, zarr.array(data, chunks=chunks)
+
+    @pytest.mark.parametrize("prefetch", [0, 1, 2, 10])
+    @pytest.mark.parametrize("dimension", [0, 1])
+    def test_all_rows(self, prefetch, dimension):
+        data, array = self.make_array()
+        rows = list(
+            formats.chunk_iterator(array, dimension=dimension, prefetch=prefetch)
+        )
+        assert len(rows) == data.shape[dimension]
+        for j, row in enumerate(rows):
+            expected = data[j] if dimension == 0 else data[:, j]
+            np.testing.assert_array_equal(row, expected)
+
+    @pytest.mark.parametrize("prefetch", [0, 1, 3])
+    def test_indexes_and_select(self, prefetch):
+        data, array = self.make_array()
+        select = np.arange(data.shape[0]) % 3 != 0
+        orthogonal_select = np.arange(data.shape[1]) % 2 == 0
+        indexes = np.array([0, 1, 5, 6, 7, 13])
+        rows = list(
+            formats.chunk_iterator(
+                array,
+                indexes=indexes,
+                select=select,
+                orthogonal_select=orthogonal_select,
+                prefetch=prefetch,
+            )
+        )
+        expected = data[select][indexes][:, orthogonal_select]
+        np.testing.assert_array_equal(np.array(rows), expected)
+
+    def test_prefetch_memory_budget(self):
+        data, array = self.make_array()
+        # A budget smaller than a chunk reads synchronously
+        rows = list(formats.chunk_iterator(array, prefetch=4, prefetch_memory=1))
+        np.testing.assert_array_equal(np.array(rows), data)
+
+    def test_stop_early(self):
+        data, array = self.make_array()
+        rows = formats.chunk_iterator(array, prefetch=4)
+        np.testing.assert_array_equal(next(rows), data[0])
+        rows.close()
+
+    @pytest.mark.parametrize("num_prefetch", [0, 1, 2, 20])
+    def test_prefetch_map(self, num_prefetch):
+        args = list(range(10))
+        result = list(threads.prefetch_map(lambda x: x * x, args, num_prefetch))
+        assert result == [x * x for x in args]
+
+    def test_prefetch_map_error(self):
+        def func(x):
+            if x == 3:
+                raise ValueError("bad arg")
+            return x
+
+        with pytest.raises(ValueError, match="bad arg"):
+            list(threads.prefetch_map(func, range(10), 2))
+
+
 class BufferedItemWriterMixin:
     """
     Tests to ensure that the buffered item writer works as expected.
@@ -42,6 +42,7 @@ from tskit import MetadataSchema
 import _tsinfer
 import tsinfer
 import tsinfer.eval_util as eval_util
+import tsinfer.inference as inference
 
 IS_WINDOWS = sys.platform == "win32"
 
@@ -1364,6 +1365,120 @@ class TestThreads:
         assert ts1.equals(ts2, ignore_provenance=True)
 
 
+class TestDataflowAncestorMatching:
+    """
+    Tests for matching ancestors without barriers between the groups.
+    """
+
+    def get_example(self):
+        ts = msprime.simulate(
+            10, mutation_rate=5, recombination_rate=5, length=5, random_seed=4
+        )
+        return tsinfer.SampleData.from_tree_sequence(ts)
+
+    @pytest.mark.parametrize("engine", [tsinfer.C_ENGINE, tsinfer.PY_ENGINE])
+    @pytest.mark.parametrize("num_threads", [1, 2, 5])
+    def test_equivalance(self, engine, num_threads):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        ts1 = tsinfer.match_ancestors(sample_data, ancestor_data, dataflow=True)
+        ts2 = tsinfer.match_ancestors(
+            sample_data,
+            ancestor_data,
+            num_threads=num_threads,
+            engine=engine,
+            dataflow=True,
+        )
+        assert ts1.equals(ts2, ignore_provenance=True)
+
+    @pytest.mark.parametrize("num_threads", [2, 4])
+    def test_threaded_deterministic(self, num_threads):
+        # Groups are completed, and their mutations added to the builder, while
+        # the worker threads are matching later groups, so repeated runs catch
+        # any matches that see mutations from outside their frozen indexes.
+        ts = msprime.simulate(
+            30, mutation_rate=10, recombination_rate=10, length=10, random_seed=7
+        )
+        sample_data = tsinfer.SampleData.from_tree_sequence(ts)
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        ts1 = tsinfer.match_ancestors(sample_data, ancestor_data, dataflow=True)
+        for _ in range(5):
+            ts2 = tsinfer.match_ancestors(
+                sample_data, ancestor_data, num_threads=num_threads, dataflow=True
+            )
+            assert ts1.equals(ts2, ignore_provenance=True)
+
+    @pytest.mark.parametrize("num_threads", [0, 3])
+    def test_verify(self, num_threads):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        ancestors_ts = tsinfer.match_ancestors(
+            sample_data, ancestor_data, num_threads=num_threads, dataflow=True
+        )
+        assert ancestors_ts.num_nodes >= ancestor_data.num_ancestors
+        ts = tsinfer.match_samples(sample_data, ancestors_ts)
+        tsinfer.verify(sample_data, ts)
+
+    def test_groups_inserted_in_order(self):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        matcher = tsinfer.AncestorMatcher(sample_data, ancestor_data, num_threads=2)
+        grouping = matcher.group_by_linesweep()
+        assert len(grouping) > 2
+        with mock.patch.object(
+            matcher,
+            "_AncestorMatcher__complete_group",
+            wraps=matcher._AncestorMatcher__complete_group,
+        ) as complete_group:
+            matcher.match_ancestors(grouping, dataflow=True)
+        calls = complete_group.call_args_list
+        assert [call.args[0] for call in calls] == list(grouping.keys())
+        for call, ancestor_ids in zip(calls, grouping.values()):
+            assert list(call.args[1]) == list(ancestor_ids)
+            assert [result.node for result in call.args[2]] == list(ancestor_ids)
+
+
+class TestGroupByLinesweep:
+    def get_matcher(self):
+        ts = msprime.simulate(
+            20, mutation_rate=5, recombination_rate=5, length=5, random_seed=6
+        )
+        sample_data = tsinfer.SampleData.from_tree_sequence(ts)
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        return tsinfer.AncestorMatcher(sample_data, ancestor_data)
+
+    def verify_grouping(self, matcher, grouping):
+        start = matcher.ancestor_data.ancestors_start[:]
+        end = matcher.ancestor_data.ancestors_end[:]
+        time = matcher.ancestor_data.ancestors_time[:]
+        group_ids = np.full(matcher.num_ancestors, -1)
+        for group_index, ancestor_ids in enumerate(grouping.values()):
+            assert np.all(group_ids[ancestor_ids] == -1)
+            group_ids[ancestor_ids] = group_index
+        assert group_ids[0] == -1
+        assert np.all(group_ids[1:] >= 0)
+        for j in range(1, matcher.num_ancestors):
+            older = (time > time[j]) & (start < end[j]) & (start[j] < end)
+            older[0] = False
+            assert np.all(group_ids[older] < group_ids[j])
+
+    @pytest.mark.parametrize("linesweep_cutoff", [0, 1, 500, None])
+    def test_linesweep_cutoff(self, linesweep_cutoff):
+        matcher = self.get_matcher()
+        grouping = matcher.group_by_linesweep(linesweep_cutoff=linesweep_cutoff)
+        self.verify_grouping(matcher, grouping)
+        num_epochs = len(np.unique(matcher.ancestor_data.ancestors_time[:]))
+        assert len(grouping) <= num_epochs
+
+    def test_match_ancestors(self):
+        matcher = self.get_matcher()
+        ancestors_ts = tsinfer.match_ancestors(
+            matcher.sample_data, matcher.ancestor_data, linesweep_cutoff=None
+        )
+        ts = tsinfer.match_samples(matcher.sample_data, ancestors_ts)
+        tsinfer.verify(matcher.sample_data, ts)
+
+
 @pytest.mark.skipif(sys.platform == "win32", reason="No cyvcf2 on windows")
 class TestBatchAncestorMatching:
     def test_equivalance(self, tmp_path, tmpdir):
@@ -1433,6 +1548,8 @@ class TestBatchAncestorMatching:
                     tmpdir / "work", group_index, group_index + 1
                 )
             else:
+                snapshot = tmpdir / "work" / f"ancestors_{group_index - 1}.tsb"
+                assert snapshot.exists()
                 for p_index, _ in enumerate(group["partitions"]):
                     tsinfer.match_ancestors_batch_group_partition(
                         tmpdir / "work", group_index, p_index
@@ -1444,6 +1561,38 @@ class TestBatchAncestorMatching:
         ts2 = tsinfer.match_ancestors(samples, ancestors)
         ts.tables.assert_equals(ts2.tables, ignore_provenance=True)
 
+    def test_equivalance_with_partitions_no_snapshots(self, tmp_path, tmpdir):
+        # Partitions fall back to the ancestors tree sequence without a snapshot
+        ts, zarr_path = tsutil.make_ts_and_zarr(tmp_path)
+        samples = tsinfer.VariantData(zarr_path, "variant_ancestral_allele")
+        ancestors = tsinfer.generate_ancestors(
+            samples, path=str(tmpdir / "ancestors.zarr")
+        )
+        metadata = tsinfer.match_ancestors_batch_init(
+            tmpdir / "work",
+            zarr_path,
+            "variant_ancestral_allele",
+            tmpdir / "ancestors.zarr",
+            1000,
+        )
+        for group_index, group in enumerate(metadata["ancestor_grouping"]):
+            if group["partitions"] is None:
+                tsinfer.match_ancestors_batch_groups(
+                    tmpdir / "work", group_index, group_index + 1
+                )
+            else:
+                os.remove(tmpdir / "work" / f"ancestors_{group_index - 1}.tsb")
+                for p_index, _ in enumerate(group["partitions"]):
+                    tsinfer.match_ancestors_batch_group_partition(
+                        tmpdir / "work", group_index, p_index
+                    )
+                tsinfer.match_ancestors_batch_group_finalise(
+                    tmpdir / "work", group_index
+                )
+        ts = tsinfer.match_ancestors_batch_finalise(tmpdir / "work")
+        ts2 = tsinfer.match_ancestors(samples, ancestors)
+        ts.tables.assert_equals(ts2.tables, ignore_provenance=True)
+
     def test_max_partitions(self, tmp_path, tmpdir):
         ts, zarr_path = tsutil.make_ts_and_zarr(tmp_path)
         samples = tsinfer.VariantData(zarr_path, "variant_ancestral_allele")
@@ -1476,6 +1625,32 @@ class TestBatchAncestorMatching:
         ts2 = tsinfer.match_ancestors(samples, ancestors)
         ts.tables.assert_equals(ts2.tables, ignore_provenance=True)
 
+    def test_pack_partitions(self):
+        ancestor_ids = list(range(10, 20))
+        costs = [1, 9, 2, 8, 3, 7, 4, 6, 5, 5]
+        partitions = inference._pack_partitions(ancestor_ids, costs, 5)
+        assert len(partitions) == 5
+        assert sorted(sum(partitions, [])) == ancestor_ids
+        for partition in partitions:
+            assert partition == sorted(partition)
+            assert sum(costs[a - 10] for a in partition) == 10
+
+    def test_pack_partitions_long_ancestor(self):
+        # A single long ancestor gets a partition to itself
+        costs = [100, 1, 1, 1, 1, 1, 1]
+        partitions = inference._pack_partitions(list(range(7)), costs, 3)
+        assert partitions[0] == [0]
+        assert sorted(len(p) for p in partitions[1:]) == [3, 3]
+        partitions = inference._pack_partitions(list(range(3)), costs[:3], 5)
+        assert partitions == [[0], [1], [2]]
+
+    def test_ancestor_match_cost(self):
+        coverage = np.array([0, 0, 1, 3, 7, 0])
+        start = np.array([0, 0, 2, 4])
+        end = np.array([1, 6, 4, 5])
+        cost = inference._ancestor_match_cost(start, end, coverage)
+        np.testing.assert_allclose(cost, [1, 6 + 2 + 1 + 3, 2 + 1 + 2, 4])
+
     def test_errors(self, tmp_path, tmpdir):
         ts, zarr_path = tsutil.make_ts_and_zarr(tmp_path)
         samples = tsinfer.VariantData(zarr_path, "variant_ancestral_allele")
@@ -1515,9 +1690,50 @@ class TestBatchAncestorMatching:
         with pytest.raises(ValueError, match="sequence length is different"):
             tsinfer.match_ancestors_batch_groups(tmpdir / "work", 2, 3)
 
+    def test_traceback_memory_limit(self, tmp_path, tmpdir):
+        ts, zarr_path = tsutil.make_ts_and_zarr(tmp_path)
+        samples = tsinfer.VariantData(zarr_path, "variant_ancestral_allele")
+        tsinfer.generate_ancestors(samples, path=str(tmpdir / "ancestors.zarr"))
+        metadata = tsinfer.match_ancestors_batch_init(
+            tmpdir / "work",
+            zarr_path,
+            "variant_ancestral_allele",
+            tmpdir / "ancestors.zarr",
+            1000,
+            traceback_memory_limit=1,
+        )
+        assert metadata["traceback_memory_limit"] == 1
+        with pytest.raises(_tsinfer.LibraryError, match="traceback memory limit"):
+            tsinfer.match_ancestors_batch_groups(
+                tmpdir / "work", 0, len(metadata["ancestor_grouping"]), 2
+            )
+
 
 @pytest.mark.skipif(sys.platform == "win32", reason="No cyvcf2 on windows")
 class TestBatchSampleMatching:
+    def test_traceback_memory_limit(self, tmp_path, tmpdir):
+        ts, zarr_path = tsutil.make_ts_and_zarr(tmp_path)
+        samples = tsinfer.VariantData(zarr_path, "variant_ancestral_allele")
+        ancestors_ts = tsinfer.match_ancestors(
+            samples, tsinfer.generate_ancestors(samples)
+        )
+        ancestors_ts.dump(tmpdir / "anc.trees")
+        wd = tsinfer.match_samples_batch_init(
+            work_dir=tmpdir / "working",
+            sample_data_path=zarr_path,
+            ancestral_state="variant_ancestral_allele",
+            ancestor_ts_path=tmpdir / "anc.trees",
+            min_work_per_job=1,
+            traceback_memory_limit=1,
+        )
+        assert wd.traceback_memory_limit == 1
+        wd = inference.SampleBatchWorkDescriptor.load(tmpdir / "working" / "wd.json")
+        assert wd.traceback_memory_limit == 1
+        with pytest.raises(_tsinfer.LibraryError, match="traceback memory limit"):
+            tsinfer.match_samples_batch_partition(
+                work_dir=tmpdir / "working", partition_index=0
+            )
+
     def test_match_samples_batch(self, tmp_path, tmpdir):
         mat_sd, mask_sd, _, _ = tsutil.make_materialized_and_masked_sampledata(
             tmp_path, tmpdir
@@ -1537,6 +1753,7 @@ class TestBatchSampleMatching:
             min_work_per_job=1,
             max_num_partitions=10,
         )
+        assert (tmpdir / "working_mat" / "ancestors.tsb").exists()
         for i in range(mat_wd.num_partitions):
             tsinfer.match_samples_batch_partition(
                 work_dir=tmpdir / "working_mat",
@@ -1569,6 +1786,170 @@ class TestBatchSampleMatching:
         mask_ts_batch.tables.assert_equals(mat_ts_batch.tables, ignore_timestamps=True)
 
 
+class TestDerivedStateIndexes:
+    """
+    Tests for the vectorised lookup of mutation derived states used when
+    restoring the tree sequence builder from an ancestors tree sequence.
+    """
+
+    def reference(self, alleles, ancestral_allele, mutation_site, derived_state):
+        ret = []
+        for site, state in zip(mutation_site, derived_state):
+            site_alleles = tuple(alleles[site])
+            site = tsinfer.formats.Site(
+                id=site,
+                position=0,
+                ancestral_allele=ancestral_allele[site],
+                metadata=None,
+                time=0,
+                alleles=site_alleles,
+            )
+            ret.append(site.reorder_alleles().index(state))
+        return ret
+
+    @pytest.mark.parametrize("padded", [True, False])
+    def test_multiple_alleles(self, padded):
+        alleles = [["A", "T"], ["G", "C", "A"], ["T", "A", "GG", "C"], ["C", "A"]]
+        ancestral_allele = np.array([0, 2, 1, 1], dtype=np.int8)
+        mutation_site = np.array([0, 1, 1, 2, 2, 2, 3], dtype=np.int32)
+        derived_state = ["T", "G", "C", "T", "GG", "C", "C"]
+        expected = self.reference(
+            alleles, ancestral_allele, mutation_site, derived_state
+        )
+        if padded:
+            array = np.full((len(alleles), 4), "", dtype="U2")
+            for j, site_alleles in enumerate(alleles):
+                array[j, : len(site_alleles)] = site_alleles
+        else:
+            array = np.empty(len(alleles), dtype=object)
+            array[:] = [site_alleles + [None] for site_alleles in alleles]
+        result = inference._derived_state_indexes(
+            array, ancestral_allele, mutation_site, derived_state
+        )
+        assert result.dtype == np.int8
+        assert list(result) == expected == [1, 1, 2, 1, 2, 3, 1]
+
+    def test_no_mutations(self):
+        result = inference._derived_state_indexes(
+            np.array([["A", "T"]]), np.zeros(1, dtype=np.int8), np.array([]), []
+        )
+        assert len(result) == 0
+
+    def test_unknown_derived_state(self):
+        with pytest.raises(ValueError, match="not one of the alleles"):
+            inference._derived_state_indexes(
+                np.array([["A", "T"], ["C", "G"]]),
+                np.zeros(2, dtype=np.int8),
+                np.array([0, 1]),
+                ["T", "T"],
+            )
+
+
+class TestTreeSequenceBuilderSnapshot:
+    """
+    Tests that the C and Python tree sequence builders write the same snapshots
+    and can restore each other's.
+    """
+
+    def dump_state(self, tsb):
+        return tsb.dump_nodes() + tsb.dump_edges() + tsb.dump_mutations()
+
+    @pytest.mark.parametrize("engine", [tsinfer.C_ENGINE, tsinfer.PY_ENGINE])
+    def test_round_trip(self, small_sd_fixture, tmp_path, engine):
+        ancestors = tsinfer.generate_ancestors(small_sd_fixture)
+        matcher = inference.AncestorMatcher(small_sd_fixture, ancestors, engine=engine)
+        matcher.match_ancestors(matcher.group_by_linesweep())
+        tsb = matcher.tree_sequence_builder
+        path = tmp_path / "snapshot.tsb"
+        tsb.dump_snapshot(path)
+        for cls in [
+            _tsinfer.TreeSequenceBuilder,
+            tsinfer.algorithm.TreeSequenceBuilder,
+        ]:
+            copy = cls(matcher.num_alleles, 1, 1)
+            copy.restore_snapshot(path)
+            assert copy.num_match_nodes == tsb.num_match_nodes
+            for a, b in zip(self.dump_state(tsb), self.dump_state(copy)):
+                np.testing.assert_array_equal(a, b)
+
+    def test_engines_write_identical_snapshots(self, small_sd_fixture, tmp_path):
+        ancestors = tsinfer.generate_ancestors(small_sd_fixture)
+        data = []
+        for engine in [tsinfer.C_ENGINE, tsinfer.PY_ENGINE]:
+            matcher = inference.AncestorMatcher(
+                small_sd_fixture, ancestors, engine=engine
+            )
+            matcher.match_ancestors(matcher.group_by_linesweep())
+            path = tmp_path / f"{engine}.tsb"
+            matcher.tree_sequence_builder.dump_snapshot(path)
+            data.append(path.read_bytes())
+        assert data[0] == data[1]
+
+    def test_py_engine_errors(self, tmp_path):
+        tsb = tsinfer.algorithm.TreeSequenceBuilder([2] * 10, 1, 1)
+        tsb.add_node(1)
+        path = tmp_path / "snapshot.tsb"
+        tsb.dump_snapshot(path)
+        data = path.read_bytes()
+        for bad_data in [b"", b"x" * len(data), data[:-8], data + bytes(8)]:
+            path.write_bytes(bad_data)
+            with pytest.raises(ValueError, match="Bad snapshot"):
+                tsinfer.algorithm.TreeSequenceBuilder([2] * 10, 1, 1).restore_snapshot(
+                    path
+                )
+        path.write_bytes(data)
+        with pytest.raises(ValueError, match="sites"):
+            tsinfer.algorithm.TreeSequenceBuilder([2] * 9, 1, 1).restore_snapshot(path)
+        with pytest.raises(ValueError, match="empty"):
+            tsb.restore_snapshot(path)
+
+
+class TestSortedOutput:
+    """
+    Tests that the edges and mutation parents dumped from the tree sequence
+    builder are the same as those we get by sorting the output tables.
+    """
+
+    def verify_sorted(self, ts):
+        tables = ts.dump_tables()
+        tables.sort()
+        tables.build_index()
+        tables.compute_mutation_parents()
+        tables.assert_equals(ts.tables, ignore_provenance=True)
+
+    @pytest.mark.parametrize("engine", [tsinfer.C_ENGINE, tsinfer.PY_ENGINE])
+    def test_ancestors_ts(self, small_sd_fixture, engine):
+        ancestors = tsinfer.generate_ancestors(small_sd_fixture)
+        ancestors_ts = tsinfer.match_ancestors(
+            small_sd_fixture, ancestors, engine=engine
+        )
+        self.verify_sorted(ancestors_ts)
+
+    @pytest.mark.parametrize("engine", [tsinfer.C_ENGINE, tsinfer.PY_ENGINE])
+    def test_samples_ts(self, small_sd_fixture, engine):
+        ancestors_ts = tsinfer.match_ancestors(
+            small_sd_fixture, tsinfer.generate_ancestors(small_sd_fixture)
+        )
+        matcher = inference.SampleMatcher(small_sd_fixture, ancestors_ts, engine=engine)
+        matcher.match_samples(np.arange(small_sd_fixture.num_samples))
+        self.verify_sorted(
+            matcher.get_samples_tree_sequence(map_additional_sites=False)
+        )
+
+    def test_engines_equal(self, small_sd_fixture):
+        ancestors = tsinfer.generate_ancestors(small_sd_fixture)
+        state = []
+        for engine in [tsinfer.C_ENGINE, tsinfer.PY_ENGINE]:
+            matcher = inference.AncestorMatcher(
+                small_sd_fixture, ancestors, engine=engine
+            )
+            matcher.match_ancestors(matcher.group_by_linesweep())
+            tsb = matcher.tree_sequence_builder
+            state.append(tsb.dump_edges(sort=True) + tsb.dump_mutations())
+        for a, b in zip(*state):
+            np.testing.assert_array_equal(a, b)
+
+
 class TestAncestorGeneratorsEquivalant:
     """
     Tests for the ancestor generation process.
@@ -1776,6 +2157,48 @@ class TestBuildAncestors:
         with pytest.raises(ValueError):
             tsinfer.generate_ancestors(sample_data, exclude_positions=["not", 1.1])
 
+    @pytest.mark.parametrize("chunk_size", [1, 3, 7, 100])
+    @pytest.mark.parametrize("engine", [tsinfer.C_ENGINE, tsinfer.PY_ENGINE])
+    def test_add_sites_selection(self, chunk_size, engine):
+        rng = np.random.default_rng(42)
+        num_sites, num_samples = 40, 8
+        times = [None, 0.5, np.nan, tskit.UNKNOWN_TIME]
+        with tsinfer.SampleData(1000, chunk_size=chunk_size) as sample_data:
+            for j in range(num_sites):
+                num_alleles = 2 + int(j % 7 == 0)
+                genotypes = rng.integers(-1, num_alleles, num_samples, dtype=np.int8)
+                alleles = [str(a) for a in range(num_alleles)]
+                sample_data.add_site(
+                    j,
+                    genotypes,
+                    alleles=alleles,
+                    ancestral_allele=[0, 1, tskit.MISSING_DATA][j % 3],
+                    time=times[j % len(times)],
+                )
+        exclude_positions = [3, 17, 18]
+        generator = tsinfer.AncestorsGenerator(sample_data, None, {}, engine=engine)
+        generator.add_sites(exclude_positions=exclude_positions)
+
+        expected = []
+        for var in sample_data.variants(recode_ancestral=True):
+            counts = tsinfer.allele_counts(var.genotypes)
+            site = var.site
+            time = site.time
+            if tskit.is_unknown_time(time) and counts.known > 0:
+                time = counts.derived / counts.known
+            if (
+                site.position not in exclude_positions
+                and sample_data.num_alleles(site.id) == 2
+                and 1 < counts.derived < counts.known
+                and site.ancestral_state is not None
+                and not np.isnan(time)
+            ):
+                expected.append(site.id)
+        assert len(expected) > 0
+        assert generator.inference_site_ids == expected
+        assert generator.num_sites == len(expected)
+        assert generator.ancestor_builder.num_sites == len(expected)
+
     def test_bad_focal_sites(self):
         # Can't generate an ancestor for a site with no mutations
         with tsinfer.SampleData(1.0) as sample_data:
@@ -2352,6 +2775,150 @@ class TestMatcher:
             )
 
 
+class TestMatcherPool:
+    """
+    Tests that low-level matcher instances are reused across haplotypes.
+    """
+
+    def get_example(self):
+        ts = msprime.simulate(8, mutation_rate=2, recombination_rate=2, random_seed=3)
+        return tsinfer.SampleData.from_tree_sequence(ts)
+
+    @pytest.mark.parametrize("engine", [tsinfer.C_ENGINE, tsinfer.PY_ENGINE])
+    @pytest.mark.parametrize("num_threads", [0, 1, 3])
+    def test_ancestors_matcher_reuse(self, engine, num_threads):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        matcher = tsinfer.AncestorMatcher(
+            sample_data, ancestor_data, engine=engine, num_threads=num_threads
+        )
+        with mock.patch.object(
+            matcher,
+            "create_matcher_instance",
+            wraps=matcher.create_matcher_instance,
+        ) as create:
+            ts = matcher.match_ancestors(matcher.group_by_linesweep())
+        assert ancestor_data.num_ancestors > 4
+        assert 1 <= create.call_count <= max(1, num_threads)
+        assert len(matcher._matcher_pool) == create.call_count
+        ts2 = tsinfer.match_ancestors(sample_data, ancestor_data, engine=engine)
+        assert ts.equals(ts2, ignore_provenance=True)
+
+    @pytest.mark.parametrize("num_threads", [0, 1, 3])
+    def test_samples_matcher_reuse(self, num_threads):
+        sample_data = self.get_example()
+        ancestors_ts = tsinfer.match_ancestors(
+            sample_data, tsinfer.generate_ancestors(sample_data)
+        )
+        matcher = tsinfer.SampleMatcher(
+            sample_data, ancestors_ts, num_threads=num_threads
+        )
+        with mock.patch.object(
+            matcher,
+            "create_matcher_instance",
+            wraps=matcher.create_matcher_instance,
+        ) as create:
+            matcher.match_samples(np.arange(sample_data.num_samples))
+        assert 1 <= create.call_count <= max(1, num_threads)
+
+
+class TestTracebackMemoryLimit:
+    """
+    Tests that the traceback memory limit is passed through to the low-level
+    matchers from the high-level matching functions.
+    """
+
+    def get_example(self):
+        ts = msprime.simulate(8, mutation_rate=2, recombination_rate=2, random_seed=3)
+        return tsinfer.SampleData.from_tree_sequence(ts)
+
+    @pytest.mark.parametrize("num_threads", [0, 1, 3])
+    @pytest.mark.parametrize("dataflow", [False, True])
+    def test_match_ancestors_over_limit(self, num_threads, dataflow):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        with pytest.raises(_tsinfer.LibraryError, match="traceback memory limit"):
+            tsinfer.match_ancestors(
+                sample_data,
+                ancestor_data,
+                num_threads=num_threads,
+                dataflow=dataflow,
+                traceback_memory_limit=1,
+            )
+
+    @pytest.mark.parametrize("num_threads", [0, 1, 3])
+    def test_match_samples_over_limit(self, num_threads):
+        sample_data = self.get_example()
+        ancestors_ts = tsinfer.match_ancestors(
+            sample_data, tsinfer.generate_ancestors(sample_data)
+        )
+        with pytest.raises(_tsinfer.LibraryError, match="traceback memory limit"):
+            tsinfer.match_samples(
+                sample_data,
+                ancestors_ts,
+                num_threads=num_threads,
+                traceback_memory_limit=1,
+            )
+        with pytest.raises(_tsinfer.LibraryError, match="traceback memory limit"):
+            tsinfer.augment_ancestors(
+                sample_data,
+                ancestors_ts,
+                [0, 1],
+                num_threads=num_threads,
+                traceback_memory_limit=1,
+            )
+
+    @pytest.mark.parametrize("num_threads", [0, 3])
+    def test_within_limit(self, num_threads):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        ancestors_ts = tsinfer.match_ancestors(sample_data, ancestor_data)
+        limited_ancestors_ts = tsinfer.match_ancestors(
+            sample_data,
+            ancestor_data,
+            num_threads=num_threads,
+            traceback_memory_limit=2**20,
+        )
+        assert ancestors_ts.equals(limited_ancestors_ts, ignore_provenance=True)
+        ts = tsinfer.match_samples(sample_data, ancestors_ts)
+        limited_ts = tsinfer.match_samples(
+            sample_data,
+            ancestors_ts,
+            num_threads=num_threads,
+            traceback_memory_limit=2**20,
+        )
+        assert ts.equals(limited_ts, ignore_provenance=True)
+
+    def test_matcher_instances_limited(self):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        matcher = tsinfer.AncestorMatcher(
+            sample_data, ancestor_data, traceback_memory_limit=1
+        )
+        assert matcher.traceback_memory_limit == 1
+        with pytest.raises(_tsinfer.LibraryError, match="traceback memory limit"):
+            matcher.match_ancestors(matcher.group_by_linesweep())
+
+    def test_bad_limit(self):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        with pytest.raises(ValueError, match="traceback_memory_limit"):
+            tsinfer.match_ancestors(
+                sample_data, ancestor_data, traceback_memory_limit=-1
+            )
+
+    def test_python_engine(self):
+        sample_data = self.get_example()
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        with pytest.raises(ValueError, match="only supported by the C engine"):
+            tsinfer.match_ancestors(
+                sample_data,
+                ancestor_data,
+                engine=tsinfer.PY_ENGINE,
+                traceback_memory_limit=2**20,
+            )
+
+
 class TestMatchSamples:
     """
     Test specific features of the match_samples stage
@@ -2535,6 +3102,12 @@ class AlgorithmsExactlyEqualMixin:
             ts = tsinfer.insert_perfect_mutations(ts, delta=1 / 8192)
             self.verify(ts)
 
+    def test_comb_tree(self):
+        # Deep trees mean long upward traversals when finding allelic states.
+        ts = tskit.Tree.generate_comb(20, span=10).tree_sequence
+        ts = tsinfer.insert_perfect_mutations(ts, delta=1 / 8192)
+        self.verify(ts)
+
     @pytest.mark.slow
     def test_twenty_samples(self):
         for seed in range(5):
@@ -3653,14 +4226,15 @@ class TestVerify:
     Checks that we correctly find problems with verify.
     """
 
-    def test_nominal_case(self):
+    @pytest.mark.parametrize("num_threads", [0, 1, 3])
+    def test_nominal_case(self, num_threads):
         ts = msprime.simulate(10, mutation_rate=5, random_seed=1)
         assert ts.num_sites > 0
         samples = tsinfer.SampleData.from_tree_sequence(ts)
         inferred_ts = tsinfer.infer(samples)
 
-        tsinfer.verify(samples, inferred_ts)
-        tsinfer.verify(samples, ts)
+        tsinfer.verify(samples, inferred_ts, num_threads=num_threads)
+        tsinfer.verify(samples, ts, num_threads=num_threads)
 
     def test_missingness(self):
         ts = msprime.simulate(10, mutation_rate=5, random_seed=1)
@@ -3759,7 +4333,8 @@ class TestVerify:
         with pytest.raises(ValueError, match="Alleles"):
             tsinfer.verify(samples, ts)
 
-    def test_bad_genotypes(self):
+    @pytest.mark.parametrize("num_threads", [0, 2])
+    def test_bad_genotypes(self, num_threads):
         n = 2
         ts = msprime.simulate(n, mutation_rate=5, random_seed=1)
         assert ts.num_sites > 1
@@ -3769,9 +4344,72 @@ class TestVerify:
                     position=var.site.position, alleles=var.alleles, genotypes=[0, 0]
                 )
 
-        with pytest.raises(ValueError, match="Genotypes"):
+        with pytest.raises(ValueError, match="Genotypes not equal at site 0"):
+            tsinfer.verify(samples, ts, num_threads=num_threads)
+
+    @pytest.mark.parametrize("num_threads", [0, 2])
+    def test_bad_genotypes_last_site(self, num_threads):
+        ts = msprime.simulate(10, mutation_rate=5, random_seed=1)
+        assert ts.num_sites > 1
+        last = ts.num_sites - 1
+        with tsinfer.SampleData(sequence_length=ts.sequence_length) as samples:
+            for var in ts.variants():
+                genotypes = var.genotypes
+                if var.site.id == last:
+                    genotypes = 1 - genotypes
+                samples.add_site(
+                    position=var.site.position, alleles=var.alleles, genotypes=genotypes
+                )
+
+        with pytest.raises(ValueError, match=f"Genotypes not equal at site {last}"):
+            tsinfer.verify(samples, ts, num_threads=num_threads)
+
+    @pytest.mark.parametrize(
+        ["bad_genotypes_site", "bad_ancestral_site", "message"],
+        [
+            (0, 1, "Genotypes not equal at site 0"),
+            (1, 0, "Ancestral allele not equal at site 0"),
+        ],
+    )
+    def test_first_bad_site_in_block(
+        self, bad_genotypes_site, bad_ancestral_site, message
+    ):
+        ts = msprime.simulate(10, mutation_rate=5, random_seed=1)
+        assert ts.num_sites > 1
+        with tsinfer.SampleData(sequence_length=ts.sequence_length) as samples:
+            for var in ts.variants():
+                alleles = var.alleles
+                genotypes = var.genotypes
+                if var.site.id == bad_genotypes_site:
+                    genotypes = 1 - genotypes
+                elif var.site.id == bad_ancestral_site:
+                    alleles = alleles[::-1]
+                    genotypes = 1 - genotypes
+                samples.add_site(
+                    position=var.site.position, alleles=alleles, genotypes=genotypes
+                )
+
+        with pytest.raises(ValueError, match=message):
             tsinfer.verify(samples, ts)
 
+    @pytest.mark.parametrize("block_size", [1, 3, 1000])
+    def test_blocks_read_in_one_pass(self, block_size):
+        ts = msprime.simulate(10, mutation_rate=5, random_seed=1)
+        assert ts.num_sites > 3
+        samples = tsinfer.SampleData.from_tree_sequence(ts)
+        progress = tsinfer.progress.DummyProgressMonitor().get("verify", 0)
+        with mock.patch.object(samples, "variants", wraps=samples.variants) as variants:
+            inference._verify_sites(samples, ts, 1, ts.num_sites, block_size, progress)
+        assert variants.call_count == 1
+        bad_ts = ts.delete_sites([ts.num_sites - 1])
+        tables = bad_ts.dump_tables()
+        tables.sites.add_row(ts.site(ts.num_sites - 1).position, "0")
+        bad_ts = tables.tree_sequence()
+        with pytest.raises(ValueError, match=f"not equal at site {ts.num_sites - 1}"):
+            inference._verify_sites(
+                samples, bad_ts, 1, ts.num_sites, block_size, progress
+            )
+
     def test_monomorphic_sites(self):
         ts = msprime.sim_ancestry(3, ploidy=1, sequence_length=10, random_seed=123)
         # A finite sites mutation model can create monomorphic sites by reversion etc.
@@ -4519,6 +5157,22 @@ class TestInsertMissingSites:
             assert "inference_type" in metadata
             assert metadata["inference_type"] == tsinfer.INFERENCE_PARSIMONY
 
+    @pytest.mark.parametrize("num_threads", [1, 2, 5, 100])
+    def test_threads(self, num_threads):
+        ts = msprime.simulate(
+            8, length=2, mutation_rate=1, recombination_rate=1, random_seed=123
+        )
+        sample_data = tsinfer.SampleData.from_tree_sequence(ts)
+        keep = sample_data.sites_position[:] < 1
+        half_ts = tsinfer.infer(sample_data.subset(sites=np.where(keep)[0]))
+        assert half_ts.num_trees > 1
+        serial_ts = tsinfer.insert_missing_sites(sample_data, half_ts)
+        threaded_ts = tsinfer.insert_missing_sites(
+            sample_data, half_ts, num_threads=num_threads
+        )
+        assert serial_ts.num_sites == sample_data.num_sites
+        serial_ts.tables.assert_equals(threaded_ts.tables)
+
     def test_insert_with_map(self):
         ts = msprime.simulate(8, length=1, recombination_rate=1, random_seed=123)
         mutated_ts = msprime.mutate(ts, rate=1, random_seed=123)
@@ -21,6 +21,7 @@ Integrity tests for the low-level module.
 """
 import sys
 
+import numpy as np
 import pytest
 
 import _tsinfer
@@ -82,6 +83,224 @@ class TestAncestorMatcher:
             with pytest.raises(ValueError):
                 _tsinfer.AncestorMatcher(tsb, [1], bad_array)
 
+    def make_tree_sequence_builder(self, num_sites=10):
+        tsb = _tsinfer.TreeSequenceBuilder([2] * num_sites)
+        tsb.add_node(3)
+        tsb.add_node(2)
+        tsb.add_node(1)
+        tsb.add_path(1, [0], [num_sites], [0])
+        tsb.add_path(2, [0], [num_sites], [1])
+        tsb.add_mutations(
+            2,
+            np.arange(0, num_sites, 2, dtype=np.int32),
+            np.ones(num_sites // 2, dtype=np.int8),
+        )
+        tsb.freeze_indexes()
+        return tsb
+
+    def make_matcher(self, num_sites=10):
+        tsb = self.make_tree_sequence_builder(num_sites)
+        return _tsinfer.AncestorMatcher(
+            tsb, np.full(num_sites, 1e-2), np.full(num_sites, 1e-3)
+        )
+
+    def test_find_paths_bad_input(self):
+        matcher = self.make_matcher()
+        haplotypes = np.zeros((2, 10), dtype=np.int8)
+        start = [0, 0]
+        end = [10, 10]
+        for bad_type in [None, {}, "sdf"]:
+            with pytest.raises(TypeError):
+                matcher.find_paths(haplotypes, start, end, num_threads=bad_type)
+        for shape in [10, (2, 9), (2, 2, 10)]:
+            with pytest.raises(ValueError):
+                matcher.find_paths(np.zeros(shape, dtype=np.int8), start, end)
+        for bad_start, bad_end in [
+            ([0], [10]),
+            ([0, 0], [10]),
+            ([-1, 0], [10, 10]),
+            ([0, 0], [10, 11]),
+            ([5, 0], [5, 10]),
+        ]:
+            with pytest.raises(ValueError):
+                matcher.find_paths(haplotypes, bad_start, bad_end)
+
+    def test_find_paths_empty(self):
+        matcher = self.make_matcher()
+        empty = np.zeros(0, dtype=np.int32)
+        result = matcher.find_paths(np.zeros((0, 10), dtype=np.int8), empty, empty)
+        assert len(result) == 8
+        assert list(result[0]) == [0]
+        assert list(result[4]) == [0]
+        for array in result[1:4] + result[5:]:
+            assert len(array) == 0
+
+    @pytest.mark.parametrize("num_threads", [0, 1, 2, 5, 20])
+    def test_find_paths_equals_find_path(self, num_threads):
+        num_sites = 10
+        matcher = self.make_matcher(num_sites)
+        rng = np.random.default_rng(42)
+        num_haplotypes = 12
+        haplotypes = rng.integers(-1, 2, size=(num_haplotypes, num_sites))
+        haplotypes = haplotypes.astype(np.int8)
+        start = rng.integers(0, num_sites // 2, size=num_haplotypes, dtype=np.int32)
+        end = rng.integers(
+            num_sites // 2 + 1, num_sites + 1, size=num_haplotypes, dtype=np.int32
+        )
+        (
+            edge_offset,
+            left,
+            right,
+            parent,
+            mutation_offset,
+            site,
+            derived_state,
+            mean_traceback_size,
+        ) = matcher.find_paths(haplotypes, start, end, num_threads=num_threads)
+        assert edge_offset[-1] == len(left) == len(right) == len(parent)
+        assert mutation_offset[-1] == len(site) == len(derived_state)
+        for j in range(num_haplotypes):
+            match = np.zeros(num_sites, dtype=np.int8)
+            h = haplotypes[j]
+            path = matcher.find_path(h, start[j], end[j], match)
+            edges = slice(edge_offset[j], edge_offset[j + 1])
+            np.testing.assert_array_equal(path[0], left[edges])
+            np.testing.assert_array_equal(path[1], right[edges])
+            np.testing.assert_array_equal(path[2], parent[edges])
+            diffs = [
+                k for k in range(start[j], end[j]) if h[k] != -1 and h[k] != match[k]
+            ]
+            mutations = slice(mutation_offset[j], mutation_offset[j + 1])
+            np.testing.assert_array_equal(site[mutations], diffs)
+            np.testing.assert_array_equal(derived_state[mutations], h[diffs])
+            assert mean_traceback_size[j] == matcher.mean_traceback_size
+
+    def test_traceback_memory_limit(self):
+        num_sites = 10
+        tsb = self.make_tree_sequence_builder(num_sites)
+        recombination = np.full(num_sites, 1e-2)
+        mismatch = np.full(num_sites, 1e-3)
+        for bad_type in [None, {}, "sdf"]:
+            with pytest.raises(TypeError):
+                _tsinfer.AncestorMatcher(
+                    tsb, recombination, mismatch, traceback_memory_limit=bad_type
+                )
+        with pytest.raises(ValueError):
+            _tsinfer.AncestorMatcher(
+                tsb, recombination, mismatch, traceback_memory_limit=-1
+            )
+        h = np.ones(num_sites, dtype=np.int8)
+        match = np.zeros(num_sites, dtype=np.int8)
+        matcher = _tsinfer.AncestorMatcher(tsb, recombination, mismatch)
+        expected = matcher.find_path(h, 0, num_sites, match)
+        limited = _tsinfer.AncestorMatcher(
+            tsb, recombination, mismatch, traceback_memory_limit=1
+        )
+        with pytest.raises(_tsinfer.LibraryError, match="traceback memory limit"):
+            limited.find_path(h, 0, num_sites, match)
+        with pytest.raises(_tsinfer.LibraryError, match="traceback memory limit"):
+            limited.find_paths(
+                h.reshape((1, num_sites)), [0], [num_sites], num_threads=2
+            )
+        roomy = _tsinfer.AncestorMatcher(
+            tsb, recombination, mismatch, traceback_memory_limit=2**20
+        )
+        path = roomy.find_path(h, 0, num_sites, match)
+        for a, b in zip(path, expected):
+            np.testing.assert_array_equal(a, b)
+        assert roomy.total_memory > 0
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_get_traceback_reused_matcher(self, seed):
+        # A matcher reused across many matches must report the same
+        # traceback as a freshly allocated one.
+        num_sites = 20
+        rng = np.random.default_rng(seed)
+        tsb = _tsinfer.TreeSequenceBuilder([2] * num_sites)
+        tsb.add_node(10, 0)
+        tsb.add_node(9, 0)
+        tsb.add_path(1, [0], [num_sites], [0])
+        tsb.freeze_indexes()
+        recombination = np.full(num_sites, 1e-2)
+        mismatch = np.full(num_sites, 1e-3)
+        reused = _tsinfer.AncestorMatcher(tsb, recombination, mismatch)
+        for time in range(8, 0, -1):
+            fresh = _tsinfer.AncestorMatcher(tsb, recombination, mismatch)
+            h = rng.integers(0, 2, size=num_sites).astype(np.int8)
+            match = np.zeros(num_sites, dtype=np.int8)
+            left, right, parent = fresh.find_path(h, 0, num_sites, match)
+            reused.find_path(h, 0, num_sites, np.zeros(num_sites, dtype=np.int8))
+            for site in range(num_sites):
+                traceback = fresh.get_traceback(site)
+                assert len(traceback) > 0
+                assert set(traceback.values()) <= {0, 1}
+                assert all(0 < u < tsb.num_nodes for u in traceback)
+                assert reused.get_traceback(site) == traceback
+            child = tsb.add_node(time, 0)
+            tsb.add_path(child, left, right, parent)
+            sites = np.where(h != match)[0].astype(np.int32)
+            tsb.add_mutations(child, sites, h[sites])
+            tsb.freeze_indexes()
+
+    def test_get_traceback_outside_match(self):
+        num_sites = 10
+        matcher = self.make_matcher(num_sites)
+        for site in range(num_sites):
+            assert matcher.get_traceback(site) == {}
+        h = np.ones(num_sites, dtype=np.int8)
+        match = np.zeros(num_sites, dtype=np.int8)
+        matcher.find_path(h, 2, 8, match)
+        for site in list(range(2)) + list(range(8, num_sites)):
+            assert matcher.get_traceback(site) == {}
+        for site in range(2, 8):
+            traceback = matcher.get_traceback(site)
+            assert len(traceback) > 0
+            assert set(traceback.values()) <= {0, 1}
+        with pytest.raises(ValueError):
+            matcher.get_traceback(num_sites)
+
+    def test_find_path_bad_num_match_nodes(self):
+        matcher = self.make_matcher()
+        h = np.zeros(10, dtype=np.int8)
+        match = np.zeros(10, dtype=np.int8)
+        for bad_type in [None, {}, "sdf"]:
+            with pytest.raises(TypeError):
+                matcher.find_path(h, 0, 10, match, num_match_nodes=bad_type)
+        with pytest.raises(ValueError):
+            matcher.find_path(h, 0, 10, match, num_match_nodes=-1)
+
+    def test_find_path_uses_frozen_indexes(self):
+        num_sites = 10
+        tsb = _tsinfer.TreeSequenceBuilder([2] * num_sites)
+        tsb.add_node(3)
+        tsb.add_node(2)
+        tsb.add_node(1)
+        tsb.add_node(1)
+        tsb.add_path(1, [0], [num_sites], [0])
+        tsb.freeze_indexes()
+        matcher = _tsinfer.AncestorMatcher(
+            tsb, np.full(num_sites, 1e-2), np.full(num_sites, 1e-3)
+        )
+        h = np.ones(num_sites, dtype=np.int8)
+        match = np.zeros(num_sites, dtype=np.int8)
+        before = matcher.find_path(h, 0, num_sites, match)
+        # Paths and mutations added since the last freeze are not visible.
+        tsb.add_path(2, [0], [num_sites], [1])
+        tsb.add_mutations(
+            2, np.arange(num_sites, dtype=np.int32), np.ones(num_sites, dtype=np.int8)
+        )
+        assert tsb.num_match_nodes == 3
+        after = matcher.find_path(h, 0, num_sites, match)
+        for a, b in zip(before, after):
+            np.testing.assert_array_equal(a, b)
+        explicit = matcher.find_path(h, 0, num_sites, match, num_match_nodes=2)
+        for a, b in zip(before, explicit):
+            np.testing.assert_array_equal(a, b)
+        tsb.freeze_indexes()
+        path = matcher.find_path(h, 0, num_sites, match)
+        assert list(path[2]) == [2]
+        assert np.all(match == 1)
+
 
 class TestTreeSequenceBuilder:
     """
@@ -101,6 +320,86 @@ class TestTreeSequenceBuilder:
             with pytest.raises(TypeError):
                 _tsinfer.TreeSequenceBuilder([2], max_edges=bad_type)
 
+    def make_builder(self, num_sites=10):
+        tsb = _tsinfer.TreeSequenceBuilder([2] * num_sites)
+        tsb.add_node(3)
+        tsb.add_node(2)
+        tsb.add_node(1)
+        tsb.add_path(1, [0], [num_sites], [0])
+        tsb.add_path(2, [num_sites // 2, 0], [num_sites, num_sites // 2], [1, 0])
+        tsb.add_mutations(
+            2, np.arange(0, num_sites, 2, dtype=np.int32), np.ones(5, dtype=np.int8)
+        )
+        return tsb
+
+    def test_snapshot_round_trip(self, tmp_path):
+        tsb = self.make_builder()
+        path = tmp_path / "snapshot.tsb"
+        tsb.dump_snapshot(path)
+        copy = _tsinfer.TreeSequenceBuilder([2] * 10)
+        copy.restore_snapshot(path)
+        assert copy.num_nodes == tsb.num_nodes
+        assert copy.num_edges == tsb.num_edges
+        assert copy.num_mutations == tsb.num_mutations
+        for a, b in zip(
+            tsb.dump_nodes() + tsb.dump_edges() + tsb.dump_mutations(),
+            copy.dump_nodes() + copy.dump_edges() + copy.dump_mutations(),
+        ):
+            np.testing.assert_array_equal(a, b)
+
+    def test_dump_sorted_edges(self):
+        tsb = self.make_builder()
+        left, right, parent, child = tsb.dump_edges()
+        time = tsb.dump_nodes()[1]
+        order = np.lexsort((left, child, parent, time[parent]))
+        for a, b in zip(tsb.dump_edges(sort=True), (left, right, parent, child)):
+            np.testing.assert_array_equal(a, b[order])
+        for bad_type in ["sdf", {}, None]:
+            with pytest.raises(TypeError):
+                tsb.dump_edges(sort=bad_type)
+
+    def test_mutation_parents(self):
+        tsb = _tsinfer.TreeSequenceBuilder([2] * 10)
+        tsb.add_node(3)
+        tsb.add_node(2)
+        tsb.add_node(1)
+        tsb.add_path(1, [0], [10], [0])
+        tsb.add_path(2, [5, 0], [10, 5], [1, 0])
+        tsb.add_mutations(1, np.array([2, 6], dtype=np.int32), np.ones(2, np.int8))
+        tsb.add_mutations(2, np.array([2, 6], dtype=np.int32), np.zeros(2, np.int8))
+        site, node, _, parent = tsb.dump_mutations()
+        assert list(site) == [2, 2, 6, 6]
+        assert list(node) == [1, 2, 1, 2]
+        # Node 2 inherits from node 0 to the left of site 5 and from node 1
+        # to the right.
+        assert list(parent) == [-1, -1, -1, 2]
+
+    def test_snapshot_errors(self, tmp_path):
+        tsb = self.make_builder()
+        for bad_type in [None, 1, {}]:
+            with pytest.raises(TypeError):
+                tsb.dump_snapshot(bad_type)
+            with pytest.raises(TypeError):
+                tsb.restore_snapshot(bad_type)
+        with pytest.raises(OSError):
+            tsb.dump_snapshot(tmp_path / "no_such_dir" / "snapshot.tsb")
+        empty = _tsinfer.TreeSequenceBuilder([2] * 10)
+        with pytest.raises(OSError):
+            empty.restore_snapshot(tmp_path / "no_such_file.tsb")
+        path = tmp_path / "snapshot.tsb"
+        tsb.dump_snapshot(path)
+        data = path.read_bytes()
+        bad_path = tmp_path / "bad.tsb"
+        for bad_data in [b"", b"x" * len(data), data[:-8], data + bytes(8)]:
+            bad_path.write_bytes(bad_data)
+            with pytest.raises(_tsinfer.LibraryError, match="snapshot"):
+                empty.restore_snapshot(bad_path)
+        with pytest.raises(_tsinfer.LibraryError, match="sites"):
+            _tsinfer.TreeSequenceBuilder([2] * 9).restore_snapshot(path)
+        with pytest.raises(_tsinfer.LibraryError, match="empty"):
+            tsb.restore_snapshot(path)
+        assert empty.num_nodes == 0
+
 
 class TestAncestorBuilder:
     """
@@ -150,4 +449,101 @@ class TestAncestorBuilder:
                 msg = "Cannot add more sites than the specified maximum."
                 assert str(record.value) == msg
 
+    def test_add_sites(self):
+        ab = _tsinfer.AncestorBuilder(num_samples=2, max_sites=10)
+        for bad_type in ["sdf", {}, None]:
+            with pytest.raises((TypeError, ValueError)):
+                ab.add_sites(time=bad_type, genotypes=[[0, 0]])
+        for bad_genotypes in ["asdf", [0, 1], [[0, 1, 2]], [[0, 1], [1, 0]]]:
+            with pytest.raises(ValueError):
+                ab.add_sites(time=[0], genotypes=bad_genotypes)
+        ab.add_sites(time=[], genotypes=np.zeros((0, 2), dtype=np.int8))
+        assert ab.num_sites == 0
+        ab.add_sites(time=[1, 2], genotypes=[[0, 1], [1, 0]])
+        assert ab.num_sites == 2
+
+    def test_add_sites_equals_add_site(self):
+        genotypes = np.array([[0, 1, 1, 0], [1, 1, 0, 0], [0, 1, 1, 0]], dtype=np.int8)
+        time = [0.5, 0.5, 0.25]
+        ab1 = _tsinfer.AncestorBuilder(num_samples=4, max_sites=3)
+        ab1.add_sites(time=time, genotypes=genotypes)
+        ab2 = _tsinfer.AncestorBuilder(num_samples=4, max_sites=3)
+        for t, g in zip(time, genotypes):
+            ab2.add_site(time=t, genotypes=g)
+        assert ab1.ancestor_descriptors() == ab2.ancestor_descriptors()
+
+    def test_add_sites_too_many_sites(self):
+        ab = _tsinfer.AncestorBuilder(num_samples=2, max_sites=2)
+        with pytest.raises(_tsinfer.LibraryError, match="more sites than"):
+            ab.add_sites(time=[1, 1, 1], genotypes=[[0, 1]] * 3)
+        assert ab.num_sites == 2
+
+    def test_workspace_init(self):
+        with pytest.raises(TypeError):
+            _tsinfer.AncestorBuilderWorkspace()
+        for bad_type in [None, "asdf", {}]:
+            with pytest.raises(TypeError):
+                _tsinfer.AncestorBuilderWorkspace(bad_type)
+
+    @pytest.mark.parametrize("genotype_encoding", [0, 1])
+    def test_make_ancestor_workspace(self, genotype_encoding):
+        rng = np.random.default_rng(5)
+        num_samples, num_sites = 20, 50
+        genotypes = (rng.random((num_sites, num_samples)) < 0.4).astype(np.int8)
+        time = np.sum(genotypes, axis=1).astype(np.float64)
+        keep = np.logical_and(time > 1, time < num_samples)
+        ab = _tsinfer.AncestorBuilder(
+            num_samples=num_samples,
+            max_sites=num_sites,
+            genotype_encoding=genotype_encoding,
+        )
+        ab.add_sites(time[keep], genotypes[keep])
+        descriptors = ab.ancestor_descriptors()
+        assert len(descriptors) > 1
+        workspace = _tsinfer.AncestorBuilderWorkspace(ab)
+        a1 = np.zeros(ab.num_sites, dtype=np.int8)
+        a2 = np.zeros(ab.num_sites, dtype=np.int8)
+        # The workspace is reused for every ancestor
+        for _, focal_sites in descriptors:
+            start, end = ab.make_ancestor(focal_sites, a1, workspace=workspace)
+            assert ab.make_ancestor(focal_sites, a2) == (start, end)
+            np.testing.assert_array_equal(a1[start:end], a2[start:end])
+
+    @pytest.mark.parametrize("num_samples", [2, 9, 64, 65, 200])
+    def test_one_bit_encoding_equivalent(self, num_samples):
+        rng = np.random.default_rng(num_samples)
+        num_sites = 60
+        genotypes = (rng.random((num_sites, num_samples)) < 0.4).astype(np.int8)
+        time = np.sum(genotypes, axis=1).astype(np.float64)
+        keep = np.logical_and(time > 1, time < num_samples)
+        ancestors = []
+        for genotype_encoding in [0, 1]:
+            ab = _tsinfer.AncestorBuilder(
+                num_samples=num_samples,
+                max_sites=num_sites,
+                genotype_encoding=genotype_encoding,
+            )
+            ab.add_sites(time[keep], genotypes[keep])
+            workspace = _tsinfer.AncestorBuilderWorkspace(ab)
+            a = np.zeros(ab.num_sites, dtype=np.int8)
+            result = {}
+            for _, focal_sites in ab.ancestor_descriptors():
+                start, end = ab.make_ancestor(focal_sites, a, workspace=workspace)
+                result[tuple(focal_sites)] = start, end, a[start:end].tobytes()
+            ancestors.append(result)
+        assert ancestors[0] == ancestors[1]
+
+    def test_make_ancestor_bad_workspace(self):
+        ab = _tsinfer.AncestorBuilder(num_samples=4, max_sites=1)
+        ab.add_site(time=1, genotypes=[0, 1, 1, 0])
+        ab.ancestor_descriptors()
+        a = np.zeros(1, dtype=np.int8)
+        for bad_type in ["asdf", {}, ab]:
+            with pytest.raises(TypeError):
+                ab.make_ancestor([0], a, workspace=bad_type)
+        other = _tsinfer.AncestorBuilder(num_samples=4, max_sites=1)
+        workspace = _tsinfer.AncestorBuilderWorkspace(other)
+        with pytest.raises(ValueError, match="different AncestorBuilder"):
+            ab.make_ancestor([0], a, workspace=workspace)
+
     # TODO need tester methods for the remaining methonds in the class.
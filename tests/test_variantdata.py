@@ -155,6 +155,9 @@ def test_variantdata_accessors(tmp_path, in_mem):
         # sgkit alleles are padded to be rectangular
         assert np.all(alleles[: len(v.alleles)] == v.alleles)
         assert np.all(alleles[len(v.alleles) :] == "")
+    assert np.array_equal(vd.num_alleles(), [len(v.alleles) for v in ts.variants()])
+    assert np.array_equal(vd.num_alleles(), formats.SampleData.num_alleles(vd))
+    assert np.array_equal(vd.num_alleles([2, 0]), vd.num_alleles()[[2, 0]])
     assert np.array_equal(vd.sites_select, np.ones(ts.num_sites, dtype=bool))
     assert np.array_equal(
         vd.sites_ancestral_allele, np.zeros(ts.num_sites, dtype=np.int8)
@@ -309,6 +312,9 @@ class TestSgkitMask:
         assert np.array_equal(
             vdata.sites_position, ts.tables.sites.position[~sites_mask]
         )
+        assert np.array_equal(
+            vdata.num_alleles(), formats.SampleData.num_alleles(vdata)
+        )
         inf_ts = tsinfer.infer(vdata)
         assert np.array_equal(
             ts.genotype_matrix()[~sites_mask], inf_ts.genotype_matrix()
@@ -151,6 +151,19 @@ class AncestorBuilder:
         # Add each site to the list for this ancestor_uid at this timepoint
         sites_at_fixed_timepoint[ancestor_uid].append(site_id)
 
+    def add_sites(self, time, genotypes):
+        """
+        Adds the sites in the rows of the specified genotype matrix to the builder.
+        """
+        time = np.asarray(time, dtype=np.float64)
+        genotypes = np.asarray(genotypes, dtype=np.int8)
+        if len(time.shape) != 1 or len(genotypes.shape) != 2:
+            raise ValueError("time must be 1D and genotypes must be 2D")
+        if genotypes.shape[0] != time.shape[0]:
+            raise ValueError("time and genotypes must have the same number of sites")
+        for site_time, site_genotypes in zip(time, genotypes):
+            self.add_site(site_time, site_genotypes)
+
     def print_state(self):
         print("Ancestor builder")
         print("Sites = ")
@@ -248,11 +261,13 @@ class AncestorBuilder:
         assert a[last_site] != tskit.MISSING_DATA
         return last_site
 
-    def make_ancestor(self, focal_sites, a):
+    def make_ancestor(self, focal_sites, a, workspace=None):
         """
         Fills out the array a with the haplotype
         return the start and end of an ancestor
         """
+        if workspace is not None and workspace.ancestor_builder is not self:
+            raise ValueError("workspace was allocated for a different AncestorBuilder")
         focal_time = self.sites[focal_sites[0]].time
         # check all focal sites in this ancestor are at the same timepoint
         assert all([self.sites[fs].time == focal_time for fs in focal_sites])
@@ -294,6 +309,50 @@ class AncestorBuilder:
         return start, end
 
 
+# The snapshot format written by tree_sequence_builder_dump_snapshot in the
+# C library: a header followed by the num_alleles, node, edge and mutation
+# arrays, each padded to a multiple of 8 bytes.
+SNAPSHOT_MAGIC = b"tsisnap"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S8"),
+        ("version", np.uint32),
+        ("flags", np.uint32),
+        ("num_sites", np.uint64),
+        ("num_nodes", np.uint64),
+        ("num_edges", np.uint64),
+        ("num_mutations", np.uint64),
+    ]
+)
+SNAPSHOT_ARRAY_DTYPES = [
+    np.dtype(dtype)
+    for dtype in [
+        np.uint32,  # num_alleles
+        np.float64,  # time
+        np.uint32,  # flags
+        np.int32,  # left
+        np.int32,  # right
+        np.int32,  # parent
+        np.int32,  # child
+        np.int32,  # site
+        np.int32,  # node
+        np.int8,  # derived_state
+    ]
+]
+
+
+class AncestorBuilderWorkspace:
+    """
+    Scratch memory used when making ancestors with the specified builder. The
+    Python implementation allocates as it goes, so this is only here for
+    compatibility with the C implementation.
+    """
+
+    def __init__(self, ancestor_builder):
+        self.ancestor_builder = ancestor_builder
+
+
 class TreeSequenceBuilder:
     def __init__(self, num_alleles, max_nodes, max_edges):
         self.num_alleles = num_alleles
@@ -639,7 +698,7 @@ class TreeSequenceBuilder:
         flags = np.array(self.flags[:], dtype=np.uint32)
         return flags, time
 
-    def dump_edges(self):
+    def dump_edges(self, sort=False):
         left = np.zeros(self.num_edges, dtype=np.int32)
         right = np.zeros(self.num_edges, dtype=np.int32)
         parent = np.zeros(self.num_edges, dtype=np.int32)
@@ -654,6 +713,16 @@ class TreeSequenceBuilder:
                 child[j] = edge.child
                 edge = edge.next
                 j += 1
+        if sort:
+            # The tskit edge sort order: parent time, parent, child, left.
+            time = np.array(self.time)
+            order = np.lexsort((left, child, parent, time[parent]))
+            left, right, parent, child = (
+                left[order],
+                right[order],
+                parent[order],
+                child[order],
+            )
         return left, right, parent, child
 
     def dump_mutations(self):
@@ -662,18 +731,94 @@ class TreeSequenceBuilder:
         node = np.zeros(num_mutations, dtype=np.int32)
         parent = np.zeros(num_mutations, dtype=np.int32)
         derived_state = np.zeros(num_mutations, dtype=np.int8)
-        # It's not clear how we'd compute the mutation parent here. We should
-        # remove it from the API if we don't figure out how to do it properly.
-        parent[:] = tskit.NULL
+        # Sweep along the edges to get the tree at each site, and find the
+        # parent of each mutation by walking up the tree from its node.
+        tree_parent = np.full(self.num_nodes, tskit.NULL, dtype=np.int32)
+        in_edges = iter(self.left_index.values())
+        out_edges = iter(self.right_index.values())
+        next_in = next(in_edges, None)
+        next_out = next(out_edges, None)
         j = 0
         for site_index in range(self.num_sites):
+            while next_out is not None and next_out.right <= site_index:
+                tree_parent[next_out.child] = tskit.NULL
+                next_out = next(out_edges, None)
+            while next_in is not None and next_in.left <= site_index:
+                tree_parent[next_in.child] = next_in.parent
+                next_in = next(in_edges, None)
+            node_mutation = {}
+            for u, _ in self.mutations[site_index]:
+                node_mutation[u] = j + len(node_mutation)
             for u, d in self.mutations[site_index]:
                 site[j] = site_index
                 node[j] = u
                 derived_state[j] = d
+                parent[j] = tskit.NULL
+                v = tree_parent[u]
+                while v != tskit.NULL:
+                    if v in node_mutation:
+                        parent[j] = node_mutation[v]
+                        break
+                    v = tree_parent[v]
                 j += 1
         return site, node, derived_state, parent
 
+    def dump_snapshot(self, path):
+        """
+        Writes the state of this builder to the specified file in the same
+        snapshot format as the C implementation.
+        """
+        flags, time = self.dump_nodes()
+        left, right, parent, child = self.dump_edges()
+        site, node, derived_state, _ = self.dump_mutations()
+        header = np.zeros(1, dtype=SNAPSHOT_HEADER_DTYPE)
+        header["magic"] = SNAPSHOT_MAGIC
+        header["version"] = SNAPSHOT_VERSION
+        header["num_sites"] = self.num_sites
+        header["num_nodes"] = len(time)
+        header["num_edges"] = len(left)
+        header["num_mutations"] = len(site)
+        arrays = [self.num_alleles, time, flags, left, right, parent, child]
+        arrays += [site, node, derived_state]
+        with open(path, "wb") as f:
+            f.write(header.tobytes())
+            for array, dtype in zip(arrays, SNAPSHOT_ARRAY_DTYPES):
+                data = np.asarray(array, dtype=dtype).tobytes()
+                f.write(data)
+                f.write(bytes(-len(data) % 8))
+
+    def restore_snapshot(self, path):
+        """
+        Restores the state of this empty builder from the specified snapshot.
+        """
+        data = np.fromfile(path, dtype=np.uint8)
+        if len(data) < SNAPSHOT_HEADER_DTYPE.itemsize:
+            raise ValueError("Bad snapshot")
+        header = data[: SNAPSHOT_HEADER_DTYPE.itemsize].view(SNAPSHOT_HEADER_DTYPE)[0]
+        if header["magic"] != SNAPSHOT_MAGIC or header["version"] != SNAPSHOT_VERSION:
+            raise ValueError("Bad snapshot")
+        counts = [header["num_sites"]] + [header["num_nodes"]] * 2
+        counts += [header["num_edges"]] * 4 + [header["num_mutations"]] * 3
+        arrays = []
+        offset = SNAPSHOT_HEADER_DTYPE.itemsize
+        for count, dtype in zip(counts, SNAPSHOT_ARRAY_DTYPES):
+            size = int(count) * dtype.itemsize
+            if offset + size > len(data):
+                raise ValueError("Bad snapshot")
+            arrays.append(data[offset : offset + size].view(dtype))
+            offset += size + (-size % 8)
+        if offset != len(data):
+            raise ValueError("Bad snapshot")
+        num_alleles, time, flags, left, right, parent, child = arrays[:7]
+        site, node, derived_state = arrays[7:]
+        if not np.array_equal(num_alleles, self.num_alleles):
+            raise ValueError("The snapshot's sites are not the same as the builder's")
+        if self.num_nodes != 0:
+            raise ValueError("Can only restore a snapshot into an empty builder")
+        self.restore_nodes(time, flags)
+        self.restore_edges(left, right, parent, child)
+        self.restore_mutations(site, node, derived_state, None)
+
 
 # Special values used to indicate compressed paths and nodes that are
 # not present in the current tree.
@@ -704,6 +849,7 @@ class AncestorMatcher:
         self.likelihood = None
         self.likelihood_nodes = None
         self.allelic_state = None
+        self.match_num_match_nodes = None
         self.total_memory = 0
 
     def print_state(self):
@@ -756,7 +902,7 @@ class AncestorMatcher:
         assert np.all(self.allelic_state == -1)
 
     def update_site(self, site, haplotype_state):
-        n = self.tree_sequence_builder.num_match_nodes
+        n = self.match_num_match_nodes
         rho = self.recombination[site]
         mu = self.mismatch[site]
         num_alleles = self.tree_sequence_builder.num_alleles[site]
@@ -775,13 +921,20 @@ class AncestorMatcher:
 
         max_L = -1
         max_L_node = -1
+        path = []
         for u in self.likelihood_nodes:
-            # Get the allelic_state at u. TODO we can cache these states to
-            # avoid some upward traversals.
+            # Get the allelic_state at u, and write it into the nodes we pass
+            # through so that later traversals can stop early.
             v = u
             while self.allelic_state[v] == -1:
                 v = self.parent[v]
                 assert v != -1
+            u_state = self.allelic_state[v]
+            v = u
+            while self.allelic_state[v] == -1:
+                self.allelic_state[v] = u_state
+                path.append(v)
+                v = self.parent[v]
 
             p_last = self.likelihood[u]
             p_no_recomb = p_last * (1 - rho + rho / n)
@@ -794,13 +947,14 @@ class AncestorMatcher:
                 recombination_required = True
             self.traceback[site][u] = recombination_required
             p_e = mu
-            if haplotype_state in (tskit.MISSING_DATA, self.allelic_state[v]):
+            if haplotype_state in (tskit.MISSING_DATA, u_state):
                 p_e = 1 - (num_alleles - 1) * mu
             self.likelihood[u] = p_t * p_e
 
             if self.likelihood[u] > max_L:
                 max_L = self.likelihood[u]
                 max_L_node = u
+        self.allelic_state[path] = -1
 
         if max_L == 0:
             if mu == 0:
@@ -897,7 +1051,12 @@ class AncestorMatcher:
     def is_nonzero_root(self, u):
         return u != 0 and self.is_root(u) and self.left_child[u] == -1
 
-    def find_path(self, h, start, end, match):
+    def find_path(self, h, start, end, match, num_match_nodes=0):
+        # If num_match_nodes is nonzero it overrides the current number of match
+        # nodes in the builder when computing the recombination probabilities.
+        self.match_num_match_nodes = self.tree_sequence_builder.num_match_nodes
+        if num_match_nodes > 0:
+            self.match_num_match_nodes = num_match_nodes
         Il = self.tree_sequence_builder.left_index
         Ir = self.tree_sequence_builder.right_index
         M = len(Il)
@@ -28,44 +28,80 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+@numba.njit
+def find_overlapping_runs(start, end, time):
+    # Scanning a single time epoch from left to right, find the runs of overlapping
+    # ancestors, returning the offsets of the runs and the end of each run.
+    n = len(start)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    run_end = np.empty_like(end)
+    num_runs = 0
+    max_right = end[0] if n > 0 else 0
+    for j in range(n):
+        if j == 0 or time[j] != time[j - 1] or start[j] >= max_right:
+            if num_runs > 0:
+                run_end[num_runs - 1] = max_right
+            offsets[num_runs] = j
+            num_runs += 1
+            max_right = end[j]
+        else:
+            max_right = max(max_right, end[j])
+    if num_runs > 0:
+        run_end[num_runs - 1] = max_right
+    offsets[num_runs] = n
+    return offsets[: num_runs + 1], run_end[:num_runs]
+
+
 def merge_overlapping_ancestors(start, end, time):
-    # Merge overlapping, same-time ancestors. We do this by scanning along a single
-    # time epoch from left to right, detecting breaks.
+    # Merge overlapping, same-time ancestors. After sorting by time and start, the
+    # ancestors merged into new ancestor j are the contiguous run
+    # sort_indices[old_offsets[j]: old_offsets[j + 1]].
     sort_indices = np.lexsort((start, time))
     start = start[sort_indices]
     end = end[sort_indices]
     time = time[sort_indices]
-    old_indexes = {}
-    # For efficiency, pre-allocate the output arrays to the maximum possible size.
-    new_start = np.full_like(start, -1)
-    new_end = np.full_like(end, -1)
-    new_time = np.full_like(time, -1)
-
-    i = 0
-    new_index_pos = 0
-    while i < len(start):
-        j = i + 1
-        group_overlap = [i]
-        max_right = end[i]
-        # While we're in the same time epoch, and the next ancestor
-        # overlaps with the group, add this ancestor to the group.
-        while j < len(start) and time[j] == time[i] and start[j] < max_right:
-            max_right = max(max_right, end[j])
-            group_overlap.append(j)
-            j += 1
-
-        # Emit the found group
-        old_indexes[new_index_pos] = group_overlap
-        new_start[new_index_pos] = start[i]
-        new_end[new_index_pos] = max_right
-        new_time[new_index_pos] = time[i]
-        new_index_pos += 1
-        i = j
-    # Trim the output arrays to the actual size.
-    new_start = new_start[:new_index_pos]
-    new_end = new_end[:new_index_pos]
-    new_time = new_time[:new_index_pos]
-    return new_start, new_end, new_time, old_indexes, sort_indices
+    old_offsets, new_end = find_overlapping_runs(start, end, time)
+    new_start = start[old_offsets[:-1]]
+    new_time = time[old_offsets[:-1]]
+    return new_start, new_end, new_time, old_offsets, sort_indices
+
+
+@numba.njit
+def _set_active(count, u, delta):
+    # Add delta to the count at leaf u and its ancestors in the segment tree
+    while u > 0:
+        count[u] += delta
+        u //= 2
+
+
+@numba.njit
+def _next_active(count, size, position):
+    # Return the smallest active position greater than the specified position,
+    # or -1 if there is none.
+    u = position + size
+    while u > 1:
+        if u % 2 == 0 and count[u + 1] > 0:
+            u += 1
+            while u < size:
+                u = 2 * u if count[2 * u] > 0 else 2 * u + 1
+            return u - size
+        u //= 2
+    return -1
+
+
+@numba.njit
+def _prev_active(count, size, position):
+    # Return the largest active position less than the specified position,
+    # or -1 if there is none.
+    u = position + size
+    while u > 1:
+        if u % 2 == 1 and count[u - 1] > 0:
+            u -= 1
+            while u < size:
+                u = 2 * u + 1 if count[2 * u + 1] > 0 else 2 * u
+            return u - size
+        u //= 2
+    return -1
 
 
 @numba.njit
@@ -73,41 +109,71 @@ def run_linesweep(event_times, event_index, event_type, new_time):
     # Run the linesweep over the ancestor start-stop events,
     # building up the dependency graph as a count of dependencies for each ancestor,
     # and a list of dependant children for each ancestor.
+    # The active ancestors all overlap each other, and (as overlapping same-time
+    # ancestors have been merged) have distinct times, so they form a chain of
+    # dependencies ordered by time. We therefore only need an edge from the youngest
+    # of the older active ancestors and to the oldest of the younger ones: the
+    # dependencies on the other active ancestors follow transitively. This keeps the
+    # graph size linear in the number of ancestors, and does not change the groups,
+    # which are given by the longest path to each ancestor.
     n = len(new_time)
 
-    # numba really likes to know the type of the list elements, so we tell it by adding
-    # a dummy element to the list and then popping it off.
-    # `active` is the list of ancestors that overlap with the current linesweep position.
-    active = [-1]
-    active.pop()
-    children = [[-1] for _ in range(n)]
-    for c in range(n):
-        children[c].pop()
+    # `active` is the set of ancestors that overlap with the current linesweep
+    # position, which we keep in a segment tree over the ranks of the ancestor times
+    # so that we can find the nearest older and younger active ancestors, and
+    # insert and remove ancestors, in logarithmic time.
+    order = np.argsort(new_time)
+    rank = np.zeros(n, dtype=np.int64)
+    num_ranks = 0
+    for k in range(n):
+        if k > 0 and new_time[order[k]] != new_time[order[k - 1]]:
+            num_ranks += 1
+        rank[order[k]] = num_ranks
+    size = 1
+    while size <= num_ranks:
+        size *= 2
+    count = np.zeros(2 * size, dtype=np.int32)
+    active = np.full(size, -1, dtype=np.int64)
+
+    edge_parent = np.zeros(2 * n, dtype=np.int32)
+    edge_child = np.zeros(2 * n, dtype=np.int32)
+    num_edges = 0
     incoming_edge_count = np.zeros(n, dtype=np.int32)
     for i in range(len(event_times)):
         index = event_index[i]
-        e_time = event_times[i]
+        position = rank[index]
         if event_type[i] == 1:
-            for j in active:
-                if new_time[j] > e_time:
-                    incoming_edge_count[index] += 1
-                    children[j].append(index)
-                elif new_time[j] < e_time:
-                    incoming_edge_count[j] += 1
-                    children[index].append(j)
-            active.append(index)
+            assert active[position] == -1
+            older = _next_active(count, size, position)
+            if older != -1:
+                edge_parent[num_edges] = active[older]
+                edge_child[num_edges] = index
+                num_edges += 1
+                incoming_edge_count[index] += 1
+            younger = _prev_active(count, size, position)
+            if younger != -1:
+                edge_parent[num_edges] = index
+                edge_child[num_edges] = active[younger]
+                num_edges += 1
+                incoming_edge_count[active[younger]] += 1
+            active[position] = index
+            _set_active(count, position + size, 1)
         else:
-            active.remove(index)
+            active[position] = -1
+            _set_active(count, position + size, -1)
 
-    # Convert children to ragged array format so we can pass arrays to the
+    # Convert the edges to ragged array format, keeping the children of each
+    # ancestor in the order they were found, so we can pass arrays to the
     # next numba function, `find_groups`.
-    children_data = []
-    children_indices = [0]
-    for child_list in children:
-        children_data.extend(child_list)
-        children_indices.append(len(children_data))
-    children_data = np.array(children_data, dtype=np.int32)
-    children_indices = np.array(children_indices, dtype=np.int32)
+    children_indices = np.zeros(n + 1, dtype=np.int32)
+    for j in range(num_edges):
+        children_indices[edge_parent[j] + 1] += 1
+    children_indices = np.cumsum(children_indices).astype(np.int32)
+    children_data = np.zeros(num_edges, dtype=np.int32)
+    next_child = children_indices[:-1].copy()
+    for j in range(num_edges):
+        children_data[next_child[edge_parent[j]]] = edge_child[j]
+        next_child[edge_parent[j]] += 1
     return children_data, children_indices, incoming_edge_count
 
 
@@ -115,23 +181,28 @@ def run_linesweep(event_times, event_index, event_type, new_time):
 def find_groups(children_data, children_indices, incoming_edge_count):
     # We find groups of ancestors that can be matched in parallel by topologically
     # sorting the dependency graph. We do this by deconstructing the graph, removing
-    # nodes with no incoming edges, and adding them to a group.
+    # nodes with no incoming edges, and adding them to a group. Rather than scanning
+    # all the nodes for each group, we keep a frontier of the nodes whose last
+    # incoming edge was removed when the previous group was, so the total work is
+    # linear in the size of the graph.
     n = len(children_indices) - 1
     group_id = np.full(n, -1, dtype=np.int32)
+    frontier = np.where(incoming_edge_count == 0)[0]
+    next_frontier = np.empty(n, dtype=frontier.dtype)
     current_group = 0
-    while True:
-        # Find the nodes with no incoming edges
-        no_incoming = np.where(incoming_edge_count == 0)[0]
-        if len(no_incoming) == 0:
-            break
-        # Remove them from the graph
-        for i in no_incoming:
+    while len(frontier) > 0:
+        num_next = 0
+        for i in frontier:
+            # Remove it from the graph and add it to the group
             incoming_edge_count[i] = -1
-            incoming_edge_count[
-                children_data[children_indices[i] : children_indices[i + 1]]
-            ] -= 1
-        # Add them to the group
-        group_id[no_incoming] = current_group
+            group_id[i] = current_group
+            for j in range(children_indices[i], children_indices[i + 1]):
+                child = children_data[j]
+                incoming_edge_count[child] -= 1
+                if incoming_edge_count[child] == 0:
+                    next_frontier[num_next] = child
+                    num_next += 1
+        frontier = next_frontier[:num_next].copy()
         current_group += 1
     return group_id
 
@@ -152,7 +223,7 @@ def group_ancestors_by_linesweep(start, end, time):
         new_start,
         new_end,
         new_time,
-        old_indexes,
+        old_offsets,
         sort_indices,
     ) = merge_overlapping_ancestors(start, end, time)
     logger.info(f"Merged to {len(new_start)} ancestors in {time_.time() - t:.2f}s")
@@ -186,24 +257,87 @@ def group_ancestors_by_linesweep(start, end, time):
     logger.info(f"Found groups in {time_.time() - t:.2f}s")
 
     t = time_.time()
-    # Convert the group id array to lists of ids for each group
-    ancestor_grouping = {}
-    for group in np.unique(group_id):
-        ancestor_grouping[group] = np.where(group_id == group)[0]
-
-    # Now un-merge the same-age ancestors, simultaneously mapping back to the original,
-    # unsorted indexes
-    for group in ancestor_grouping:
-        ancestor_grouping[group] = sorted(
-            [
-                sort_indices[item]
-                for i in ancestor_grouping[group]
-                for item in old_indexes[i]
-            ]
-        )
+    # Un-merge the same-age ancestors, simultaneously mapping back to the original,
+    # unsorted indexes, and split them into the groups
+    ancestor_group_id = np.empty(len(sort_indices), dtype=np.int32)
+    ancestor_group_id[sort_indices] = np.repeat(group_id, np.diff(old_offsets))
+    groups, counts = np.unique(ancestor_group_id, return_counts=True)
+    group_ancestors = np.split(
+        np.argsort(ancestor_group_id, kind="stable"), np.cumsum(counts)[:-1]
+    )
+    ancestor_grouping = dict(zip(groups, group_ancestors))
     logger.info(f"Un-merged in {time_.time() - t:.2f}s")
     logger.info(
         f"{len(ancestor_grouping)} groups with median size "
         f"{np.median([len(ancestor_grouping[group]) for group in ancestor_grouping])}"
     )
     return ancestor_grouping
+
+
+@numba.njit
+def find_dependency_groups(start, end, group, num_sites):
+    # For ancestors listed in group order, find the latest earlier group containing
+    # an ancestor that overlaps each ancestor (or -1 if there is none). Once that
+    # group has been inserted into the tree sequence builder, all the ancestors
+    # that can affect the match for an ancestor are present, and so it can be
+    # matched without waiting for the intervening groups. We keep the latest group
+    # to have covered each site in a segment tree: as groups are inserted in
+    # increasing order, an update only needs to record the group at the canonical
+    # nodes for the range (tag) and propagate it up to their ancestors (sub).
+    n = len(start)
+    size = 1
+    while size < num_sites:
+        size *= 2
+    tag = np.full(2 * size, -1, dtype=np.int32)
+    sub = np.full(2 * size, -1, dtype=np.int32)
+    dependency = np.full(n, -1, dtype=np.int32)
+    j = 0
+    while j < n:
+        k = j
+        while k < n and group[k] == group[j]:
+            k += 1
+        for i in range(j, k):
+            value = -1
+            left = start[i] + size
+            right = end[i] + size
+            # Any tag on a node containing part of the range is on the path from
+            # the first or last leaf in the range to the root.
+            u = left
+            v = right - 1
+            while u > 0:
+                value = max(value, tag[u], tag[v])
+                u //= 2
+                v //= 2
+            while left < right:
+                if left & 1:
+                    value = max(value, sub[left])
+                    left += 1
+                if right & 1:
+                    right -= 1
+                    value = max(value, sub[right])
+                left //= 2
+                right //= 2
+            dependency[i] = value
+        for i in range(j, k):
+            left = start[i] + size
+            right = end[i] + size
+            u = left
+            v = right - 1
+            while left < right:
+                if left & 1:
+                    tag[left] = group[i]
+                    sub[left] = group[i]
+                    left += 1
+                if right & 1:
+                    right -= 1
+                    tag[right] = group[i]
+                    sub[right] = group[i]
+                left //= 2
+                right //= 2
+            while u > 0:
+                sub[u] = max(sub[u], group[i])
+                sub[v] = max(sub[v], group[i])
+                u //= 2
+                v //= 2
+        j = k
+    return dependency
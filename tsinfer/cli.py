@@ -290,7 +290,9 @@ def run_verify(args):
     setup_logging(args)
     samples = tsinfer.SampleData.load(args.samples)
     ts = tskit.load(args.tree_sequence)
-    tsinfer.verify(samples, ts, progress_monitor=args.progress)
+    tsinfer.verify(
+        samples, ts, progress_monitor=args.progress, num_threads=args.num_threads
+    )
     summarise_usage()
 
 
@@ -601,6 +603,7 @@ def get_cli_parser():
     parser.add_argument(
         "tree_sequence", help="The tree sequence to compare with in .trees format."
     )
+    add_num_threads_argument(parser)
     add_progress_argument(parser)
     parser.set_defaults(runner=run_verify)
 
@@ -65,6 +65,13 @@ DEFAULT_COMPRESSOR = numcodecs.Zstd()
 # sparse files are supported, we default to 1TiB.
 DEFAULT_MAX_FILE_SIZE = 2**30 if sys.platform == "win32" else 2**40
 
+# The iterators over stored genotypes and haplotypes read this many chunks
+# ahead on background threads, so that reading and decompressing the next
+# chunks overlaps with processing the current one. The chunks read ahead are
+# limited to DEFAULT_PREFETCH_MEMORY bytes. Set to 0 to read synchronously.
+DEFAULT_PREFETCH_CHUNKS = 2
+DEFAULT_PREFETCH_MEMORY = 2**28
+
 
 def np_obj_equal(np_obj_array1, np_obj_array2):
     """
@@ -306,12 +313,46 @@ def zarr_summary(array):
     return ret
 
 
+def _recode_ancestral_block(genotypes, ancestral_allele):
+    """
+    Recode the specified 2D (sites x samples) genotype matrix so that the
+    ancestral allele at each site is coded as 0, as for
+    ``variants(recode_ancestral=True)``. Sites with an unknown ancestral
+    allele are left unchanged.
+    """
+    aa_index = np.array(ancestral_allele, dtype=genotypes.dtype)[:, np.newaxis]
+    aa_index[aa_index == MISSING_DATA] = 0
+    return np.where(
+        genotypes == aa_index,
+        0,
+        np.where(
+            np.logical_and(genotypes != MISSING_DATA, genotypes < aa_index),
+            genotypes + 1,
+            genotypes,
+        ),
+    ).astype(genotypes.dtype)
+
+
+def _num_prefetch_chunks(chunk_nbytes, prefetch, prefetch_memory):
+    # The number of chunks of the specified size to read ahead within the budget
+    return min(prefetch, prefetch_memory // max(1, chunk_nbytes))
+
+
 def chunk_iterator(
-    array, indexes=None, select=None, orthogonal_select=None, dimension=0
+    array,
+    indexes=None,
+    select=None,
+    orthogonal_select=None,
+    dimension=0,
+    prefetch=0,
+    prefetch_memory=None,
 ):
     """
     Utility to iterate over closely spaced rows in the specified array efficiently
-    by accessing one chunk at a time (normally used as an iterator over each row)
+    by accessing one chunk at a time (normally used as an iterator over each row).
+    If prefetch > 0, up to that many of the following chunks are read and
+    decompressed on background threads while the current chunk is consumed,
+    limited so that the chunks read ahead use no more than prefetch_memory bytes.
     """
     # Only the first two dimensions are supported.
     assert dimension < 2
@@ -321,6 +362,8 @@ def chunk_iterator(
         orthogonal_select = np.ones(array.shape[int(not dimension)], dtype=bool)
     if len(select) != array.shape[dimension]:
         raise ValueError("Mask must be the same length as the array")
+    if prefetch_memory is None:
+        prefetch_memory = DEFAULT_PREFETCH_MEMORY
 
     if indexes is None:
         indexes = range(np.sum(select))
@@ -337,21 +380,32 @@ def chunk_iterator(
     if not np.all(select):
         indexes = np.nonzero(select)[0][indexes]
     chunk_size = array.chunks[dimension]
+    chunk_shape = list(array.shape)
+    chunk_shape[dimension] = chunk_size
+    chunk_nbytes = int(np.prod(chunk_shape)) * array.dtype.itemsize
+    prefetch = _num_prefetch_chunks(chunk_nbytes, prefetch, prefetch_memory)
+    chunk_ids = np.unique(np.asarray(indexes, dtype=np.int64) // chunk_size)
+
+    def read_chunk(chunk_id):
+        chunk_slice = slice(chunk_id * chunk_size, (chunk_id + 1) * chunk_size)
+        if dimension == 0:
+            return array[chunk_slice][:]
+        return array[:, chunk_slice][:]
+
+    chunks = threads.prefetch_map(read_chunk, chunk_ids, prefetch)
     prev_chunk_id = -1
-    if dimension == 0:
-        for j in indexes:
-            chunk_id = j // chunk_size
-            if chunk_id != prev_chunk_id:
-                chunk = array[chunk_id * chunk_size : (chunk_id + 1) * chunk_size][:]
-                prev_chunk_id = chunk_id
-            yield chunk[j % chunk_size, orthogonal_select]
-    elif dimension == 1:
+    try:
         for j in indexes:
             chunk_id = j // chunk_size
             if chunk_id != prev_chunk_id:
-                chunk = array[:, chunk_id * chunk_size : (chunk_id + 1) * chunk_size][:]
+                chunk = next(chunks)
                 prev_chunk_id = chunk_id
-            yield chunk[orthogonal_select, j % chunk_size]
+            if dimension == 0:
+                yield chunk[j % chunk_size, orthogonal_select]
+            else:
+                yield chunk[orthogonal_select, j % chunk_size]
+    finally:
+        chunks.close()
 
 
 def merge_variants(sd1, sd2):
@@ -2151,7 +2205,9 @@ class SampleData(DataContainer):
         """
         if recode_ancestral is None:
             recode_ancestral = False
-        all_genotypes = chunk_iterator(self.sites_genotypes, indexes=sites)
+        all_genotypes = chunk_iterator(
+            self.sites_genotypes, indexes=sites, prefetch=DEFAULT_PREFETCH_CHUNKS
+        )
         assert MISSING_DATA < 0  # required for geno_map to remap MISSING_DATA
         for genos, site in zip(all_genotypes, self.sites(ids=sites)):
             aa = site.ancestral_allele
@@ -2167,6 +2223,31 @@ class SampleData(DataContainer):
                 genos = geno_map[genos]
             yield Variant(site=site, alleles=alleles, genotypes=genos)
 
+    def _genotype_blocks(self, recode_ancestral=None):
+        # Iterate over (start, genotypes) pairs, where genotypes is the 2D
+        # (sites x samples) genotype matrix for the consecutive sites from site
+        # ID start, read one chunk of sites at a time.
+        if recode_ancestral is None:
+            recode_ancestral = False
+        aa_index = self.sites_ancestral_allele[:]
+        chunk_size = self.sites_genotypes.chunks[0]
+        starts = range(0, self.num_sites, chunk_size)
+        prefetch = _num_prefetch_chunks(
+            chunk_size * self.num_samples * self.sites_genotypes.dtype.itemsize,
+            DEFAULT_PREFETCH_CHUNKS,
+            DEFAULT_PREFETCH_MEMORY,
+        )
+        blocks = threads.prefetch_map(
+            lambda start: self.sites_genotypes[start : start + chunk_size],
+            starts,
+            prefetch,
+        )
+        for start, genotypes in zip(starts, blocks):
+            end = start + len(genotypes)
+            if recode_ancestral:
+                genotypes = _recode_ancestral_block(genotypes, aa_index[start:end])
+            yield start, genotypes
+
     def _all_haplotypes(self, sites=None, recode_ancestral=None):
         # We iterate over chunks vertically here, and it's not worth complicating
         # the chunk iterator to handle this.
@@ -2564,6 +2645,14 @@ class VariantData(SampleData):
     def sites_alleles(self):
         return self.data["variant_allele"][:][self.sites_select].astype(str)
 
+    def num_alleles(self, sites=None):
+        # The alleles are a fixed width array padded with empty strings, so we
+        # can count them without looping over the sites.
+        num_alleles = np.sum(self.sites_alleles != "", axis=1).astype(np.uint32)
+        if sites is None:
+            return num_alleles
+        return num_alleles[sites]
+
     @property
     def sites_ancestral_allele(self):
         return self._sites_ancestral_allele
@@ -2779,6 +2868,7 @@ class VariantData(SampleData):
             indexes=sites,
             select=self.sites_select,
             orthogonal_select=self.individuals_select,
+            prefetch=DEFAULT_PREFETCH_CHUNKS,
         )
         assert MISSING_DATA < 0  # required for geno_map to remap MISSING_DATA
         for genos, site in zip(all_genotypes, self.sites(ids=sites)):
@@ -2799,6 +2889,39 @@ class VariantData(SampleData):
             assert all(a != "" for a in alleles)
             yield Variant(site=site, alleles=alleles, genotypes=genos)
 
+    def _genotype_blocks(self, recode_ancestral=None):
+        if recode_ancestral is None:
+            recode_ancestral = False
+        call_genotype = self.data["call_genotype"]
+        chunk_size = call_genotype.chunks[0]
+        prefetch = _num_prefetch_chunks(
+            chunk_size
+            * int(np.prod(call_genotype.shape[1:]))
+            * call_genotype.dtype.itemsize,
+            DEFAULT_PREFETCH_CHUNKS,
+            DEFAULT_PREFETCH_MEMORY,
+        )
+
+        def read_chunk(sites_chunk_i):
+            chunk_start = sites_chunk_i * chunk_size
+            site_select = self.sites_select[chunk_start : chunk_start + chunk_size]
+            gt_chunk = call_genotype[chunk_start : chunk_start + chunk_size]
+            return gt_chunk[site_select][:, self.individuals_select, :]
+
+        start = 0
+        for gt_chunk in threads.prefetch_map(
+            read_chunk, self.sites_used_chunks, prefetch
+        ):
+            genotypes = gt_chunk.reshape(len(gt_chunk), self.num_samples)
+            end = start + len(genotypes)
+            if recode_ancestral:
+                genotypes = _recode_ancestral_block(
+                    genotypes, self.sites_ancestral_allele[start:end]
+                )
+            yield start, genotypes
+            start = end
+        assert start == self.num_sites
+
     def _all_haplotypes(self, sites=None, recode_ancestral=None, samples_slice=None):
         # We iterate over chunks vertically here, and it's not worth complicating
         # the chunk iterator to handle this.
@@ -3609,7 +3732,12 @@ class AncestorData(DataContainer):
         end = self.ancestors_end[:]
         time = self.ancestors_time[:]
         focal_sites = self.ancestors_focal_sites[:]
-        haplotypes = chunk_iterator(self.ancestors_full_haplotype, indexes, dimension=1)
+        haplotypes = chunk_iterator(
+            self.ancestors_full_haplotype,
+            indexes,
+            dimension=1,
+            prefetch=DEFAULT_PREFETCH_CHUNKS,
+        )
         if indexes is None:
             indexes = range(len(time))
         for j, h in zip(indexes, haplotypes):
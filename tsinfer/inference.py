@@ -22,9 +22,12 @@ of the core tasks like ancestor generation and matching are delegated
 to other modules.
 """
 import collections
+import concurrent.futures
+import contextlib
 import copy
 import dataclasses
 import heapq
+import itertools
 import json
 import logging
 import math
@@ -195,9 +198,87 @@ def _update_site_metadata(current_metadata, inference_type):
     return {"inference_type": inference_type, **current_metadata}
 
 
-def verify(sample_data, tree_sequence, progress_monitor=None):
+def _empty_metadata_columns(metadata_schema, num_rows):
     """
-    verify(samples, tree_sequence)
+    Returns the metadata and metadata_offset columns for num_rows rows that
+    all hold the encoded empty value of the specified schema, as add_row
+    would store when no metadata is given.
+    """
+    empty = metadata_schema.validate_and_encode_row(metadata_schema.empty_value)
+    metadata = np.tile(np.frombuffer(empty, dtype=np.int8), num_rows)
+    metadata_offset = np.arange(num_rows + 1, dtype=np.uint64) * len(empty)
+    return metadata, metadata_offset
+
+
+def _verify_sites(sample_data, tree_sequence, start, end, block_size, progress):
+    """
+    Verifies the sites from start to end in blocks of block_size sites. The
+    genotypes for each block are decoded into 2D arrays and the tree sequence
+    genotypes are mapped to the sample data alleles using a per-site lookup
+    table, so that each block can be compared using numpy. The sample data
+    variants are read using a single iterator over the whole interval, so that
+    each chunk of the genotypes is only decompressed once.
+    """
+    ts_variant = tskit.Variant(tree_sequence)
+    sd_variants = sample_data.variants(
+        sites=np.arange(start, end), recode_ancestral=True
+    )
+    for block_start in range(start, end, block_size):
+        block_end = min(end, block_start + block_size)
+        num_block_sites = block_end - block_start
+        G1 = np.empty((num_block_sites, sample_data.num_samples), dtype=np.int32)
+        G2 = np.empty_like(G1)
+        sd_alleles = []
+        ts_alleles = []
+        for k, var in enumerate(itertools.islice(sd_variants, num_block_sites)):
+            G1[k] = var.genotypes
+            ts_variant.decode(block_start + k)
+            G2[k] = ts_variant.genotypes
+            sd_alleles.append(tuple(var.alleles))
+            ts_alleles.append(tuple(ts_variant.alleles))
+        # First (ancestral) allele should always be the same. We check this
+        # along with the genotypes below, so that the error is for the first
+        # failing site in the block.
+        ancestral_mismatch = np.array(
+            [
+                alleles1[0] != alleles2[0]
+                for alleles1, alleles2 in zip(sd_alleles, ts_alleles)
+            ],
+            dtype=bool,
+        )
+
+        # Alleles may be in a different order, or even present/absent if not in
+        # the genotype matrix, so we map each tree sequence allele to the index
+        # of the same sample data allele. The last column maps missing data in
+        # the tree sequence, which we don't expect, to a value that never matches.
+        max_alleles = max(len(alleles) for alleles in ts_alleles)
+        lookup = np.full((num_block_sites, max_alleles + 1), -2, dtype=np.int32)
+        for k, (alleles1, alleles2) in enumerate(zip(sd_alleles, ts_alleles)):
+            index = {
+                allele: j for j, allele in enumerate(alleles1) if allele is not None
+            }
+            for j, allele in enumerate(alleles2):
+                lookup[k, j] = index.get(allele, -2)
+        mapped = lookup[np.arange(num_block_sites)[:, np.newaxis], G2]
+        mismatch = np.logical_and(G1 != tskit.MISSING_DATA, mapped != G1)
+        bad_sites = np.flatnonzero(
+            np.logical_or(ancestral_mismatch, np.any(mismatch, axis=1))
+        )
+        if len(bad_sites) > 0:
+            k = bad_sites[0]
+            site_id = block_start + k
+            if ancestral_mismatch[k]:
+                raise ValueError(f"Ancestral allele not equal at site {site_id}")
+            if sd_alleles[k] == ts_alleles[k]:
+                raise ValueError(f"Genotypes not equal at site {site_id}")
+            sample = np.flatnonzero(mismatch[k])[0]
+            raise ValueError(f"Alleles for sample {sample} not equal at site {site_id}")
+        progress.update(num_block_sites)
+
+
+def verify(sample_data, tree_sequence, progress_monitor=None, num_threads=0):
+    """
+    verify(samples, tree_sequence, progress_monitor=None, num_threads=0)
 
     Verifies that the specified sample data and tree sequence files encode the
     same data.
@@ -206,6 +287,10 @@ def verify(sample_data, tree_sequence, progress_monitor=None):
         representing the observed data that we wish to compare to.
     :param TreeSequence tree_sequence: The input :class:`tskit.TreeSequence`
         instance an encoding of the specified samples that we wish to verify.
+    :param int num_threads: The number of worker threads to use. If this is
+        greater than zero, the sites are split into ``num_threads`` contiguous
+        intervals of the genome which are verified concurrently. If < 1,
+        verify all sites synchronously. Defaults to 0.
     """
     progress_monitor = _get_progress_monitor(progress_monitor, verify=True)
     if sample_data.num_sites != tree_sequence.num_sites:
@@ -214,37 +299,39 @@ def verify(sample_data, tree_sequence, progress_monitor=None):
         raise ValueError("numbers of samples not equal")
     if sample_data.sequence_length != tree_sequence.sequence_length:
         raise ValueError("Sequence lengths not equal")
-    progress = progress_monitor.get("verify", tree_sequence.num_sites)
-    for var1, var2 in zip(
-        sample_data.variants(recode_ancestral=True), tree_sequence.variants()
-    ):
-        if var1.site.position != var2.site.position:
-            raise ValueError(
-                "site positions not equal: {} != {}".format(
-                    var1.site.position, var2.site.position
+    sd_position = sample_data.sites_position[:]
+    ts_position = tree_sequence.sites_position
+    bad_positions = np.flatnonzero(sd_position != ts_position)
+    if len(bad_positions) > 0:
+        j = bad_positions[0]
+        raise ValueError(
+            f"site positions not equal: {sd_position[j]} != {ts_position[j]}"
+        )
+    num_sites = tree_sequence.num_sites
+    # Limit the size of the genotype blocks held in memory by each worker
+    block_size = max(1, min(1024, 2**24 // max(1, sample_data.num_samples)))
+    progress = progress_monitor.get("verify", num_sites)
+    if num_threads <= 0:
+        _verify_sites(sample_data, tree_sequence, 0, num_sites, block_size, progress)
+    else:
+        bounds = np.linspace(0, num_sites, num_threads + 1).astype(int)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+            futures = [
+                pool.submit(
+                    _verify_sites,
+                    sample_data,
+                    tree_sequence,
+                    start,
+                    end,
+                    block_size,
+                    progress,
                 )
-            )
-        # First (ancestral) allele should always be the same
-        if var1.alleles[0] != var2.alleles[0]:
-            raise ValueError(f"Ancestral allele not equal at site {var1.site.id}")
-        if var1.alleles != var2.alleles:
-            # Alleles may be in a different order, or even present/absent if not in the
-            # genotype matrix so we need to explicitly compare the decoded values (slow)
-            for i, (g1, g2) in enumerate(zip(var1.genotypes, var2.genotypes)):
-                # We don't expect missingness in a tsinfer generated tree sequence
-                assert g2 != tskit.NULL
-                if g1 != tskit.NULL and var1.alleles[g1] != var2.alleles[g2]:
-                    raise ValueError(
-                        f"Alleles for sample {i} not equal at site {var1.site.id}"
-                    )
-        else:
-            g1 = var1.genotypes
-            g2 = np.copy(var2.genotypes)
-            missing_mask = g1 == tskit.NULL
-            g2[missing_mask] = tskit.NULL
-            if not np.array_equal(g1, g2):
-                raise ValueError(f"Genotypes not equal at site {var1.site.id}")
-        progress.update()
+                for start, end in zip(bounds[:-1], bounds[1:])
+                if end > start
+            ]
+            # Report the error at the leftmost site if more than one interval fails
+            for future in futures:
+                future.result()
     progress.close()
 
 
@@ -503,6 +590,9 @@ def match_ancestors(
     mismatch_ratio=None,
     path_compression=True,
     num_threads=0,
+    dataflow=False,
+    linesweep_cutoff=500,
+    traceback_memory_limit=None,
     # Deliberately undocumented parameters below
     recombination=None,  # See :class:`Matcher`
     mismatch=None,  # See :class:`Matcher`
@@ -515,7 +605,8 @@ def match_ancestors(
 ):
     """
     match_ancestors(sample_data, ancestor_data, *, recombination_rate=None,\
-        mismatch_ratio=None, path_compression=True, num_threads=0)
+        mismatch_ratio=None, path_compression=True, num_threads=0, dataflow=False,\
+        linesweep_cutoff=500, traceback_memory_limit=None)
 
     Run the ancestor matching :ref:`algorithm <sec_inference_match_ancestors>`
     on the specified :class:`SampleData` and :class:`AncestorData` instances,
@@ -545,6 +636,25 @@ def match_ancestors(
         paths (essentially taking advantage of shared recombination breakpoints).
     :param int num_threads: The number of match worker threads to use. If
         this is <= 0 then a simpler sequential algorithm is used (default).
+    :param bool dataflow: If True, start matching each ancestor as soon as the
+        earlier groups it depends on have been inserted, rather than waiting for
+        the whole of the previous group to finish. Each ancestor is matched against
+        the tree sequence as it was when its dependencies were inserted, so the
+        output is not identical to that of the default grouped schedule (although
+        it does not depend on ``num_threads``). Matching only runs concurrently
+        with group insertion using the C engine; with the Python engine the
+        ancestors are matched one at a time. (Default: False)
+    :param int linesweep_cutoff: The ancestors are grouped for matching by
+        linesweep, which puts ancestors that do not depend on each other in the
+        same group, up to the first epoch in the second half of the epochs that is
+        more than ``linesweep_cutoff`` times the median epoch size. Each of the
+        remaining epochs is matched as a single group. If ``None``, all of the
+        ancestors are grouped by linesweep. (Default: 500)
+    :param int traceback_memory_limit: The maximum number of bytes that each
+        match worker may use to store the traceback of a single match. Matching a
+        haplotype whose traceback needs more memory than this raises an error,
+        rather than allocating it. If ``None``, the traceback is not limited
+        (default). Only supported by the C engine.
     :return: The ancestors tree sequence representing the inferred history
         of the set of ancestors.
     :rtype: tskit.TreeSequence
@@ -567,9 +677,10 @@ def match_ancestors(
         extended_checks=extended_checks,
         engine=engine,
         progress_monitor=progress_monitor,
+        traceback_memory_limit=traceback_memory_limit,
     )
-    ancestor_grouping = matcher.group_by_linesweep()
-    ts = matcher.match_ancestors(ancestor_grouping)
+    ancestor_grouping = matcher.group_by_linesweep(linesweep_cutoff=linesweep_cutoff)
+    ts = matcher.match_ancestors(ancestor_grouping, dataflow=dataflow)
     tables = ts.dump_tables()
     for timestamp, record in ancestor_data.provenances():
         tables.provenances.add_row(timestamp=timestamp, record=json.dumps(record))
@@ -583,6 +694,42 @@ def match_ancestors(
     return ts
 
 
+def _ancestor_match_cost(start, end, coverage):
+    """
+    Returns the estimated relative cost of matching ancestors with the
+    specified start and end sites, given the number of previously matched
+    ancestors covering each site. Each site the ancestor spans costs one unit,
+    plus a term for the trees at that site, which grow with the number of
+    ancestors that have been inserted over it. The likelihood calculations
+    only touch a small fraction of the tree nodes, so we take this term to be
+    logarithmic in the coverage.
+    """
+    site_cost = np.zeros(len(coverage) + 1)
+    np.cumsum(1 + np.log2(1 + coverage), out=site_cost[1:])
+    return site_cost[end] - site_cost[start]
+
+
+def _pack_partitions(ancestor_ids, costs, num_partitions):
+    """
+    Packs the specified ancestors into num_partitions partitions of roughly
+    equal total cost, using the longest-processing-time heuristic: ancestors
+    are assigned in decreasing order of cost to the partition with the
+    least work so far. Ancestors within each partition are returned in their
+    original order.
+    """
+    heap = [(0, j) for j in range(num_partitions)]
+    partitions = [[] for _ in range(num_partitions)]
+    for k in np.argsort(-np.asarray(costs), kind="stable"):
+        work, j = heapq.heappop(heap)
+        partitions[j].append(k)
+        heapq.heappush(heap, (work + costs[k], j))
+    return [
+        [ancestor_ids[k] for k in sorted(partition)]
+        for partition in partitions
+        if len(partition) > 0
+    ]
+
+
 def match_ancestors_batch_init(
     working_dir,
     sample_data_path,
@@ -596,6 +743,8 @@ def match_ancestors_batch_init(
     recombination_rate=None,
     mismatch_ratio=None,
     path_compression=True,
+    linesweep_cutoff=500,
+    traceback_memory_limit=None,
     # Deliberately undocumented parameters below
     recombination=None,  # See :class:`Matcher`
     mismatch=None,  # See :class:`Matcher`
@@ -605,6 +754,37 @@ def match_ancestors_batch_init(
     time_units=None,
     record_provenance=True,
 ):
+    """
+    Initialise a working directory for matching ancestors in batches. The
+    ancestors are grouped for matching, and the larger groups are split into
+    partitions that can be matched by separate jobs. The grouping is written to
+    ``metadata.json`` in ``working_dir`` and also returned.
+
+    :param str working_dir: The directory in which to store the intermediate
+        results. It is created if it does not exist.
+    :param str sample_data_path: The path to the sample data zarr store.
+    :param str ancestral_state: The name of the sample data array holding the
+        ancestral state of each site.
+    :param str ancestor_data_path: The path to the ancestor data generated from
+        the sample data.
+    :param int min_work_per_job: The minimum amount of work, measured as the total
+        length in sites of the ancestors, for each partition of a group.
+    :param int max_num_partitions: The maximum number of partitions of any group
+        (default: 1000).
+    :param int linesweep_cutoff: The ancestors are grouped by linesweep up to the
+        first epoch in the second half of the epochs that is more than
+        ``linesweep_cutoff`` times the median epoch size, and each of the
+        remaining epochs is a single group. If ``None``, all of the ancestors are
+        grouped by linesweep. See :func:`match_ancestors`. (Default: 500)
+    :param int traceback_memory_limit: The maximum number of bytes that each match
+        worker may use to store a traceback in the batch jobs. See
+        :func:`match_ancestors`. (Default: ``None``)
+
+    The remaining parameters are as for :func:`match_ancestors`.
+
+    :return: The batch metadata, including the grouping of the ancestors.
+    :rtype: dict
+    """
     if max_num_partitions is None:
         max_num_partitions = 1000
 
@@ -627,33 +807,35 @@ def match_ancestors_batch_init(
     )
     ancestor_grouping = []
     ancestor_lengths = ancestors.ancestors_length
-    for group_index, group_ancestors in matcher.group_by_linesweep().items():
+    ancestor_starts = ancestors.ancestors_start[:]
+    ancestor_ends = ancestors.ancestors_end[:]
+    # The number of ancestors from earlier groups covering each site, used to
+    # estimate the size of the trees each ancestor will be matched against.
+    coverage_diff = np.zeros(matcher.num_sites + 1, dtype=np.int64)
+    grouping = matcher.group_by_linesweep(linesweep_cutoff=linesweep_cutoff)
+    for group_index, group_ancestors in grouping.items():
         # Make ancestor_ids JSON serialisable
         group_ancestors = list(map(int, group_ancestors))
-        partitions = []
-        current_partition = []
-        current_partition_work = 0
-        # TODO: Can do better here by packing ancestors
-        # into as equal sized partitions as possible
-        if group_index == 0:
-            partitions.append(group_ancestors)
-        else:
+        partitions = [group_ancestors]
+        if group_index > 0:
             total_work = sum(ancestor_lengths[ancestor] for ancestor in group_ancestors)
             min_work_per_job_group = min_work_per_job
             if total_work / max_num_partitions > min_work_per_job:
                 min_work_per_job_group = total_work / max_num_partitions
-            for ancestor in group_ancestors:
-                if (
-                    current_partition_work + ancestor_lengths[ancestor]
-                    > min_work_per_job_group
-                ):
-                    partitions.append(current_partition)
-                    current_partition = [ancestor]
-                    current_partition_work = ancestor_lengths[ancestor]
-                else:
-                    current_partition.append(ancestor)
-                    current_partition_work += ancestor_lengths[ancestor]
-            partitions.append(current_partition)
+            num_partitions = min(
+                len(group_ancestors),
+                max_num_partitions,
+                math.ceil(total_work / min_work_per_job_group),
+            )
+            if num_partitions > 1:
+                costs = _ancestor_match_cost(
+                    ancestor_starts[group_ancestors],
+                    ancestor_ends[group_ancestors],
+                    np.cumsum(coverage_diff[:-1]),
+                )
+                partitions = _pack_partitions(group_ancestors, costs, num_partitions)
+        np.add.at(coverage_diff, ancestor_starts[group_ancestors], 1)
+        np.add.at(coverage_diff, ancestor_ends[group_ancestors], -1)
         if len(partitions) > 1:
             group_dir = working_dir / f"group_{group_index}"
             group_dir.mkdir()
@@ -680,6 +862,7 @@ def match_ancestors_batch_init(
         "extended_checks": extended_checks,
         "time_units": time_units,
         "record_provenance": record_provenance,
+        "traceback_memory_limit": traceback_memory_limit,
         "ancestor_grouping": ancestor_grouping,
     }
     metadata_path = working_dir / "metadata.json"
@@ -710,10 +893,42 @@ def initialize_ancestor_matcher(metadata, ancestors_ts=None, **kwargs):
         precision=metadata["precision"],
         extended_checks=metadata["extended_checks"],
         engine=metadata["engine"],
+        traceback_memory_limit=metadata["traceback_memory_limit"],
         **kwargs,
     )
 
 
+def _group_snapshot_path(work_dir, group_index):
+    return os.path.join(work_dir, f"ancestors_{group_index}.tsb")
+
+
+def _dump_group_snapshot(work_dir, metadata, group_index, matcher):
+    """
+    If the group after the specified group is partitioned, write a snapshot of
+    the matcher's tree sequence builder for the partition jobs to restore, which
+    is much quicker than restoring it from the ancestors tree sequence.
+    """
+    grouping = metadata["ancestor_grouping"]
+    if group_index + 1 < len(grouping) and grouping[group_index + 1]["partitions"]:
+        path = _group_snapshot_path(work_dir, group_index)
+        logger.info(f"Dumping tree sequence builder snapshot to {path}")
+        matcher.tree_sequence_builder.dump_snapshot(path)
+
+
+def _initialize_partitioned_group_matcher(work_dir, metadata, group_index):
+    """
+    Returns a matcher for the specified partitioned group, restored from the
+    snapshot of the previous group if there is one.
+    """
+    snapshot_path = _group_snapshot_path(work_dir, group_index - 1)
+    if os.path.exists(snapshot_path):
+        return initialize_ancestor_matcher(metadata, snapshot_path=snapshot_path)
+    ancestors_ts = tskit.load(
+        os.path.join(work_dir, f"ancestors_{group_index-1}.trees")
+    )
+    return initialize_ancestor_matcher(metadata, ancestors_ts)
+
+
 def match_ancestors_batch_groups(
     work_dir, group_index_start, group_index_end, num_threads=0
 ):
@@ -744,6 +959,7 @@ def match_ancestors_batch_groups(
     path = os.path.join(work_dir, f"ancestors_{group_index_end-1}.trees")
     logger.info(f"Dumping to {path}")
     ts.dump(path)
+    _dump_group_snapshot(work_dir, metadata, group_index_end - 1, matcher)
     return ts
 
 
@@ -757,10 +973,7 @@ def match_ancestors_batch_group_partition(work_dir, group_index, partition_index
     if partition_index >= len(group["partitions"]) or partition_index < 0:
         raise ValueError(f"Partition {partition_index} is out of range")
 
-    ancestors_ts = tskit.load(
-        os.path.join(work_dir, f"ancestors_{group_index-1}.trees")
-    )
-    matcher = initialize_ancestor_matcher(metadata, ancestors_ts)
+    matcher = _initialize_partitioned_group_matcher(work_dir, metadata, group_index)
     ancestors_to_match = group["partitions"][partition_index]
 
     results = matcher.match_partition(ancestors_to_match, group_index, partition_index)
@@ -777,10 +990,7 @@ def match_ancestors_batch_group_finalise(work_dir, group_index):
     with open(metadata_path) as f:
         metadata = json.load(f)
     group = metadata["ancestor_grouping"][group_index]
-    ancestors_ts = tskit.load(
-        os.path.join(work_dir, f"ancestors_{group_index-1}.trees")
-    )
-    matcher = initialize_ancestor_matcher(metadata, ancestors_ts)
+    matcher = _initialize_partitioned_group_matcher(work_dir, metadata, group_index)
     logger.info(
         f"Finalising group {group_index}, loading {len(group['partitions'])} partitions"
     )
@@ -791,8 +1001,13 @@ def match_ancestors_batch_group_finalise(work_dir, group_index):
         )
         with open(partition_path, "rb") as f:
             results.extend(pickle.load(f))
+    # Partitions are not contiguous ranges of the group, so put the results
+    # back into group order.
+    results_by_node = {result.node: result for result in results}
+    results = [results_by_node[ancestor] for ancestor in group["ancestors"]]
     ts = matcher.finalise_group(group, results, group_index)
     ts.dump(os.path.join(work_dir, f"ancestors_{group_index}.trees"))
+    _dump_group_snapshot(work_dir, metadata, group_index, matcher)
     return ts
 
 
@@ -825,6 +1040,7 @@ def augment_ancestors(
     mismatch_ratio=None,
     path_compression=True,
     num_threads=0,
+    traceback_memory_limit=None,
     # Deliberately undocumented parameters below
     recombination=None,  # See :class:`Matcher`
     mismatch=None,  # See :class:`Matcher`
@@ -836,7 +1052,8 @@ def augment_ancestors(
 ):
     """
     augment_ancestors(sample_data, ancestors_ts, indexes, *, recombination_rate=None,\
-        mismatch_ratio=None, path_compression=True, num_threads=0)
+        mismatch_ratio=None, path_compression=True, num_threads=0,\
+        traceback_memory_limit=None)
 
     Runs the sample matching :ref:`algorithm <sec_inference_match_samples>`
     on the specified :class:`SampleData` instance and ancestors tree sequence,
@@ -870,6 +1087,11 @@ def augment_ancestors(
         paths (essentially taking advantage of shared recombination breakpoints).
     :param int num_threads: The number of match worker threads to use. If
         this is <= 0 then a simpler sequential algorithm is used (default).
+    :param int traceback_memory_limit: The maximum number of bytes that each
+        match worker may use to store the traceback of a single match. Matching a
+        haplotype whose traceback needs more memory than this raises an error,
+        rather than allocating it. If ``None``, the traceback is not limited
+        (default). Only supported by the C engine.
     :return: The specified ancestors tree sequence augmented with copying
         paths for the specified sample.
     :rtype: tskit.TreeSequence
@@ -889,6 +1111,7 @@ def augment_ancestors(
         extended_checks=extended_checks,
         engine=engine,
         progress_monitor=progress_monitor,
+        traceback_memory_limit=traceback_memory_limit,
     )
     sample_indexes = check_sample_indexes(sample_data, indexes)
     sample_times = np.zeros(
@@ -923,6 +1146,7 @@ class SampleBatchWorkDescriptor:
     precision: int
     engine: str
     extended_checks: bool
+    traceback_memory_limit: int
     post_process: bool
     force_sample_times: bool
     map_additional_sites: bool
@@ -942,6 +1166,7 @@ class SampleBatchWorkDescriptor:
             "precision": self.precision,
             "engine": self.engine,
             "extended_checks": self.extended_checks,
+            "traceback_memory_limit": self.traceback_memory_limit,
         }
 
     def save(self, path):
@@ -969,7 +1194,9 @@ class SampleBatchWorkDescriptor:
         return cls(**wd_dict)
 
 
-def load_variant_data_and_ancestors_ts(wd: SampleBatchWorkDescriptor):
+def load_variant_data_and_ancestors_ts(
+    wd: SampleBatchWorkDescriptor, snapshot_path=None
+):
     variant_data = formats.VariantData(
         wd.sample_data_path,
         wd.ancestral_state,
@@ -981,6 +1208,7 @@ def load_variant_data_and_ancestors_ts(wd: SampleBatchWorkDescriptor):
     matcher = SampleMatcher(
         variant_data,
         ancestor_ts,
+        snapshot_path=snapshot_path,
         **wd.common_params(),
     )
     return variant_data, ancestor_ts, matcher
@@ -1002,6 +1230,7 @@ def match_samples_batch_init(
     indexes=None,
     post_process=None,
     force_sample_times=False,
+    traceback_memory_limit=None,
     # Deliberately undocumented parameters below
     recombination=None,  # See :class:`Matcher`
     mismatch=None,  # See :class:`Matcher`
@@ -1035,6 +1264,7 @@ def match_samples_batch_init(
         precision=precision,
         engine=engine,
         extended_checks=extended_checks,
+        traceback_memory_limit=traceback_memory_limit,
         post_process=post_process,
         force_sample_times=force_sample_times,
         map_additional_sites=map_additional_sites,
@@ -1067,6 +1297,9 @@ def match_samples_batch_init(
         num_samples_per_partition = 1
     wd.num_samples_per_partition = num_samples_per_partition
     wd.num_partitions = math.ceil(len(sample_indexes) / num_samples_per_partition)
+    # The partition jobs restore the tree sequence builder from a snapshot, which
+    # is much quicker than restoring it from the ancestors tree sequence.
+    matcher.tree_sequence_builder.dump_snapshot(work_dir / "ancestors.tsb")
     wd_path = work_dir / "wd.json"
     wd.save(wd_path)
     return wd
@@ -1090,7 +1323,12 @@ def match_samples_batch_partition(work_dir, partition_index):
         f"Matching partition {partition_index} with {partition_slice.start} to"
         f" {partition_slice.stop} of {len(sample_indexes)} samples"
     )
-    variant_data, ancestor_ts, matcher = load_variant_data_and_ancestors_ts(wd)
+    snapshot_path = pathlib.Path(work_dir) / "ancestors.tsb"
+    if not snapshot_path.exists():
+        snapshot_path = None
+    variant_data, ancestor_ts, matcher = load_variant_data_and_ancestors_ts(
+        wd, snapshot_path
+    )
     results = matcher.match_samples(
         sample_indexes, sample_times, slice_=partition_slice
     )
@@ -1133,6 +1371,7 @@ def match_samples(
     post_process=None,
     force_sample_times=False,
     num_threads=0,
+    traceback_memory_limit=None,
     # Deliberately undocumented parameters below
     recombination=None,  # See :class:`Matcher`
     mismatch=None,  # See :class:`Matcher`
@@ -1148,7 +1387,8 @@ def match_samples(
     """
     match_samples(sample_data, ancestors_ts, *, recombination_rate=None,\
         mismatch_ratio=None, path_compression=True, post_process=None,\
-        indexes=None, force_sample_times=False, num_threads=0)
+        indexes=None, force_sample_times=False, num_threads=0,\
+        traceback_memory_limit=None)
 
     Runs the sample matching :ref:`algorithm <sec_inference_match_samples>`
     on the specified :class:`SampleData` instance and ancestors tree sequence,
@@ -1187,6 +1427,11 @@ def match_samples(
         appear at the time of the individual with which they are associated.
     :param int num_threads: The number of match worker threads to use. If
         this is <= 0 then a simpler sequential algorithm is used (default).
+    :param int traceback_memory_limit: The maximum number of bytes that each
+        match worker may use to store the traceback of a single match. Matching a
+        haplotype whose traceback needs more memory than this raises an error,
+        rather than allocating it. If ``None``, the traceback is not limited
+        (default). Only supported by the C engine.
     :param bool simplify: Treated as an alias for ``post_process``, deprecated but
         currently retained for backwards compatibility if set to ``False``.
 
@@ -1230,6 +1475,7 @@ def match_samples(
         extended_checks=extended_checks,
         engine=engine,
         progress_monitor=progress_monitor,
+        traceback_memory_limit=traceback_memory_limit,
     )
     sample_indexes = check_sample_indexes(sample_data, indexes)
     sample_times = np.zeros(
@@ -1263,8 +1509,76 @@ def match_samples(
     return ts
 
 
+def _map_missing_sites(
+    sample_data, tree_sequence, tables, site_ids, sample_id_map, progress
+):
+    """
+    Returns new site and mutation tables, with the same schemas as those in the
+    specified tables, containing the sample_data sites in site_ids with
+    mutations placed by parsimony. The site_ids must be in increasing order.
+    Site and parent IDs in the returned mutation table refer to rows in the
+    returned tables.
+    """
+    sites = tskit.SiteTable()
+    sites.metadata_schema = tables.sites.metadata_schema
+    mutations = tskit.MutationTable()
+    mutations.metadata_schema = tables.mutations.metadata_schema
+    schema = sites.metadata_schema.schema
+    tree = tskit.Tree(tree_sequence)
+    for variant in sample_data.variants(sites=site_ids, recode_ancestral=True):
+        site = variant.site
+        pos = site.position
+        anc_state = site.ancestral_state
+        anc_value = 0  # variant(recode_ancestral=True) always has 0 as the anc index
+        G = variant.genotypes[sample_id_map]
+        # We can't perform parsimony inference if all sites are missing, and there's no
+        # point if all non-missing sites are the ancestral state, so skip these cases
+        if np.all(np.logical_or(G == tskit.MISSING_DATA, G == anc_value)):
+            metadata = _update_site_metadata(
+                site.metadata, inference_type=constants.INFERENCE_NONE
+            )
+            if schema is None:
+                metadata = _encode_raw_metadata(metadata)
+            sites.add_row(
+                position=pos,
+                ancestral_state="" if anc_state is None else anc_state,
+                metadata=metadata,
+            )
+        else:
+            if tree.index == -1 or tree.interval.right <= pos:
+                tree.seek(pos)
+            anc_state, mapped_mutations = tree.map_mutations(
+                G, variant.alleles, ancestral_state=anc_state
+            )
+            metadata = _update_site_metadata(
+                site.metadata, inference_type=constants.INFERENCE_PARSIMONY
+            )
+            if schema is None:
+                metadata = _encode_raw_metadata(metadata)
+            new_site_id = sites.add_row(
+                position=pos,
+                ancestral_state=anc_state,
+                metadata=metadata,
+            )
+            mut_map = {tskit.NULL: tskit.NULL}
+            for i, mutation in enumerate(mapped_mutations):
+                mut_map[i] = mutations.add_row(
+                    site=new_site_id,
+                    node=mutation.node,
+                    derived_state=mutation.derived_state,
+                    parent=mut_map[mutation.parent],
+                )
+        progress.update()
+    return sites, mutations
+
+
 def insert_missing_sites(
-    sample_data, tree_sequence, *, sample_id_map=None, progress_monitor=None
+    sample_data,
+    tree_sequence,
+    *,
+    sample_id_map=None,
+    progress_monitor=None,
+    num_threads=0,
 ):
     """
     Return a new tree sequence containing extra sites that are present in a
@@ -1310,6 +1624,11 @@ def insert_missing_sites(
         to sample nodes ``0..(num_samples-1)`` in the tree sequence. If None,
         assume that all the samples in sample_data correspond to the sample nodes
         in the tree sequence, and are in the same order.
+    :param int num_threads: The number of worker threads to use. If this is
+        greater than zero, the new sites are split into ``num_threads``
+        contiguous intervals of the genome which are mapped concurrently, and
+        the results are merged in order. If < 1, map all sites synchronously.
+        Defaults to 0.
     :return: The input tree sequence with additional sites and mutations.
     :rtype: tskit.TreeSequence
 
@@ -1327,60 +1646,67 @@ def insert_missing_sites(
         )
     progress_monitor = _get_progress_monitor(progress_monitor)
     tables = tree_sequence.dump_tables()
-    trees = tree_sequence.trees()
-    tree = next(trees)
     positions = sample_data.sites_position[:]
     new_sd_sites = np.where(np.isin(positions, tables.sites.position) == 0)[0]
-    schema = tables.sites.metadata_schema.schema
 
-    # Create new sites and add the mutations
     progress = progress_monitor.get("ms_extra_sites", len(new_sd_sites))
-    for variant in sample_data.variants(sites=new_sd_sites, recode_ancestral=True):
-        site = variant.site
-        pos = site.position
-        anc_state = site.ancestral_state
-        anc_value = 0  # variant(recode_ancestral=True) always has 0 as the anc index
-        G = variant.genotypes[sample_id_map]
-        # We can't perform parsimony inference if all sites are missing, and there's no
-        # point if all non-missing sites are the ancestral state, so skip these cases
-        if np.all(np.logical_or(G == tskit.MISSING_DATA, G == anc_value)):
-            metadata = _update_site_metadata(
-                site.metadata, inference_type=constants.INFERENCE_NONE
-            )
-            if schema is None:
-                metadata = _encode_raw_metadata(metadata)
-            tables.sites.add_row(
-                position=pos,
-                ancestral_state="" if anc_state is None else anc_state,
-                metadata=metadata,
-            )
-        else:
-            while tree.interval[1] <= pos:
-                tree = next(trees)
-            anc_state, mapped_mutations = tree.map_mutations(
-                G, variant.alleles, ancestral_state=anc_state
-            )
-            metadata = _update_site_metadata(
-                site.metadata, inference_type=constants.INFERENCE_PARSIMONY
-            )
-            if schema is None:
-                metadata = _encode_raw_metadata(metadata)
-            new_site_id = tables.sites.add_row(
-                position=pos,
-                ancestral_state=anc_state,
-                metadata=metadata,
+    if num_threads <= 0:
+        results = [
+            _map_missing_sites(
+                sample_data,
+                tree_sequence,
+                tables,
+                new_sd_sites,
+                sample_id_map,
+                progress,
             )
-            mut_map = {tskit.NULL: tskit.NULL}
-            for i, mutation in enumerate(mapped_mutations):
-                mut_map[i] = tables.mutations.add_row(
-                    site=new_site_id,
-                    node=mutation.node,
-                    derived_state=mutation.derived_state,
-                    parent=mut_map[mutation.parent],
+        ]
+    else:
+        # Each worker maps a contiguous interval of the genome, so it only has
+        # to seek to its first tree and then moves forwards along the sequence.
+        chunks = np.array_split(new_sd_sites, num_threads)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+            futures = [
+                pool.submit(
+                    _map_missing_sites,
+                    sample_data,
+                    tree_sequence,
+                    tables,
+                    chunk,
+                    sample_id_map,
+                    progress,
                 )
-        progress.update()
+                for chunk in chunks
+                if len(chunk) > 0
+            ]
+            results = [future.result() for future in futures]
     progress.close()
 
+    for sites, mutations in results:
+        site_offset = len(tables.sites)
+        mutation_offset = len(tables.mutations)
+        tables.sites.append_columns(
+            position=sites.position,
+            ancestral_state=sites.ancestral_state,
+            ancestral_state_offset=sites.ancestral_state_offset,
+            metadata=sites.metadata,
+            metadata_offset=sites.metadata_offset,
+        )
+        tables.mutations.append_columns(
+            site=mutations.site + site_offset,
+            node=mutations.node,
+            time=mutations.time,
+            derived_state=mutations.derived_state,
+            derived_state_offset=mutations.derived_state_offset,
+            parent=np.where(
+                mutations.parent == tskit.NULL,
+                tskit.NULL,
+                mutations.parent + mutation_offset,
+            ).astype(np.int32),
+            metadata=mutations.metadata,
+            metadata_offset=mutations.metadata_offset,
+        )
+
     tables.sort()
     return tables.tree_sequence()
 
@@ -1426,6 +1752,7 @@ class AncestorsGenerator:
             )
             logging.info(f"Using mmapped {self.mmap_temp_file.name} for genotypes")
             mmap_fd = self.mmap_temp_file.fileno()
+        self.engine = engine
         if engine == constants.C_ENGINE:
             logger.debug("Using C AncestorBuilder implementation")
             self.ancestor_builder = _tsinfer.AncestorBuilder(
@@ -1461,52 +1788,62 @@ class AncestorsGenerator:
         with non-missing alleles).
         """
         if exclude_positions is None:
-            exclude_positions = set()
-        else:
-            exclude_positions = np.array(exclude_positions, dtype=np.float64)
-            if len(exclude_positions.shape) != 1:
-                raise ValueError("exclude_positions must be a 1D array of numbers")
-        exclude_positions = set(exclude_positions)
+            exclude_positions = []
+        exclude_positions = np.array(exclude_positions, dtype=np.float64)
+        if len(exclude_positions.shape) != 1:
+            raise ValueError("exclude_positions must be a 1D array of numbers")
 
         logger.info(f"Starting addition of {self.max_sites} sites")
         progress = self.progress_monitor.get("ga_add_sites", self.max_sites)
+        # Site-level conditions that don't depend on the genotypes are evaluated
+        # for all sites up front. num_alleles == 2 ensures the derived state is "1"
+        usable = np.logical_and(
+            self.sample_data.num_alleles() == 2,
+            self.sample_data.sites_ancestral_allele[:] != tskit.MISSING_DATA,
+        )
+        usable[np.isin(self.sample_data.sites_position[:], exclude_positions)] = False
+        sites_time = self.sample_data.sites_time[:]
         inference_site_id = []
-        for variant in self.sample_data.variants(recode_ancestral=True):
-            # If there's missing data the last allele is None
-            num_alleles = len(variant.alleles) - int(variant.alleles[-1] is None)
-
-            counts = allele_counts(variant.genotypes)
-            use_site = False
-            site = variant.site
-            if (
-                site.position not in exclude_positions
-                and num_alleles == 2  # This will ensure that the derived state is "1"
-                and 1 < counts.derived < counts.known
-                and site.ancestral_state is not None
-            ):
-                use_site = True
-                time = site.time
-                if tskit.is_unknown_time(time):
-                    # Non-variable sites have no obvious freq-as-time values
-                    assert counts.known != counts.derived
-                    assert counts.known != counts.ancestral
-                    time = counts.derived / counts.known
-                if np.isnan(time):
-                    use_site = False  # Site with meaningless time value: skip inference
-            if use_site:
-                self.ancestor_builder.add_site(time, variant.genotypes)
-                inference_site_id.append(site.id)
-                self.num_sites += 1
-            progress.update()
+        for start, genotypes in self.sample_data._genotype_blocks(
+            recode_ancestral=True
+        ):
+            end = start + len(genotypes)
+            known = np.sum(genotypes != tskit.MISSING_DATA, axis=1)
+            derived = known - np.sum(genotypes == 0, axis=1)
+            use_site = np.logical_and(
+                usable[start:end], np.logical_and(1 < derived, derived < known)
+            )
+            time = np.array(sites_time[start:end], dtype=np.float64)
+            # Non-variable sites have no obvious freq-as-time values, but they
+            # have been excluded by the derived count conditions above
+            freq_time = np.logical_and(use_site, tskit.is_unknown_time(time))
+            time[freq_time] = derived[freq_time] / known[freq_time]
+            # Sites with meaningless time values are skipped for inference
+            use_site[np.isnan(time)] = False
+            site_id = np.flatnonzero(use_site)
+            if len(site_id) > 0:
+                self.ancestor_builder.add_sites(time[site_id], genotypes[site_id])
+                inference_site_id.extend((start + site_id).tolist())
+                self.num_sites += len(site_id)
+            progress.update(end - start)
         progress.close()
         self.inference_site_ids = inference_site_id
         logger.info("Finished adding sites")
 
+    def _make_workspace(self):
+        # Scratch memory for make_ancestor, which must not be shared between threads
+        if self.engine == constants.C_ENGINE:
+            return _tsinfer.AncestorBuilderWorkspace(self.ancestor_builder)
+        return algorithm.AncestorBuilderWorkspace(self.ancestor_builder)
+
     def _run_synchronous(self, progress):
         a = np.zeros(self.num_sites, dtype=np.int8)
+        workspace = self._make_workspace()
         for t, focal_sites in self.descriptors:
             before = time_.perf_counter()
-            start, end = self.ancestor_builder.make_ancestor(focal_sites, a)
+            start, end = self.ancestor_builder.make_ancestor(
+                focal_sites, a, workspace=workspace
+            )
             duration = time_.perf_counter() - before
             logger.debug(
                 "Made ancestor in {:.2f}s at timepoint {} "
@@ -1557,12 +1894,15 @@ class AncestorsGenerator:
 
         def build_worker(thread_index):
             a = np.zeros(self.num_sites, dtype=np.int8)
+            workspace = self._make_workspace()
             while True:
                 work = build_queue.get()
                 if work is None:
                     break
                 index, t, focal_sites = work
-                start, end = self.ancestor_builder.make_ancestor(focal_sites, a)
+                start, end = self.ancestor_builder.make_ancestor(
+                    focal_sites, a, workspace=workspace
+                )
                 with add_lock:
                     haplotype = a[start:end].copy()
                     heapq.heappush(
@@ -1661,6 +2001,63 @@ class StoredMatchData:
     results: dict
 
 
+def _flatten_site_alleles(alleles):
+    """
+    Returns the site, index within the site and value of every allele in the
+    specified per-site alleles, in site order. The alleles are either a 2D array
+    of strings padded with "" (VariantData) or an array of per-site lists
+    (SampleData).
+    """
+    if alleles.ndim == 2:
+        allele_site, allele_index = np.nonzero(alleles != "")
+        allele_value = alleles[allele_site, allele_index]
+    else:
+        # Missing data is recorded as a trailing None allele
+        alleles = [
+            [a for a in site_alleles if a is not None] for site_alleles in alleles
+        ]
+        lengths = np.array([len(site_alleles) for site_alleles in alleles], dtype=int)
+        allele_site = np.repeat(np.arange(len(alleles)), lengths)
+        allele_index = np.arange(len(allele_site)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        allele_value = np.array(list(itertools.chain.from_iterable(alleles)), dtype=str)
+    return allele_site, allele_index, allele_value
+
+
+def _derived_state_indexes(alleles, ancestral_allele, mutation_site, derived_state):
+    """
+    Returns the index of each mutation's derived state in the alleles of its
+    site, reordered so that the ancestral allele is first as in
+    Site.reorder_alleles().
+    """
+    allele_site, allele_index, allele_value = _flatten_site_alleles(alleles)
+    if len(mutation_site) == 0:
+        return np.zeros(0, dtype=np.int8)
+    ancestral = ancestral_allele[allele_site]
+    allele_index = np.where(
+        allele_index == ancestral,
+        0,
+        np.where(allele_index < ancestral, allele_index + 1, allele_index),
+    )
+    # Map the (site, allele) pairs to integer keys to look up each mutation
+    values, codes = np.unique(
+        np.concatenate([allele_value, np.array(derived_state, dtype=str)]),
+        return_inverse=True,
+    )
+    codes = codes.reshape(-1)
+    allele_key = allele_site.astype(np.int64) * len(values) + codes[: len(allele_site)]
+    mutation_key = (
+        mutation_site.astype(np.int64) * len(values) + codes[len(allele_site) :]
+    )
+    order = np.argsort(allele_key)
+    index = np.searchsorted(allele_key, mutation_key, sorter=order)
+    index = order[np.minimum(index, len(order) - 1)]
+    if np.any(allele_key[index] != mutation_key):
+        raise ValueError("Mutation derived state is not one of the alleles at its site")
+    return allele_index[index].astype(np.int8)
+
+
 class Matcher:
     """
     A matching instance, used in both ``tsinfer.match_ancestors`` and
@@ -1683,6 +2080,10 @@ class Matcher:
     mismatch is *required* at every site. For this reason, the probabilities
     created for recombination and mismatch when using the the public-facing
     ``recombination_rate`` and ``mismatch_ratio`` parameters are never > 0.5.
+    The ``traceback_memory_limit`` parameter, if not None, is the maximum number
+    of bytes that each low-level matcher instance may use to store the traceback
+    of a single match. A match that needs more than this fails with an error
+    rather than allocating more memory. It is only supported by the C engine.
     TODO: include deliberately non-public details of precision here.
     """
 
@@ -1701,6 +2102,7 @@ class Matcher:
         engine=constants.C_ENGINE,
         progress_monitor=None,
         allow_multiallele=False,
+        traceback_memory_limit=None,
     ):
         self.sample_data = sample_data
         self.num_threads = num_threads
@@ -1832,6 +2234,9 @@ class Matcher:
             self.ancestor_matcher_class = algorithm.AncestorMatcher
         else:
             raise ValueError(f"Unknown engine:{engine}")
+        if traceback_memory_limit is not None and engine != constants.C_ENGINE:
+            raise ValueError("traceback_memory_limit is only supported by the C engine")
+        self.traceback_memory_limit = traceback_memory_limit
         self.tree_sequence_builder = None
 
         # Allocate 64K nodes and edges initially. This will double as needed and will
@@ -1846,15 +2251,25 @@ class Matcher:
             num_alleles=num_alleles, max_nodes=self.max_nodes, max_edges=self.max_edges
         )
         logger.debug(f"Allocated tree sequence builder with max_nodes={self.max_nodes}")
+        # Pool of low-level matcher instances shared between the match worker
+        # threads. Instances reset themselves between haplotypes and only
+        # reallocate their node arrays when the tree sequence builder grows,
+        # so we keep them for the lifetime of the Matcher.
+        self._matcher_pool = []
+        self._matcher_pool_lock = threading.Lock()
 
     @staticmethod
-    def find_path(matcher, child_id, haplotype, start, end):
+    def find_path(matcher, child_id, haplotype, start, end, num_match_nodes=0):
         """
-        Finds the path of the specified haplotype and returns the MatchResult object
+        Finds the path of the specified haplotype and returns the MatchResult object.
+        If num_match_nodes is nonzero, it is used in place of the number of match
+        nodes in the tree sequence builder's indexes.
         """
         missing = haplotype == tskit.MISSING_DATA
         match = np.full(len(haplotype), tskit.MISSING_DATA, dtype=np.int8)
-        left, right, parent = matcher.find_path(haplotype, start, end, match)
+        left, right, parent = matcher.find_path(
+            haplotype, start, end, match, num_match_nodes=num_match_nodes
+        )
         match[missing] = tskit.MISSING_DATA
         diffs = start + np.where(haplotype[start:end] != match[start:end])[0]
         derived_state = haplotype[diffs]
@@ -1878,6 +2293,77 @@ class Matcher:
         )
         return result
 
+    def find_paths(self, matcher, child_ids, haplotypes, start, end):
+        """
+        Finds the paths of a block of haplotypes using the batched low-level
+        interface, which matches them on num_threads threads without holding
+        the GIL, and returns the list of MatchResult objects.
+        """
+        (
+            edge_offset,
+            left,
+            right,
+            parent,
+            mutation_offset,
+            mutations_site,
+            mutations_derived_state,
+            mean_traceback_size,
+        ) = matcher.find_paths(
+            haplotypes, start, end, num_threads=max(1, self.num_threads)
+        )
+        results = []
+        for j, child_id in enumerate(child_ids):
+            edges = slice(edge_offset[j], edge_offset[j + 1])
+            mutations = slice(mutation_offset[j], mutation_offset[j + 1])
+            results.append(
+                MatchResult(
+                    node=child_id,
+                    path=Path(
+                        left=left[edges], right=right[edges], parent=parent[edges]
+                    ),
+                    mutations_site=mutations_site[mutations],
+                    mutations_derived_state=mutations_derived_state[mutations],
+                    mean_traceback_size=mean_traceback_size[j],
+                )
+            )
+        logger.debug(
+            "Matched {} haplotypes; num_edges={} match_mem={}".format(
+                len(child_ids),
+                len(left),
+                humanize.naturalsize(matcher.total_memory, binary=True),
+            )
+        )
+        return results
+
+    def match_batched(self, haplotypes):
+        """
+        Matches the (child_id, haplotype, start, end) tuples from the specified
+        iterator in blocks using find_paths, and returns the list of MatchResults.
+        Blocks are large enough to keep all threads busy, but limited to about
+        64MiB of haplotype data.
+        """
+        batch_size = max(
+            4 * self.num_threads, min(1024, 2**26 // max(1, self.num_sites))
+        )
+        results = []
+        with self.matcher_instance() as matcher:
+            while True:
+                batch = list(itertools.islice(haplotypes, batch_size))
+                if len(batch) == 0:
+                    break
+                child_ids, batch_haplotypes, start, end = zip(*batch)
+                results.extend(
+                    self.find_paths(
+                        matcher,
+                        child_ids,
+                        np.array(batch_haplotypes, dtype=np.int8),
+                        np.array(start, dtype=np.int32),
+                        np.array(end, dtype=np.int32),
+                    )
+                )
+                self.match_progress.update(len(batch))
+        return results
+
     @staticmethod
     def recombination_rate_to_dist(rho, positions):
         """
@@ -1915,43 +2401,115 @@ class Matcher:
         return (1 - np.exp(-genetic_distances * ratio * num_alleles)) / num_alleles
 
     def create_matcher_instance(self):
+        kwargs = {}
+        if self.traceback_memory_limit is not None:
+            kwargs["traceback_memory_limit"] = self.traceback_memory_limit
         return self.ancestor_matcher_class(
             self.tree_sequence_builder,
             recombination=self.recombination,
             mismatch=self.mismatch,
             precision=self.precision,
             extended_checks=self.extended_checks,
+            **kwargs,
         )
 
+    @contextlib.contextmanager
+    def matcher_instance(self):
+        """
+        Context manager that takes a matcher instance from the pool for the
+        duration of the block, allocating a new one only if all existing
+        instances are in use by other threads.
+        """
+        with self._matcher_pool_lock:
+            matcher = self._matcher_pool.pop() if self._matcher_pool else None
+        if matcher is None:
+            matcher = self.create_matcher_instance()
+            logger.debug(
+                f"Allocated matcher instance in thread {threading.get_ident()}"
+            )
+        try:
+            yield matcher
+        finally:
+            with self._matcher_pool_lock:
+                self._matcher_pool.append(matcher)
+
     def convert_inference_mutations(self, tables):
         """
         Convert the mutations stored in the tree sequence builder into the output
-        format.
+        format, including the mutation parents. The site and mutation tables must
+        be empty.
         """
-        mut_site, node, derived_state, _ = self.tree_sequence_builder.dump_mutations()
-        mutation_id = 0
-        num_mutations = len(mut_site)
+        assert len(tables.sites) == 0 and len(tables.mutations) == 0
+        (
+            mut_site,
+            node,
+            derived_state,
+            mut_parent,
+        ) = self.tree_sequence_builder.dump_mutations()
         progress = self.progress_monitor.get(
             "ms_full_mutations", len(self.inference_site_id)
         )
-        schema = tables.sites.metadata_schema.schema
-        for site in self.sample_data.sites(self.inference_site_id):
-            metadata = _update_site_metadata(site.metadata, constants.INFERENCE_FULL)
-            if schema is None:
-                metadata = _encode_raw_metadata(metadata)
-            site_id = tables.sites.add_row(
-                site.position,
-                ancestral_state=site.ancestral_state,
-                metadata=metadata,
-            )
-            while mutation_id < num_mutations and mut_site[mutation_id] == site_id:
-                tables.mutations.add_row(
-                    site_id,
-                    node=node[mutation_id],
-                    derived_state=site.reorder_alleles()[derived_state[mutation_id]],
+        allele_site, _, allele_value = _flatten_site_alleles(
+            self.sample_data.sites_alleles[:][self.inference_site_id]
+        )
+        site_offset = np.searchsorted(allele_site, np.arange(self.num_sites))
+        ancestral_allele = self.sample_data.sites_ancestral_allele[:][
+            self.inference_site_id
+        ].astype(np.int64)
+        if np.any(ancestral_allele < 0):
+            raise ValueError("Inference sites must have a known ancestral allele")
+        # Invert Site.reorder_alleles() to find the derived states in the alleles
+        ancestral = ancestral_allele[mut_site]
+        index = derived_state.astype(np.int64)
+        index = np.where(
+            index == 0, ancestral, np.where(index <= ancestral, index - 1, index)
+        )
+        derived_state, derived_state_offset = tskit.pack_strings(
+            allele_value[site_offset[mut_site] + index]
+        )
+
+        metadata_array = self.sample_data.sites_metadata[:]
+        schema = tables.sites.metadata_schema
+        if schema.schema is None:
+            encode = _encode_raw_metadata
+        else:
+            encode = schema.validate_and_encode_row
+        # Most sites have no metadata of their own, so only encode that once
+        empty_metadata = encode(_update_site_metadata({}, constants.INFERENCE_FULL))
+        metadata = []
+        for site_id in self.inference_site_id:
+            site_metadata = metadata_array[site_id]
+            if len(site_metadata) == 0:
+                metadata.append(empty_metadata)
+            else:
+                site_metadata = _update_site_metadata(
+                    site_metadata, constants.INFERENCE_FULL
                 )
-                mutation_id += 1
-            progress.update()
+                metadata.append(encode(site_metadata))
+        metadata, metadata_offset = tskit.pack_bytes(metadata)
+        ancestral_state, ancestral_state_offset = tskit.pack_strings(
+            allele_value[site_offset + ancestral_allele]
+        )
+        tables.sites.set_columns(
+            position=self.sample_data.sites_position[:][self.inference_site_id],
+            ancestral_state=ancestral_state,
+            ancestral_state_offset=ancestral_state_offset,
+            metadata=metadata,
+            metadata_offset=metadata_offset,
+        )
+        metadata, metadata_offset = _empty_metadata_columns(
+            tables.mutations.metadata_schema, len(node)
+        )
+        tables.mutations.set_columns(
+            site=mut_site,
+            node=node,
+            parent=mut_parent,
+            derived_state=derived_state,
+            derived_state_offset=derived_state_offset,
+            metadata=metadata,
+            metadata_offset=metadata_offset,
+        )
+        progress.update(len(self.inference_site_id))
         progress.close()
 
     def restore_tree_sequence_builder(self):
@@ -1989,20 +2547,16 @@ class Matcher:
         )
 
         mutations = tables.mutations
-        derived_state = np.zeros(len(mutations), dtype=np.int8)
-        mutation_site = mutations.site
-        site_id = 0
-        mutation_id = 0
-        for site in self.sample_data.sites(self.inference_site_id):
-            while (
-                mutation_id < len(mutations) and mutation_site[mutation_id] == site_id
-            ):
-                allele = mutations[mutation_id].derived_state
-                derived_state[mutation_id] = site.reorder_alleles().index(allele)
-                mutation_id += 1
-            site_id += 1
+        derived_state = _derived_state_indexes(
+            self.sample_data.sites_alleles[:][self.inference_site_id],
+            self.sample_data.sites_ancestral_allele[:][self.inference_site_id],
+            mutations.site,
+            tskit.unpack_strings(
+                mutations.derived_state, mutations.derived_state_offset
+            ),
+        )
         self.tree_sequence_builder.restore_mutations(
-            mutation_site, mutations.node, derived_state, mutations.parent
+            mutations.site, mutations.node, derived_state, mutations.parent
         )
         logger.info(
             "Loaded {} samples {} nodes; {} edges; {} sites; {} mutations".format(
@@ -2017,7 +2571,13 @@ class Matcher:
 
 class AncestorMatcher(Matcher):
     def __init__(
-        self, sample_data, ancestor_data, ancestors_ts=None, time_units=None, **kwargs
+        self,
+        sample_data,
+        ancestor_data,
+        ancestors_ts=None,
+        time_units=None,
+        snapshot_path=None,
+        **kwargs,
     ):
         super().__init__(sample_data, ancestor_data.sites_position[:], **kwargs)
         self.ancestor_data = ancestor_data
@@ -2026,7 +2586,9 @@ class AncestorMatcher(Matcher):
         self.time_units = time_units
         self.num_ancestors = self.ancestor_data.num_ancestors
 
-        if ancestors_ts is None:
+        if snapshot_path is not None:
+            self.tree_sequence_builder.restore_snapshot(snapshot_path)
+        elif ancestors_ts is None:
             # Add nodes for all the ancestors so that the ancestor IDs are equal
             # to the node IDs.
             for t in self.ancestor_data.ancestors_time[:]:
@@ -2035,15 +2597,23 @@ class AncestorMatcher(Matcher):
             self.ancestors_ts_tables = ancestors_ts.tables
             self.restore_tree_sequence_builder()
 
-    def group_by_linesweep(self):
+    def group_by_linesweep(self, linesweep_cutoff=500):
+        """
+        Returns the ancestors grouped for matching. The ancestors are grouped by
+        linesweep up to the first epoch (after the first half) that is more than
+        linesweep_cutoff times larger than the median epoch size, and the
+        remaining epochs each form a single group. If linesweep_cutoff is None
+        all the ancestors are grouped by linesweep.
+        """
         t = time_.time()
         start = self.ancestor_data.ancestors_start[:]
         end = self.ancestor_data.ancestors_end[:]
         time = self.ancestor_data.ancestors_time[:]
 
-        # We only need to perform the grouping for the small epochs at earlier times.
-        # Skipping the later epochs _really_ helps as later ancestors are dependent on
-        # almost all the earlier ones, so the dependency graph becomes intractable.
+        # Grouping by linesweep gives fewer, larger groups than grouping by epoch.
+        # However, later epochs are large and their ancestors depend on almost all
+        # the earlier ones, so there is little to gain from them, and by default
+        # we switch to grouping by epoch at the first large epoch.
         breaks = np.where(time[1:] != time[:-1])[0]
         epoch_start = np.hstack([[0], breaks + 1])
         epoch_end = np.hstack([breaks + 1, [self.num_ancestors]])
@@ -2051,13 +2621,16 @@ class AncestorMatcher(Matcher):
         epoch_sizes = time_slices[:, 1] - time_slices[:, 0]
 
         median_size = np.median(epoch_sizes)
-        cutoff = 500 * median_size
+        cutoff = np.inf
+        if linesweep_cutoff is not None:
+            cutoff = linesweep_cutoff * median_size
         # Zero out the first half so that an initial large epoch doesn't
         # get selected as the cutoff
         epoch_sizes[: len(epoch_sizes) // 2] = 0
-        # To choose a cutoff point find the first epoch that is 50 times larger than
-        # the median epoch size. For a large set of human genomes the median epoch
-        # size is around 10, so we'll stop grouping by linesweep at 5000.
+        # To choose a cutoff point find the first epoch that is linesweep_cutoff
+        # times larger than the median epoch size. For a large set of human genomes
+        # the median epoch size is around 10, so with the default of 500 we'll stop
+        # grouping by linesweep at 5000.
         if np.max(epoch_sizes) <= cutoff:
             large_epoch = len(time_slices)
             large_epoch_first_ancestor = self.num_ancestors
@@ -2080,8 +2653,9 @@ class AncestorMatcher(Matcher):
 
         # Remove the "virtual root" ancestor
         try:
-            assert 0 in ancestor_grouping[0]
-            ancestor_grouping[0].remove(0)
+            group = ancestor_grouping[0]
+            assert 0 in group
+            ancestor_grouping[0] = group[group != 0]
         except KeyError:
             pass
         logger.info(
@@ -2134,17 +2708,21 @@ class AncestorMatcher(Matcher):
         )
 
     def match_locally(self, ancestor_ids):
-        def thread_worker_function(ancestor):
-            local_data = threading.local()
-            if not hasattr(local_data, "matcher"):
-                local_data.matcher = self.create_matcher_instance()
-            result = self.find_path(
-                matcher=local_data.matcher,
-                child_id=ancestor.id,
-                haplotype=ancestor.full_haplotype,
-                start=ancestor.start,
-                end=ancestor.end,
+        if self.engine == constants.C_ENGINE:
+            return self.match_batched(
+                (ancestor.id, ancestor.full_haplotype, ancestor.start, ancestor.end)
+                for ancestor in self.ancestor_data.ancestors(indexes=ancestor_ids)
             )
+
+        def thread_worker_function(ancestor):
+            with self.matcher_instance() as matcher:
+                result = self.find_path(
+                    matcher=matcher,
+                    child_id=ancestor.id,
+                    haplotype=ancestor.full_haplotype,
+                    start=ancestor.start,
+                    end=ancestor.end,
+                )
             self.match_progress.update()
             return result
 
@@ -2166,30 +2744,165 @@ class AncestorMatcher(Matcher):
 
         return results
 
-    def match_ancestors(self, ancestor_grouping):
+    def match_ancestors(self, ancestor_grouping, dataflow=False):
         logger.info(f"Starting ancestor matching for {len(ancestor_grouping)} groups")
         self.match_progress = self.progress_monitor.get(
             "ma_match", sum(len(ids) for ids in ancestor_grouping.values())
         )
-        for group, ancestor_ids in ancestor_grouping.items():
-            t = time_.time()
-            logger.info(
-                f"Starting group {group} of {len(ancestor_grouping)} "
-                f"with {len(ancestor_ids)} ancestors"
-            )
-            self.__start_group(group, ancestor_ids)
-            results = self.match_locally(ancestor_ids)
-            self.__complete_group(group, ancestor_ids, results)
-            logger.info(
-                f"Finished group {group} of {len(ancestor_grouping)} in "
-                f"{time_.time() - t:.2f} seconds"
-            )
+        if dataflow:
+            self.match_ancestors_dataflow(ancestor_grouping)
+        else:
+            for group, ancestor_ids in ancestor_grouping.items():
+                t = time_.time()
+                logger.info(
+                    f"Starting group {group} of {len(ancestor_grouping)} "
+                    f"with {len(ancestor_ids)} ancestors"
+                )
+                self.__start_group(group, ancestor_ids)
+                results = self.match_locally(ancestor_ids)
+                self.__complete_group(group, ancestor_ids, results)
+                logger.info(
+                    f"Finished group {group} of {len(ancestor_grouping)} in "
+                    f"{time_.time() - t:.2f} seconds"
+                )
 
         ts = self.store_output()
         self.match_progress.close()
         logger.info("Finished ancestor matching")
         return ts
 
+    def match_ancestors_dataflow(self, ancestor_grouping):
+        """
+        Matches the ancestors in the specified grouping without a barrier between
+        groups. The groups are still inserted into the tree sequence builder in
+        order, but each ancestor starts matching as soon as the latest earlier
+        group containing an ancestor that overlaps it has been inserted, so that
+        matching in later groups overlaps with stragglers in earlier ones.
+
+        Matching only depends on the edges and mutations within the ancestor's
+        interval, which cannot change until the ancestor's own group is inserted.
+        The remaining dependency on the builder state is through the number of
+        match nodes, which we fix as the number after the dependency group was
+        inserted. The output is therefore the same for any number of threads,
+        but is not identical to that of the grouped schedule.
+        """
+        groups = list(ancestor_grouping.items())
+        group_ids = [
+            np.asarray(ancestor_ids, dtype=np.int32) for _, ancestor_ids in groups
+        ]
+        all_ids = (
+            np.concatenate(group_ids) if len(groups) > 0 else np.zeros(0, np.int32)
+        )
+        group_index = np.repeat(
+            np.arange(len(groups), dtype=np.int32), [len(ids) for ids in group_ids]
+        )
+        dependency = ancestors.find_dependency_groups(
+            self.ancestor_data.ancestors_start[:][all_ids],
+            self.ancestor_data.ancestors_end[:][all_ids],
+            group_index,
+            self.num_sites,
+        )
+        # The ancestors that become ready when each group has been inserted,
+        # preceded by those that are ready immediately.
+        order = np.argsort(dependency, kind="stable")
+        dependants = np.split(
+            all_ids[order],
+            np.searchsorted(dependency[order], np.arange(len(groups))),
+        )
+        # Ready ancestors are read lazily from the ancestor data, to bound the
+        # number of haplotypes held in memory.
+        ready = collections.deque()
+        in_flight = set()
+        results = {}
+        max_in_flight = 4 * max(1, self.num_threads)
+
+        def match_ancestor(ancestor, num_match_nodes):
+            with self.matcher_instance() as matcher:
+                result = self.find_path(
+                    matcher=matcher,
+                    child_id=ancestor.id,
+                    haplotype=ancestor.full_haplotype,
+                    start=ancestor.start,
+                    end=ancestor.end,
+                    num_match_nodes=num_match_nodes,
+                )
+            self.match_progress.update()
+            return result
+
+        def release(index):
+            ids = dependants[index + 1]
+            if len(ids) > 0:
+                if index >= 0:
+                    self.tree_sequence_builder.freeze_indexes()
+                ready.append(
+                    (
+                        self.ancestor_data.ancestors(indexes=np.sort(ids)),
+                        self.tree_sequence_builder.num_match_nodes,
+                    )
+                )
+
+        def next_ready():
+            while len(ready) > 0:
+                ancestors_iter, num_match_nodes = ready[0]
+                ancestor = next(ancestors_iter, None)
+                if ancestor is not None:
+                    return ancestor, num_match_nodes
+                ready.popleft()
+            return None
+
+        def step(executor):
+            if executor is None:
+                ancestor, num_match_nodes = next_ready()
+                results[ancestor.id] = match_ancestor(ancestor, num_match_nodes)
+                return
+            while len(in_flight) < max_in_flight:
+                item = next_ready()
+                if item is None:
+                    break
+                in_flight.add(executor.submit(match_ancestor, *item))
+            done, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                in_flight.remove(future)
+                result = future.result()
+                results[result.node] = result
+
+        with contextlib.ExitStack() as stack:
+            executor = None
+            # The Python engine reads the builder's live indexes, so we can only
+            # match concurrently with the insertion of groups using the C engine.
+            if self.num_threads > 0 and self.engine == constants.C_ENGINE:
+                executor = stack.enter_context(
+                    concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
+                )
+            self.tree_sequence_builder.freeze_indexes()
+            release(-1)
+            for index, (group, ancestor_ids) in enumerate(groups):
+                t = time_.time()
+                logger.info(
+                    f"Waiting for group {group} of {len(groups)} "
+                    f"with {len(ancestor_ids)} ancestors"
+                )
+                self.progress_monitor.set_detail(
+                    collections.OrderedDict(
+                        [("level", str(group)), ("nanc", str(len(ancestor_ids)))]
+                    )
+                )
+                for ancestor_id in ancestor_ids:
+                    while ancestor_id not in results:
+                        step(executor)
+                group_results = [
+                    results.pop(ancestor_id) for ancestor_id in ancestor_ids
+                ]
+                self.__complete_group(group, ancestor_ids, group_results)
+                release(index)
+                logger.info(
+                    f"Finished group {group} of {len(groups)} in "
+                    f"{time_.time() - t:.2f} seconds"
+                )
+        assert len(results) == 0 and len(in_flight) == 0
+
     def match_partition(self, ancestors_to_match, group_index, partition_index):
         logger.info(
             f"Matching group {group_index} partition {partition_index} "
@@ -2236,7 +2949,9 @@ class AncestorMatcher(Matcher):
                 metadata.append(_encode_raw_metadata({"ancestor_data_id": ancestor}))
                 ancestor += 1
         tables.nodes.packset_metadata(metadata)
-        left, right, parent, child = tsb.dump_edges()
+        # The builder dumps the edges in sorted order and computes the mutation
+        # parents, so we don't need to sort the tables.
+        left, right, parent, child = tsb.dump_edges(sort=True)
         tables.edges.set_columns(
             left=self.position_map[left],
             right=self.position_map[right],
@@ -2245,14 +2960,7 @@ class AncestorMatcher(Matcher):
         )
 
         self.convert_inference_mutations(tables)
-
-        logger.debug("Sorting ancestors tree sequence")
-        tables.sort()
-        # Note: it's probably possible to compute the mutation parents from the
-        # tsb data structures but we're not doing it for now.
         tables.build_index()
-        tables.compute_mutation_parents()
-        logger.debug("Sorting ancestors tree sequence done")
         logger.info(
             "Built ancestors tree sequence: {} nodes ({} pc ancestors); {} edges; "
             "{} sites; {} mutations".format(
@@ -2282,10 +2990,13 @@ class AncestorMatcher(Matcher):
 
 
 class SampleMatcher(Matcher):
-    def __init__(self, sample_data, ancestors_ts, **kwargs):
+    def __init__(self, sample_data, ancestors_ts, snapshot_path=None, **kwargs):
         self.ancestors_ts_tables = ancestors_ts.dump_tables()
         super().__init__(sample_data, self.ancestors_ts_tables.sites.position, **kwargs)
-        self.restore_tree_sequence_builder()
+        if snapshot_path is None:
+            self.restore_tree_sequence_builder()
+        else:
+            self.tree_sequence_builder.restore_snapshot(snapshot_path)
         # Map from input sample indexes (IDs in the SampleData file) to the
         # node ID in the tree sequence.
         self.sample_id_map = {}
@@ -2294,19 +3005,17 @@ class SampleMatcher(Matcher):
         def thread_worker_function(j_haplotype):
             j, haplotype = j_haplotype
             assert len(haplotype) == self.num_sites
-            local_data = threading.local()
-            if not hasattr(local_data, "matcher"):
-                local_data.matcher = self.create_matcher_instance()
             logger.info(
                 f"{time_.time()}Thread {threading.get_ident()} starting haplotype {j}"
             )
-            result = self.find_path(
-                matcher=local_data.matcher,
-                child_id=self.sample_id_map[j],
-                haplotype=haplotype,
-                start=0,
-                end=self.num_sites,
-            )
+            with self.matcher_instance() as matcher:
+                result = self.find_path(
+                    matcher=matcher,
+                    child_id=self.sample_id_map[j],
+                    haplotype=haplotype,
+                    start=0,
+                    end=self.num_sites,
+                )
             self.match_progress.update()
             logger.info(
                 f"{time_.time()}Thread {threading.get_ident()} finished haplotype {j}"
@@ -2318,6 +3027,11 @@ class SampleMatcher(Matcher):
             sites=self.inference_site_id,
             recode_ancestral=True,
         )
+        if self.engine == constants.C_ENGINE:
+            return self.match_batched(
+                (self.sample_id_map[j], haplotype, 0, self.num_sites)
+                for j, haplotype in sample_haplotypes
+            )
         if self.num_threads > 0:
             results = threads.threaded_map(
                 thread_worker_function, sample_haplotypes, self.num_threads
@@ -2426,17 +3140,39 @@ class SampleMatcher(Matcher):
             tables.individuals.metadata_schema = tskit.MetadataSchema(schema)
 
         num_ancestral_individuals = len(tables.individuals)
-        for ind in self.sample_data.individuals():
-            metadata = ind.metadata
-            if ind.time != 0:
-                metadata["sample_data_time"] = ind.time
-            if schema is None:
-                metadata = _encode_raw_metadata(ind.metadata)
-            tables.individuals.add_row(
-                location=ind.location,
-                metadata=metadata,
-                flags=ind.flags,
-            )
+        individuals_population = self.sample_data.individuals_population[:]
+        samples_individual = self.sample_data.samples_individual[:]
+        individuals_time = self.sample_data.individuals_time[:]
+        if schema is None:
+            encode = _encode_raw_metadata
+        else:
+            encode = tables.individuals.metadata_schema.validate_and_encode_row
+        metadata = []
+        for ind_metadata, time in zip(
+            self.sample_data.individuals_metadata[:], individuals_time
+        ):
+            if time != 0:
+                ind_metadata = {**ind_metadata, "sample_data_time": time}
+            metadata.append(encode(ind_metadata))
+        metadata, metadata_offset = tskit.pack_bytes(metadata)
+        location = self.sample_data.individuals_location[:]
+        if location.ndim == 2:
+            location_offset = np.arange(len(location) + 1, dtype=np.uint64)
+            location_offset *= location.shape[1]
+            location = location.reshape(-1)
+        else:
+            # SampleData stores a ragged array of per-individual locations
+            lengths = np.array([len(loc) for loc in location], dtype=np.uint64)
+            location_offset = np.zeros(len(location) + 1, dtype=np.uint64)
+            np.cumsum(lengths, out=location_offset[1:])
+            location = np.concatenate([np.zeros(0), *location])
+        tables.individuals.append_columns(
+            flags=self.sample_data.individuals_flags[:].astype(np.uint32),
+            location=location,
+            location_offset=location_offset,
+            metadata=metadata,
+            metadata_offset=metadata_offset,
+        )
 
         logger.debug("Adding tree sequence nodes")
         flags, times = tsb.dump_nodes()
@@ -2451,29 +3187,46 @@ class SampleMatcher(Matcher):
         tables.nodes.flags = new_flags.astype(np.uint32)
         sample_ids = list(self.sample_id_map.values())
         assert len(tables.nodes) == sample_ids[0]
-        individuals_population = self.sample_data.individuals_population[:]
-        samples_individual = self.sample_data.samples_individual[:]
-        individuals_time = self.sample_data.individuals_time[:]
-        for index, sample_id in self.sample_id_map.items():
-            individual = samples_individual[index]
-            if individuals_time[individual] != 0:
-                flags[sample_id] = np.bitwise_or(
-                    flags[sample_id], constants.NODE_IS_HISTORICAL_SAMPLE
-                )
-            population = individuals_population[individual]
-            tables.nodes.add_row(
-                flags=flags[sample_id],
-                time=times[sample_id],
-                population=population,
-                individual=num_ancestral_individuals + individual,
-            )
-        # Add in the remaining non-sample nodes.
-        for u in range(sample_ids[-1] + 1, tsb.num_nodes):
-            tables.nodes.add_row(flags=flags[u], time=times[u])
+        sample_index = np.fromiter(self.sample_id_map.keys(), dtype=np.int64)
+        sample_id = np.array(sample_ids, dtype=np.int64)
+        individual = samples_individual[sample_index]
+        flags[sample_id] |= np.where(
+            individuals_time[individual] != 0, constants.NODE_IS_HISTORICAL_SAMPLE, 0
+        ).astype(flags.dtype)
+        # The sample nodes are followed by the remaining non-sample nodes.
+        node_id = np.concatenate(
+            [sample_id, np.arange(sample_ids[-1] + 1, tsb.num_nodes, dtype=np.int64)]
+        )
+        num_non_sample = len(node_id) - len(sample_id)
+        node_population = np.concatenate(
+            [
+                individuals_population[individual],
+                np.full(num_non_sample, tskit.NULL),
+            ]
+        ).astype(np.int32)
+        node_individual = np.concatenate(
+            [
+                num_ancestral_individuals + individual,
+                np.full(num_non_sample, tskit.NULL),
+            ]
+        ).astype(np.int32)
+        metadata, metadata_offset = _empty_metadata_columns(
+            tables.nodes.metadata_schema, len(node_id)
+        )
+        tables.nodes.append_columns(
+            flags=flags[node_id].astype(np.uint32),
+            time=times[node_id],
+            population=node_population,
+            individual=node_individual,
+            metadata=metadata,
+            metadata_offset=metadata_offset,
+        )
 
         logger.debug("Adding tree sequence edges")
         tables.edges.clear()
-        left, right, parent, child = tsb.dump_edges()
+        tables.sites.clear()
+        tables.mutations.clear()
+        left, right, parent, child = tsb.dump_edges(sort=True)
         if self.num_sites == 0:
             # We have no inference sites, so no edges have been estimated. To ensure
             # we have a rooted tree, we add in edges for each sample to an artificial
@@ -2485,7 +3238,9 @@ class SampleMatcher(Matcher):
             tables.edges.add_row(0, tables.sequence_length, ultimate, root)
             for sample_id in sample_ids:
                 tables.edges.add_row(0, tables.sequence_length, root, sample_id)
+            tables.sort()
         else:
+            # The edges are already in sorted order
             tables.edges.set_columns(
                 left=self.position_map[left],
                 right=self.position_map[right],
@@ -2493,11 +3248,6 @@ class SampleMatcher(Matcher):
                 child=child,
             )
 
-        logger.debug("Sorting and building intermediate tree sequence.")
-        tables.sites.clear()
-        tables.mutations.clear()
-        tables.sort()
-
         schema = self.sample_data.sites_metadata_schema
         if schema is not None:
             schema = add_to_schema(
@@ -2507,11 +3257,7 @@ class SampleMatcher(Matcher):
             )
             tables.sites.metadata_schema = tskit.MetadataSchema(schema)
         self.convert_inference_mutations(tables)
-
-        # FIXME this is a shortcut. We should be computing the mutation parent above
-        # during insertion (probably)
         tables.build_index()
-        tables.compute_mutation_parents()
 
         logger.info(
             "Built samples tree sequence: {} nodes ({} pc); {} edges; "
@@ -2534,6 +3280,7 @@ class SampleMatcher(Matcher):
                 ts,
                 sample_id_map=np.array(list(self.sample_id_map.keys())),
                 progress_monitor=self.progress_monitor,
+                num_threads=self.num_threads,
             )
         else:
             logger.info("Skipping additional site mapping")
@@ -2579,7 +3326,7 @@ class SampleMatcher(Matcher):
         tables.nodes.time = tables.nodes.time + 1
 
         # TODO - check this works for augmented ancestors with missing data
-        left, right, parent, child = tsb.dump_edges()
+        left, right, parent, child = tsb.dump_edges(sort=True)
         tables.edges.set_columns(
             left=self.position_map[left],
             right=self.position_map[right],
@@ -2590,10 +3337,7 @@ class SampleMatcher(Matcher):
         tables.sites.clear()
         tables.mutations.clear()
         self.convert_inference_mutations(tables)
-
-        logger.debug("Sorting ancestors tree sequence")
-        tables.sort()
-        logger.debug("Sorting ancestors tree sequence done")
+        tables.build_index()
         logger.info(
             "Augmented ancestors tree sequence: {} nodes ({} extra pc ancestors); "
             "{} edges; {} sites; {} mutations".format(
@@ -20,8 +20,10 @@
 Utilities for handling threads.
 """
 import _thread
+import collections
 import concurrent.futures
 import heapq
+import itertools
 import logging
 import threading
 import traceback
@@ -94,6 +96,36 @@ def threaded_map(func, args, num_workers):
             yield result
 
 
+def prefetch_map(func, args, num_prefetch):
+    """
+    Returns an iterator over func(arg) for each of the specified args, in order.
+    While a result is being consumed, the results for up to num_prefetch of the
+    following args are computed on a pool of background threads, so that at most
+    num_prefetch + 1 results are held at any time. If num_prefetch < 1 the
+    results are computed synchronously as they are requested.
+    """
+    if num_prefetch < 1:
+        for arg in args:
+            yield func(arg)
+        return
+    args = iter(args)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_prefetch)
+    in_flight = collections.deque(
+        executor.submit(func, arg) for arg in itertools.islice(args, num_prefetch)
+    )
+    try:
+        while len(in_flight) > 0:
+            future = in_flight.popleft()
+            for arg in itertools.islice(args, 1):
+                in_flight.append(executor.submit(func, arg))
+            yield future.result()
+    finally:
+        # If the consumer stops early, don't wait for results it won't use.
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
 def _queue_thread(worker, work_queue, name="tsinfer-worker", index=0, consumer=True):
     def thread_target():
         try: